@@ -0,0 +1,672 @@
+"""
+Integer-encoded barcode whitelist index.
+
+Each base is packed into 3 bits (A=0, C=1, G=2, T=3, N=4, other=7) behind a leading 1 bit,
+so sequences of different length never share a code. A sequence of up to 21 bases fits in an uint64.
+"""
+
+import bisect
+import itertools
+import math
+import os
+import tempfile
+
+import numpy as np
+
+BASES = "ACGTN"
+BITS = 3
+MAX_LEN = 21
+INVALID_BASE = 7
+# bump when the on-disk layout of BarcodeIndex changes
+CACHE_VERSION = 1
+
+_STR_TABLE = str.maketrans({b: str(i) for i, b in enumerate(BASES)})
+_DECODE_TABLE = str.maketrans("01234567", "ACGTNNNN")
+BASE_LUT = np.full(256, INVALID_BASE, dtype=np.uint64)
+for _i, _b in enumerate(BASES):
+    BASE_LUT[ord(_b)] = _i
+
+
+def encode_seq(seq: str) -> int:
+    """Encode a sequence into an integer. Returns -1 if seq contains bases other than ACGTN.
+
+    >>> encode_seq("ACGTN")
+    33436
+    >>> encode_seq("A") != encode_seq("AA")
+    True
+    >>> encode_seq("AXG")
+    -1
+    """
+    try:
+        return int("1" + seq.translate(_STR_TABLE), 8)
+    except ValueError:
+        return -1
+
+
+def decode_seq(code: int) -> str:
+    """Invalid bases are decoded as N.
+
+    >>> decode_seq(encode_seq("TTGCAN"))
+    'TTGCAN'
+    """
+    digits = oct(code)[3:]
+    return digits.translate(_DECODE_TABLE)
+
+
+def seqs_to_matrix(seqs, width: int) -> np.ndarray:
+    """Convert sequences (list of str or numpy S-dtype array) into an uint8 matrix with shape (n, width).
+    Longer sequences are truncated and shorter sequences are padded with 0.
+
+    >>> seqs_to_matrix(["ACG", "A"], 2).tolist()
+    [[65, 67], [65, 0]]
+    """
+    if not isinstance(seqs, np.ndarray):
+        # faster than converting a list of str to numpy S-dtype
+        buf = "".join([x[:width].ljust(width, "\0") for x in seqs]).encode("latin-1")
+        return np.frombuffer(buf, dtype=np.uint8).reshape(-1, width)
+    arr = seqs
+    if arr.dtype.kind != "S" or arr.dtype.itemsize != width:
+        arr = arr.astype(f"S{width}")
+    return np.ascontiguousarray(arr).view(np.uint8).reshape(-1, width)
+
+
+def encode_matrix(mat: np.ndarray) -> np.ndarray:
+    """Encode each row of an uint8 matrix into an uint64 code. Padding bytes are encoded as invalid bases."""
+    if mat.shape[1] > MAX_LEN:
+        raise ValueError(f"sequence length {mat.shape[1]} is greater than {MAX_LEN}")
+    base = BASE_LUT[mat]
+    codes = np.full(mat.shape[0], 1, dtype=np.uint64)
+    for i in range(mat.shape[1]):
+        codes = (codes << np.uint64(BITS)) | base[:, i]
+    return codes
+
+
+def encode_array(seqs) -> np.ndarray:
+    """Encode equal-length sequences (list of str or numpy S-dtype array) into an uint64 array.
+
+    >>> codes = encode_array(["ACGTN", "TTTTT"])
+    >>> int(codes[0]) == encode_seq("ACGTN")
+    True
+    >>> int(codes[1]) == encode_seq("TTTTT")
+    True
+    """
+    arr = np.asarray(seqs, dtype=bytes)
+    if arr.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return encode_matrix(seqs_to_matrix(arr, arr.dtype.itemsize))
+
+
+def trim_codes(codes: np.ndarray, lengths: np.ndarray, width: int, at_start: bool = False) -> np.ndarray:
+    """Trim codes of width bases to lengths bases, dropping bases at the end (or at the start if at_start).
+    Used to remove the padding of truncated sequences.
+
+    >>> codes = encode_array(["ACGT", "ACGT", "ACGT"])
+    >>> [decode_seq(int(x)) for x in trim_codes(codes, np.array([4, 2, 0]), 4)]
+    ['ACGT', 'AC', '']
+    >>> [decode_seq(int(x)) for x in trim_codes(codes, np.array([4, 2, 0]), 4, at_start=True)]
+    ['ACGT', 'GT', '']
+    """
+    lengths = np.asarray(lengths).astype(np.uint64)
+    if at_start:
+        keep = np.uint64(BITS) * lengths
+        return (codes & ((np.uint64(1) << keep) - np.uint64(1))) | (np.uint64(1) << keep)
+    return codes >> ((np.uint64(width) - lengths) * np.uint64(BITS))
+
+
+def _substitute(codes: np.ndarray, length: int, pos: int, base: int) -> np.ndarray:
+    shift = np.uint64(BITS * (length - 1 - pos))
+    mask = ~(np.uint64(INVALID_BASE) << shift)
+    return (codes & mask) | (np.uint64(base) << shift)
+
+
+class BarcodeIndex:
+    """
+    Sorted-array index from every sequence within n_mismatch of a whitelist barcode to that barcode.
+    Same lookup semantics as the dict from `create_mismatch_origin_dict`, but about 12 bytes per entry.
+    Exact whitelist barcodes always map to themselves.
+
+    >>> index = BarcodeIndex(["AACGTGAT", "AAACATCG"])
+    >>> index["AACGTGAA"]
+    'AACGTGAT'
+    >>> "AACGTGAA" in index, "TTTTTTTT" in index
+    (True, False)
+    >>> index.get("TTTTTTTT", "") == ""
+    True
+    """
+
+    __slots__ = ("barcodes", "n_mismatch", "codes", "keys", "values")
+
+    def __init__(self, barcodes: list, n_mismatch: int = 1):
+        self.barcodes = [x.strip() for x in barcodes if x.strip()]
+        self.n_mismatch = n_mismatch
+        self.codes = np.zeros(len(self.barcodes), dtype=np.uint64)
+        key_list, value_list, exact_list = [], [], []
+        lengths = np.array([len(x) for x in self.barcodes], dtype=int)
+        for length in np.unique(lengths):
+            length = int(length)
+            if n_mismatch > length:
+                raise ValueError(f"n_mismatch ({n_mismatch}) cannot be greater than the sequence length ({length})")
+            origin = np.flatnonzero(lengths == length).astype(np.int32)
+            codes = encode_array([self.barcodes[i] for i in origin])
+            self.codes[origin] = codes
+            key_list.append(codes)
+            value_list.append(origin)
+            exact_list.append(np.ones(len(origin), dtype=bool))
+            for n in range(1, n_mismatch + 1):
+                for locs in itertools.combinations(range(length), n):
+                    for bases in itertools.product(range(len(BASES)), repeat=n):
+                        variant = codes
+                        for pos, base in zip(locs, bases):
+                            variant = _substitute(variant, length, pos, base)
+                        key_list.append(variant)
+                        value_list.append(origin)
+                        exact_list.append(np.zeros(len(origin), dtype=bool))
+
+        keys = np.concatenate(key_list) if key_list else np.zeros(0, dtype=np.uint64)
+        values = np.concatenate(value_list) if value_list else np.zeros(0, dtype=np.int32)
+        exact = np.concatenate(exact_list) if exact_list else np.zeros(0, dtype=bool)
+        # like dict assignment, the last whitelist barcode wins; exact barcodes win over everything
+        order = np.lexsort((values, exact, keys))
+        keys, values = keys[order], values[order]
+        last = np.append(keys[1:] != keys[:-1], True) if len(keys) else np.zeros(0, dtype=bool)
+        self.keys = keys[last]
+        self.values = values[last]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, seq):
+        return self.find(seq) != -1
+
+    def __getitem__(self, seq):
+        i = self.find(seq)
+        if i == -1:
+            raise KeyError(seq)
+        return self.barcodes[i]
+
+    def get(self, seq, default=None):
+        i = self.find(seq)
+        return default if i == -1 else self.barcodes[i]
+
+    def find(self, seq: str) -> int:
+        """Returns the whitelist index of the barcode that seq is corrected to, or -1."""
+        code = encode_seq(seq)
+        if code == -1:
+            return -1
+        # bisect on a memoryview avoids the numpy scalar overhead of searchsorted
+        keys = memoryview(self.keys)
+        pos = bisect.bisect_left(keys, code)
+        if pos < len(keys) and keys[pos] == code:
+            return memoryview(self.values)[pos]
+        return -1
+
+    def lookup_codes(self, codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            codes: uint64 array from `encode_array`
+        Returns:
+            index: whitelist index of each code, -1 if invalid
+            corrected: True if code is not an exact whitelist barcode but within n_mismatch
+
+        >>> index = BarcodeIndex(["AAA", "CCC"])
+        >>> idx, corrected = index.lookup_codes(encode_array(["AAA", "ACC", "GGG"]))
+        >>> idx.tolist(), corrected.tolist()
+        ([0, 1, -1], [False, True, False])
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        if len(self.keys) == 0:
+            return np.full(len(codes), -1, dtype=np.int32), np.zeros(len(codes), dtype=bool)
+        pos = self.keys.searchsorted(codes)
+        pos[pos == len(self.keys)] = 0
+        hit = self.keys[pos] == codes
+        index = np.where(hit, self.values[pos], -1).astype(np.int32)
+        corrected = hit & (self.codes[np.maximum(index, 0)] != codes)
+        return index, corrected
+
+    def lookup(self, seqs) -> tuple[np.ndarray, np.ndarray]:
+        """Same as `lookup_codes` for a list or S-dtype array of equal-length sequences."""
+        return self.lookup_codes(encode_array(seqs))
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.values.nbytes + self.codes.nbytes
+
+    def save(self, path, **meta):
+        """Save to an uncompressed npz file.
+        Write to a temp file first so that concurrent readers never see a partial file."""
+        dirname = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=dirname, suffix=".tmp", delete=False) as f:
+            np.savez(
+                f,
+                barcodes=np.array(self.barcodes, dtype=bytes),
+                n_mismatch=self.n_mismatch,
+                codes=self.codes,
+                keys=self.keys,
+                values=self.values,
+                cache_version=CACHE_VERSION,
+                **meta,
+            )
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path) -> tuple["BarcodeIndex", dict]:
+        """
+        Returns:
+            BarcodeIndex, meta saved with it
+
+        >>> import tempfile
+        >>> index = BarcodeIndex(["AACGTGAT", "AAACATCG"])
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     index.save(f"{tmp_dir}/bc.npz", md5="fake")
+        ...     loaded, meta = BarcodeIndex.load(f"{tmp_dir}/bc.npz")
+        >>> loaded["AACGTGAA"], meta
+        ('AACGTGAT', {'md5': 'fake'})
+        """
+        with np.load(path) as data:
+            if int(data["cache_version"]) != CACHE_VERSION:
+                raise ValueError(f"{path} cache version is not {CACHE_VERSION}")
+            index = cls.__new__(cls)
+            index.barcodes = [x.decode() for x in data["barcodes"]]
+            index.n_mismatch = int(data["n_mismatch"])
+            index.codes = data["codes"]
+            index.keys = data["keys"]
+            index.values = data["values"]
+            known = {"barcodes", "n_mismatch", "codes", "keys", "values", "cache_version"}
+            meta = {k: data[k].item() for k in data.files if k not in known}
+        return index, meta
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return POPCOUNT_LUT[x.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def base_mask(length: int) -> int:
+    """Mask with the lowest bit of each 3-bit base set."""
+    return int("1" * length, 8)
+
+
+def hamming_codes(a, b, length: int):
+    """Number of mismatched bases between codes of equal-length sequences. Works on int or uint64 arrays.
+
+    >>> hamming_codes(encode_seq("ACGTA"), encode_seq("ACGTN"), 5)
+    1
+    >>> hamming_codes(encode_array(["AAAAA", "TTTTT"]), encode_seq("AAATT"), 5).tolist()
+    [2, 3]
+    """
+    if isinstance(a, int) and isinstance(b, int):
+        x = a ^ b
+        return ((x | x >> 1 | x >> 2) & base_mask(length)).bit_count()
+    x = np.asarray(a, dtype=np.uint64) ^ np.asarray(b, dtype=np.uint64)
+    x = (x | (x >> np.uint64(1)) | (x >> np.uint64(2))) & np.uint64(base_mask(length))
+    return _popcount(x).astype(np.int32)
+
+
+class HammingIndex:
+    """
+    Bounded Hamming search for n_mismatch >= 2 without materialising the mismatch neighbourhood.
+    Pigeonhole split-seed index: each barcode is split into n_mismatch + 1 chunks, and any sequence within
+    n_mismatch of a barcode shares at least one chunk with it exactly. Candidates sharing a chunk are then verified
+    by Hamming distance. Memory is O(whitelist size * (n_mismatch + 1)).
+
+    Has the same lookup API as BarcodeIndex. The nearest barcode wins; ties go to the last barcode in the whitelist,
+    the same as `create_mismatch_origin_dict`.
+
+    >>> index = HammingIndex(["AACGTGAT", "AAACATCG"], n_mismatch=2)
+    >>> index["AACGTGCC"], index["AAACATGG"]
+    ('AACGTGAT', 'AAACATCG')
+    >>> "AACGTCCC" in index, "AACGTGAT" in index
+    (False, True)
+    >>> idx, corrected = index.lookup(["AACGTGCC", "AACGTGAT", "TTTTTTTT"])
+    >>> idx.tolist(), corrected.tolist()
+    ([0, 0, -1], [True, False, False])
+    """
+
+    __slots__ = ("barcodes", "n_mismatch", "length", "codes", "chunks", "chunk_keys", "chunk_values")
+
+    def __init__(self, barcodes: list, n_mismatch: int = 2):
+        self.barcodes = [x.strip() for x in barcodes if x.strip()]
+        self.n_mismatch = n_mismatch
+        lengths = {len(x) for x in self.barcodes}
+        if len(lengths) > 1:
+            raise ValueError(f"barcodes must have the same length: {sorted(lengths)}")
+        self.length = lengths.pop() if lengths else 0
+        if n_mismatch >= self.length > 0:
+            raise ValueError(f"n_mismatch ({n_mismatch}) must be less than the sequence length ({self.length})")
+        self.codes = encode_array(self.barcodes)
+        # (shift, mask) of each chunk
+        bounds = np.linspace(0, self.length, n_mismatch + 2).astype(int)
+        self.chunks = []
+        self.chunk_keys, self.chunk_values = [], []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            shift = BITS * (self.length - stop)
+            mask = (1 << (BITS * (stop - start))) - 1
+            self.chunks.append((shift, mask))
+            keys = (self.codes >> np.uint64(shift)) & np.uint64(mask)
+            order = np.argsort(keys, kind="stable")
+            self.chunk_keys.append(keys[order])
+            self.chunk_values.append(order.astype(np.int32))
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def __contains__(self, seq):
+        return self.find(seq) != -1
+
+    def __getitem__(self, seq):
+        i = self.find(seq)
+        if i == -1:
+            raise KeyError(seq)
+        return self.barcodes[i]
+
+    def get(self, seq, default=None):
+        i = self.find(seq)
+        return default if i == -1 else self.barcodes[i]
+
+    def find(self, seq: str) -> int:
+        """Returns the whitelist index of the nearest barcode within n_mismatch, or -1."""
+        best, best_dist = -1, self.n_mismatch + 1
+        for j, dist in self.candidates(seq).items():
+            if dist < best_dist or (dist == best_dist and j > best):
+                best, best_dist = j, dist
+        return best
+
+    def candidates(self, seq: str) -> dict[int, int]:
+        """All whitelist barcodes within n_mismatch of seq.
+
+        Returns:
+            {whitelist index: hamming distance}
+
+        >>> HammingIndex(["AAAAAA", "AAAATT", "CCCCCC"], 2).candidates("AAAAAT")
+        {0: 1, 1: 1}
+        """
+        res = {}
+        if len(seq) != self.length:
+            return res
+        code = encode_seq(seq)
+        if code == -1:
+            return res
+        codes = memoryview(self.codes)
+        for (shift, mask), keys, values in zip(self.chunks, self.chunk_keys, self.chunk_values):
+            key = (code >> shift) & mask
+            keys = memoryview(keys)
+            start = bisect.bisect_left(keys, key)
+            stop = bisect.bisect_right(keys, key, lo=start)
+            for j in memoryview(values)[start:stop]:
+                if j not in res:
+                    dist = hamming_codes(code, codes[j], self.length)
+                    if dist <= self.n_mismatch:
+                        res[j] = dist
+        return res
+
+    def valid_codes(self, codes: np.ndarray) -> np.ndarray:
+        """
+        True for codes of self.length bases without invalid bases, i.e. the sequences `candidates` accepts.
+        Padding of short sequences is encoded as invalid bases.
+        """
+        # all 3 bits set: INVALID_BASE
+        invalid = codes & (codes >> np.uint64(1)) & (codes >> np.uint64(2)) & np.uint64(base_mask(self.length))
+        return ((codes >> np.uint64(BITS * self.length)) == 1) & (invalid == 0)
+
+    def lookup_codes(self, codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as BarcodeIndex.lookup_codes. Codes of other lengths, or with invalid bases or padding, are not matched.
+
+        >>> index = HammingIndex(["AACGTGAT", "AAACATCG"], n_mismatch=2)
+        >>> idx, corrected = index.lookup(["AACGTG", "AACGTGXT", "AACGTGNT"])
+        >>> idx.tolist(), corrected.tolist()
+        ([-1, -1, 0], [False, False, True])
+        >>> [index.find(x) for x in ["AACGTG", "AACGTGXT", "AACGTGNT"]]
+        [-1, -1, 0]
+        >>> index.lookup_codes(encode_array(["AACGTG"]))[0].tolist()
+        [-1]
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        n = len(codes)
+        valid = np.flatnonzero(self.valid_codes(codes))
+        query_list, candidate_list = [], []
+        for (shift, mask), keys, values in zip(self.chunks, self.chunk_keys, self.chunk_values):
+            query_keys = (codes[valid] >> np.uint64(shift)) & np.uint64(mask)
+            start = keys.searchsorted(query_keys, side="left")
+            stop = keys.searchsorted(query_keys, side="right")
+            counts = stop - start
+            query = np.repeat(valid, counts)
+            # position of each candidate in values: start of its query + rank inside the range
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            query_list.append(query)
+            candidate_list.append(values[np.repeat(start, counts) + offsets])
+        query = np.concatenate(query_list)
+        candidate = np.concatenate(candidate_list)
+        dist = hamming_codes(codes[query], self.codes[candidate], self.length)
+        keep = dist <= self.n_mismatch
+        query, candidate, dist = query[keep], candidate[keep], dist[keep]
+        # best candidate per query: smallest distance, then largest whitelist index
+        order = np.lexsort((candidate, -dist, query))
+        query, candidate = query[order], candidate[order]
+        last = np.append(query[1:] != query[:-1], True) if len(query) else np.zeros(0, dtype=bool)
+        index = np.full(n, -1, dtype=np.int32)
+        index[query[last]] = candidate[last]
+        corrected = (index != -1) & (self.codes[np.maximum(index, 0)] != codes)
+        return index, corrected
+
+    def lookup(self, seqs) -> tuple[np.ndarray, np.ndarray]:
+        """Same as `lookup_codes` for a list or S-dtype array of equal-length sequences."""
+        return self.lookup_codes(encode_array(seqs))
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + sum(x.nbytes + y.nbytes for x, y in zip(self.chunk_keys, self.chunk_values))
+
+
+def create_index(barcodes: list, n_mismatch: int = 1):
+    """BarcodeIndex expands the mismatch neighbourhood and is fastest for n_mismatch <= 1.
+    HammingIndex is used for larger n_mismatch to avoid the combinatorial expansion.
+
+    >>> type(create_index(["AACGTGAT"], 1)).__name__, type(create_index(["AACGTGAT"], 2)).__name__
+    ('BarcodeIndex', 'HammingIndex')
+    """
+    if n_mismatch <= 1:
+        return BarcodeIndex(barcodes, n_mismatch)
+    return HammingIndex(barcodes, n_mismatch)
+
+
+# longest segment with a reject bitmap: 4 ** 12 bits = 2 MB
+MAX_BITMAP_LEN = 12
+_2BIT_TABLE = str.maketrans("ACGT", "0123")
+
+
+def create_bitmap(barcodes: list, n_mismatch: int) -> bytes | None:
+    """
+    Bitmap over 2-bit packed ACGT sequences of the barcode length. Bits of all sequences within n_mismatch of a
+    barcode are set. None if barcodes have different lengths, are longer than MAX_BITMAP_LEN or contain other bases.
+
+    >>> bitmap = create_bitmap(["AC"], 1)
+    >>> [int("AC".translate(_2BIT_TABLE), 4), int("TT".translate(_2BIT_TABLE), 4)]
+    [1, 15]
+    >>> bitmap[0] >> 1 & 1, bitmap[1] >> 7 & 1
+    (1, 0)
+    """
+    lengths = {len(x) for x in barcodes}
+    if len(lengths) != 1 or not 0 < min(lengths) <= MAX_BITMAP_LEN:
+        return None
+    length = lengths.pop()
+    try:
+        codes = np.array([int(x.translate(_2BIT_TABLE), 4) for x in barcodes], dtype=np.int64)
+    except ValueError:
+        return None
+    flags = np.zeros(4**length, dtype=bool)
+    flags[codes] = True
+    for n in range(1, min(n_mismatch, length) + 1):
+        for locs in itertools.combinations(range(length), n):
+            shifts = [2 * (length - 1 - pos) for pos in locs]
+            cleared = codes
+            for shift in shifts:
+                cleared = cleared & ~(3 << shift)
+            for bases in itertools.product(range(4), repeat=n):
+                flags[cleared | sum(base << shift for base, shift in zip(bases, shifts))] = True
+    return np.packbits(flags, bitorder="little").tobytes()
+
+
+class WhitelistMatcher:
+    """
+    Match barcode segments of reads to whitelists. Same results as `parse_chemistry.check_seq_mismatch`.
+    Each segment is checked against the exact whitelist set, then a fast-reject bitmap of every ACGT sequence within
+    n_mismatch (see `create_bitmap`), and only then the correcting index. Most invalid segments are rejected by the
+    bitmap without an index search. Sequences containing N skip the bitmap.
+
+    The matcher only holds sets, bytes and numpy arrays, so it is picklable, and forked workers share it
+    copy-on-write.
+
+    >>> matcher = WhitelistMatcher([BarcodeIndex(["AAA", "CCC"]), BarcodeIndex(["GGG"])])
+    >>> matcher.match(["AAT", "GGG"])
+    (True, True, 'AAA_GGG')
+    >>> matcher.match(["TTT", "GGG"])
+    (False, False, '_GGG')
+    >>> matcher.reject(["TTT", "GGG"]), matcher.reject(["ANA", "GGG"]), matcher.is_valid(["ANA", "GGG"])
+    (True, False, True)
+    """
+
+    __slots__ = ("indexes", "raw_sets", "bitmaps", "lengths")
+
+    def __init__(self, indexes: list):
+        """
+        Args:
+            indexes: BarcodeIndex or HammingIndex of each segment
+        """
+        self.indexes = indexes
+        self.raw_sets = [set(x.barcodes) for x in indexes]
+        self.bitmaps = [create_bitmap(x.barcodes, x.n_mismatch) for x in indexes]
+        self.lengths = [len(x.barcodes[0]) if x.barcodes else 0 for x in indexes]
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def _rejected(self, i: int, seq: str) -> bool:
+        """True if seq is surely not within n_mismatch of whitelist i"""
+        bitmap = self.bitmaps[i]
+        if bitmap is None or len(seq) != self.lengths[i]:
+            return False
+        try:
+            key = int(seq.translate(_2BIT_TABLE), 4)
+        except ValueError:
+            return False
+        return not bitmap[key >> 3] >> (key & 7) & 1
+
+    def reject(self, seqs) -> bool:
+        """True if any segment is rejected by its bitmap"""
+        return any(seq not in raw and self._rejected(i, seq) for i, (seq, raw) in enumerate(zip(seqs, self.raw_sets)))
+
+    def contains(self, i: int, seq: str) -> bool:
+        """True if seq is within n_mismatch of whitelist i"""
+        return seq in self.raw_sets[i] or (not self._rejected(i, seq) and seq in self.indexes[i])
+
+    def is_valid(self, seqs) -> bool:
+        """True if every segment is within n_mismatch of its whitelist. Always True without whitelists."""
+        if not self.indexes:
+            return True
+        return all(self.contains(i, seq) for i, seq in enumerate(seqs))
+
+    def match(self, seqs) -> tuple[bool, bool, str]:
+        """
+        Returns:
+            valid, corrected, corrected segments joined by "_". Invalid segments are empty.
+        """
+        valid = True
+        corrected = False
+        res = []
+        for i, (seq, raw) in enumerate(zip(seqs, self.raw_sets)):
+            if seq in raw:
+                res.append(seq)
+                continue
+            j = -1 if self._rejected(i, seq) else self.indexes[i].find(seq)
+            if j == -1:
+                valid = False
+                res.append("")
+            else:
+                corrected = True
+                res.append(self.indexes[i].barcodes[j])
+        return valid, corrected, "_".join(res)
+
+
+PHRED_OFFSET = 33
+# log10 of the probability that a base call is wrong, indexed by quality char ord
+LOG10_ERROR = [max(-(i - PHRED_OFFSET) / 10, -9.9) if i >= PHRED_OFFSET else 0.0 for i in range(256)]
+LOG10_THIRD = math.log10(1 / 3)
+
+
+class QualityCorrector:
+    """
+    Quality-aware barcode correction, similar to Cell Ranger.
+    Each whitelist barcode within n_mismatch is a candidate, with likelihood
+        prior(candidate) * prod(error_prob(qual at mismatch position) / 3)
+    prior is estimated from exact-match barcode counts (plus pseudocount) added with `add_counts`.
+    The best candidate is accepted only if its posterior probability >= min_posterior,
+    so ambiguous corrections become invalid instead of picking an arbitrary neighbour.
+
+    Fit the prior before correcting, e.g. from the exact matches of the first reads; `correct` never updates it,
+    so results do not depend on read order, chunking or threads. Without counts the prior is uniform.
+
+    >>> corrector = QualityCorrector(["AAAAAA", "AAAATT"])
+    >>> corrector.correct("AAAAAT", "IIIIII")  # ambiguous
+    (-1, False)
+    >>> corrector.add_counts([1] * 99 + [0])
+    >>> corrector.correct("AAAAAT", "IIIIII")  # equal quality, prior prefers AAAATT
+    (1, True)
+    >>> corrector.correct("AAAAAT", "IIII#I")  # low quality at the 5th base points to AAAATT
+    (1, True)
+    >>> corrector.correct("AAAAAT", "IIIII#")  # low quality at the 6th base points to AAAAAA
+    (0, True)
+    >>> corrector.correct("AAAAAA", "######")
+    (0, False)
+    >>> corrector.correct("CCCCCC", "IIIIII")
+    (-1, False)
+    """
+
+    def __init__(self, barcodes: list, n_mismatch: int = 1, min_posterior: float = 0.975, pseudocount: float = 0.5):
+        self.index = HammingIndex(barcodes, n_mismatch)
+        self.exact = {x: i for i, x in enumerate(self.index.barcodes)}
+        self.min_posterior = min_posterior
+        self.pseudocount = pseudocount
+        self.counts = np.zeros(len(self.index.barcodes), dtype=np.int64)
+        self.total = 0
+
+    def add_counts(self, whitelist_index):
+        """Add observed exact-match barcodes (whitelist index array, -1 is ignored) to the prior."""
+        whitelist_index = np.asarray(whitelist_index, dtype=np.intp)
+        whitelist_index = whitelist_index[whitelist_index >= 0]
+        np.add.at(self.counts, whitelist_index, 1)
+        self.total += len(whitelist_index)
+
+    def exact_index(self, seq: str) -> int:
+        """Whitelist index of seq, -1 if seq is not in the whitelist"""
+        return self.exact.get(seq, -1)
+
+    def correct(self, seq: str, qual: str) -> tuple[int, bool]:
+        """
+        Returns:
+            whitelist index (-1 if invalid), corrected
+        """
+        if seq in self.exact:
+            return self.exact[seq], False
+        candidates = self.index.candidates(seq)
+        if not candidates:
+            return -1, False
+        if len(candidates) == 1:
+            return next(iter(candidates)), True
+        barcodes = self.index.barcodes
+        total = self.total + self.pseudocount * len(barcodes)
+        likelihood = {}
+        for j in candidates:
+            log10_l = math.log10((self.counts[j] + self.pseudocount) / total)
+            for base, bc_base, q in zip(seq, barcodes[j], qual):
+                if base != bc_base:
+                    log10_l += LOG10_ERROR[ord(q)] + LOG10_THIRD
+            likelihood[j] = 10**log10_l
+        best = max(likelihood, key=likelihood.get)
+        if likelihood[best] / sum(likelihood.values()) < self.min_posterior:
+            return -1, False
+        return best, True
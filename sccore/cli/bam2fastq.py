@@ -2,13 +2,15 @@ from pathlib import Path
 import sys
 import pysam
 
+from sccore.fastq import FastqWriter
+
 
 def extract_unmapped_to_fastq(bam_path, r1_path, r2_path):
     # 打开 BAM 文件
     bam = pysam.AlignmentFile(bam_path, "rb")
 
     # 打开输出文件
-    with open(r1_path, "w") as r1, open(r2_path, "w") as r2:
+    with FastqWriter(r1_path) as r1, FastqWriter(r2_path) as r2:
         for read in bam:
             # 仅处理未比对的 read
             if read.is_unmapped:
@@ -33,18 +35,22 @@ def extract_unmapped_to_fastq(bam_path, r1_path, r2_path):
                 r2_qual = pysam.qualities_to_qualitystring(read.query_qualities)
 
                 # 写入 R1 FASTQ
-                r1.write(f"@{read.query_name}\n{r1_seq}\n+\n{r1_qual}\n")
+                r1.write(read.query_name, r1_seq, r1_qual)
 
                 # 写入 R2 FASTQ
-                r2.write(f"@{read.query_name}\n{r2_seq}\n+\n{r2_qual}\n")
+                r2.write(read.query_name, r2_seq, r2_qual)
 
     bam.close()
     print(f"提取完成！R1: {r1_path}, R2: {r2_path}")
 
 
-if __name__ == "__main__":
+def main():
     bam_file = sys.argv[1]
     sample = Path(bam_file).stem.split("_")[0]
     r1_file = f"{sample}_R1.fastq"
     r2_file = f"{sample}_R2.fastq"
     extract_unmapped_to_fastq(bam_file, r1_file, r2_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,13 @@
 
 import numpy as np
 
-import scanpy as sc
 import pandas as pd
 import argparse
 import os
 from glob import glob
 
+from sccore.matrix import CountMatrix
+
 
 def parse_gtf(gtf_file):
     gene_info = {}
@@ -40,7 +41,7 @@ def parse_gtf(gtf_file):
 
 def process_matrix(matrix_dir, gene_info, out_prefix):
     print(f"Processing sample: {out_prefix}")
-    adata = sc.read_10x_mtx(matrix_dir, var_names="gene_symbols", make_unique=True)
+    adata = CountMatrix.from_matrix_dir(matrix_dir, cache=True).to_anndata()
 
     counts = np.array(adata.X.sum(axis=0)).ravel()  # 不会转稠密，只返回一个小的一维数组
     gene_counts = pd.DataFrame(
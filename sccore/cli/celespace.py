@@ -11,6 +11,7 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 
 from sccore import utils
+from sccore.matrix import CountMatrix
 
 SPATIAL_DIR = Path("/SGRNJ06/randd/USER/zhouyiqi/work/analysis/space/fake_spatial/")
 
@@ -21,7 +22,7 @@ def run_scanpy(sample, mtx_path, spatial_path):
     if not sample_path.exists():
         os.makedirs(sample_path, exist_ok=True)
     print(f"Processing sample: {sample}\n")
-    adata = sc.read_10x_mtx(mtx_path, var_names="gene_symbols", make_unique=True)
+    adata = CountMatrix.from_matrix_dir(mtx_path, cache=True).to_anndata()
 
     pos_file = spatial_path / "tissue_positions_list.csv"
     positions = pd.read_csv(pos_file, header=None)
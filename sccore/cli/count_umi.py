@@ -2,6 +2,7 @@
 输入一个fastq文件， fastq文件名称为{sample}_2.fq
 read name格式为barcode:umi:id
 统计每个barcode的read数目和umi数目，输出为{sample}_count.tsv文件，包含barcode, read_count, umi_count三列
+可选的第二个参数为UMI去重方法(unique, cluster, directional)，默认unique；cluster和directional会合并相差1个碱基的UMI
 """
 
 #!/usr/bin/env python3
@@ -9,38 +10,41 @@ import sys
 import os
 
 import pandas as pd
-import pysam
-from collections import defaultdict
+from sccore import fastq, umi
 
 
 def main():
-    if len(sys.argv) != 2:
-        sys.stderr.write("Usage: python count_barcode_umi.py <input.fq>\n")
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write(f"Usage: python count_barcode_umi.py <input.fq> [{'|'.join(umi.METHODS)}]\n")
         sys.exit(1)
 
     fq = sys.argv[1]
+    method = sys.argv[2] if len(sys.argv) == 3 else "unique"
+    if method not in umi.METHODS:
+        sys.stderr.write(f"Unknown UMI method: {method}. Choose from {umi.METHODS}\n")
+        sys.exit(1)
     sample = os.path.basename(fq).split("_")[0]
     out_tsv = f"{sample}_count.tsv"
 
-    read_count = defaultdict(int)
-    umi_set = defaultdict(set)
+    counter = umi.UmiCounter()
 
     print(f"Processing file: {fq}")
-    with pysam.FastxFile(fq) as f:
-        for read in f:
+    for chunk in fastq.iter_fastq_chunks(fq):
+        barcodes, umis = [], []
+        for name in chunk.names:
             # read name format: barcode:umi:id
             try:
-                barcode, umi, _ = read.name.split(":", 2)
+                barcode, umi_seq, _ = name.split(":", 2)
             except ValueError:
-                sys.stderr.write(f"Invalid read name format: {read.name}\n")
+                sys.stderr.write(f"Invalid read name format: {name}\n")
                 continue
-
-            read_count[barcode] += 1
-            umi_set[barcode].add(umi)
+            barcodes.append(barcode)
+            umis.append(umi_seq)
+        counter.add(barcodes, umis)
 
     rows = []
-    for barcode in read_count:
-        rows.append({"barcode": barcode, "read_count": read_count[barcode], "umi_count": len(umi_set[barcode])})
+    for barcode, (read_count, umi_count) in counter.count(method).items():
+        rows.append({"barcode": barcode, "read_count": read_count, "umi_count": umi_count})
 
     df = pd.DataFrame(rows)
 
@@ -5,16 +5,23 @@ import pandas as pd
 from collections import defaultdict
 import sys
 
+from sccore import umi
 
-def count_gene_reads_and_umis(bam_path) -> pd.DataFrame:
+BATCH_SIZE = 100_000
+
+
+def count_gene_reads_and_umis(bam_path, method="unique") -> pd.DataFrame:
     """
     统计 unique-mapped reads (NH:i:1) 的每个基因的 read 数量 和 unique UMI 数量（考虑 cell barcode）。
+    method: UMI去重方法，见 sccore.umi
     返回 pandas DataFrame。
     """
     bam = pysam.AlignmentFile(bam_path, "rb")
 
     gene_reads = defaultdict(int)
-    gene_umis = defaultdict(set)  # (cell, umi) 去重
+    gene_umis = defaultdict(int)
+    counter = umi.UmiCounter()  # (gene, cell) 内 UMI 去重
+    keys, umis = [], []
 
     for read in bam:
         if read.is_unmapped:
@@ -30,20 +37,27 @@ def count_gene_reads_and_umis(bam_path) -> pd.DataFrame:
         # 获取标签
         tags = dict(read.get_tags())
         gene = tags.get("GN")
-        umi = tags.get("UB")
+        umi_seq = tags.get("UB")
         cell = tags.get("CB")
 
-        if not gene or not umi or not cell or gene == "-" or umi == "-" or cell == "-":
+        if not gene or not umi_seq or not cell or gene == "-" or umi_seq == "-" or cell == "-":
             continue
 
         gene_reads[gene] += 1
-        gene_umis[gene].add((cell, umi))
+        keys.append((gene, cell))
+        umis.append(umi_seq)
+        if len(keys) == BATCH_SIZE:
+            counter.add(keys, umis)
+            keys, umis = [], []
 
     bam.close()
+    counter.add(keys, umis)
+    for (gene, _cell), (_n_read, n_umi) in counter.count(method).items():
+        gene_umis[gene] += n_umi
 
     # 生成 DataFrame
     df = pd.DataFrame(
-        [(g, gene_reads[g], len(gene_umis[g])) for g in gene_reads], columns=["gene", "read_count", "umi_count"]
+        [(g, gene_reads[g], gene_umis[g]) for g in gene_reads], columns=["gene", "read_count", "umi_count"]
     )
 
     # 计算总数并添加百分比列（保留三位小数）
@@ -60,14 +74,15 @@ def count_gene_reads_and_umis(bam_path) -> pd.DataFrame:
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python count_gene_reads_umis_df.py <input.bam>")
+        print(f"Usage: python count_gene_reads_umis_df.py <input.bam> [{'|'.join(umi.METHODS)}]")
         sys.exit(1)
     bam_path = Path(sys.argv[1])
+    method = sys.argv[2] if len(sys.argv) > 2 else "unique"
     prefix = bam_path.stem
     out_path = Path(f"{prefix}.gene_read_umi.tsv")
 
     print("🔍 开始统计基因的 reads 和 UMIs...")
-    df = count_gene_reads_and_umis(bam_path)
+    df = count_gene_reads_and_umis(bam_path, method)
     df.to_csv(out_path, sep="\t", index=False)
 
     print(f"✅ 输出完成: {out_path} ({len(df)} genes)")
@@ -11,8 +11,8 @@ import functools
 
 
 def get_metrics_dict(mtx_path, doublet_threshold):
-    mtx = CountMatrix.from_matrix_dir(mtx_path)
-    m = mtx.get_matrix()
+    mtx = CountMatrix.from_matrix_dir(mtx_path, cache=True)
+    m = mtx.get_csr()
     f = mtx.get_features()
 
     human = []
@@ -22,8 +22,8 @@ def get_metrics_dict(mtx_path, doublet_threshold):
             human.append(i)
         else:
             mouse.append(i)
-    umi_h = m.tocsr()[human, :].sum(axis=0)
-    umi_m = m.tocsr()[mouse, :].sum(axis=0)
+    umi_h = m[human, :].sum(axis=0)
+    umi_m = m[mouse, :].sum(axis=0)
     df_m = pd.DataFrame(umi_m.T, columns=["mouse"])
     df_h = pd.DataFrame(umi_h.T, columns=["human"])
     df = pd.merge(df_m, df_h, left_index=True, right_index=True)
@@ -1,67 +1,88 @@
 #!usr/bin/env python3
 
 import argparse
-import pyfastx
+import itertools
+import random
+
 import pysam
-from sccore import parse_chemistry, utils
+from sccore import fastq, parse_chemistry
+
+
+def sample_invalid_names(bam, num, seed=0) -> set[str]:
+    """
+    Reservoir sample of num read names with CB == "-" in one pass.
+    Secondary and supplementary records are skipped so that each read is counted once; records of the same read
+    next to each other are also skipped. Memory does not grow with the number of invalid reads.
+    """
+    names = []
+    prev_name = None
+    n = 0
+    rng = random.Random(seed)
+    with pysam.AlignmentFile(bam, "rb") as fh:
+        for read in fh:
+            if read.is_secondary or read.is_supplementary:
+                continue
+            if not read.has_tag("CB") or read.get_tag("CB") != "-" or read.query_name == prev_name:
+                continue
+            prev_name = read.query_name
+            n += 1
+            if len(names) < num:
+                names.append(read.query_name)
+            else:
+                j = rng.randrange(n)
+                if j < num:
+                    names[j] = read.query_name
+    return set(names)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--fq1")
+    parser.add_argument("--fq1", help="R1 fastq files, comma separated")
     parser.add_argument("--bam")
-    parser.add_argument("--assets_dir")
-    parser.add_argument("--num", default=10**4, type=int)
+    parser.add_argument("--assets_dir", help="Not used")
+    parser.add_argument("--chemistry", default="GEXSCOPE-V2", help="Chemistry in CHEMISTRY_DICT, or auto")
+    parser.add_argument(
+        "--num",
+        default=10**4,
+        type=int,
+        help="bam: number of sampled invalid read names. fq1: only check the first num reads",
+    )
+    parser.add_argument(
+        "--sample_size", default=1000, type=int, help="fq1: number of invalid reads sampled into invalid.fastq"
+    )
+    parser.add_argument("--threads", default=1, type=int)
     args = parser.parse_args()
     if not (args.fq1 or args.bam):
         raise ValueError("Please provide fq1 or bam")
+    fq1_list = args.fq1.split(",") if args.fq1 else []
 
     if args.bam:
-        cnt = 0
-        read_names = set()
-        fh = pysam.AlignmentFile(args.bam, "rb")
-        for read in fh:
-            bc = read.get_tag("CB")
-            if bc == "-" and read.query_name not in read_names:
-                cnt += 1
-                read_names.add(read.query_name)
-                if cnt == args.num:
-                    break
-        print(f"{cnt} Read names extracted")
+        read_names = sample_invalid_names(args.bam, args.num)
+        print(f"{len(read_names)} Read names extracted")
 
-        fq1 = pyfastx.Fastx(args.fq1)
         found = 0
-        invalid_fastq = open("invalid.txt", "wt")
-        for name1, seq1, qual1 in fq1:
-            if name1 in read_names:
-                found += 1
-                invalid_fastq.write(seq1 + "\n")
-                if found == args.num:
+        chunks = itertools.chain.from_iterable(fastq.iter_fastq_chunks(fq1) for fq1 in fq1_list)
+        with open("invalid.txt", "wt") as invalid_fastq:
+            for chunk in chunks:
+                for name, seq, _qual in chunk:
+                    if name in read_names:
+                        found += 1
+                        invalid_fastq.write(seq + "\n")
+                if found == len(read_names):
                     break
 
     elif args.fq1:
-        chemistry_dict = parse_chemistry.get_chemistry_dict(args.assets_dir)
-        v2_dict = chemistry_dict["GEXSCOPE-V2"]
-        v2_raw, v2_mismatch = parse_chemistry.create_mismatch_origin_dicts_from_whitelists(v2_dict["bc"], 1)
-
-        invalid_fastq = open("invalid.fastq", "wt")
-        fq1 = pyfastx.Fastx(args.fq1)
-        raw = valid_reads = invalid_reads = 0
-        for name1, seq1, qual1 in fq1:
-            raw += 1
-            bc_list = [seq1[x] for x in v2_dict["pattern_dict"]["C"]]
-            valid, _corrected, res = parse_chemistry.check_seq_mismatch(bc_list, v2_raw, v2_mismatch)
-            if not valid:
-                invalid_fastq.write(utils.fastq_str(name1, seq1, qual1))
-                invalid_reads += 1
-            else:
-                valid_reads += 1
-
-            if raw == args.num:
-                break
-        print(f"Total reads: {raw}")
-        print(f"Valid reads: {valid_reads}")
-        print(f"Invalid reads: {invalid_reads}")
+        chemistry = args.chemistry
+        if chemistry == "auto":
+            chemistry = parse_chemistry.AutoRNA(fq1_list).get_chemistry()
+        stats = parse_chemistry.diagnose_invalid(chemistry, fq1_list, args.num, args.sample_size, args.threads)
+        stats.write("invalid.fastq", "invalid_stats.tsv")
+        parse_chemistry.invalid_debug(chemistry, fq1_list, "invalid.html", stats=stats)
+        print(f"Total reads: {stats.n_read}")
+        print(f"Valid reads: {stats.n_read - stats.n_invalid}")
+        print(f"Invalid reads: {stats.n_invalid}")
+        for reason, n, percent in stats.get_reason_rows():
+            print(f"{reason}: {n} ({percent}%)")
 
 
 if __name__ == "__main__":
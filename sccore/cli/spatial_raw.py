@@ -5,7 +5,8 @@ import shutil
 import h5py
 import numpy as np
 from pathlib import Path
-import scanpy as sc
+
+from sccore.matrix import CountMatrix
 
 
 def convert_10x_h5(mtx_dir, outfile, library_id="library0"):
@@ -28,7 +29,7 @@ def convert_10x_h5(mtx_dir, outfile, library_id="library0"):
         outfile.unlink()
 
     # 读取 MTX 文件
-    adata = sc.read_10x_mtx(mtx_dir, var_names="gene_symbols", make_unique=True)
+    adata = CountMatrix.from_matrix_dir(mtx_dir, cache=True).to_anndata()
 
     n_cells = adata.n_obs
     n_genes = adata.n_vars
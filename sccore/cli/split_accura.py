@@ -2,53 +2,216 @@
 将AccuraSCOPE RNA或者DNA的fastq拆分到孔的fastq
 - 根据well name的mapping关系命名对应的fastq文件
 - 输出指标：valid reads百分比，在孔中的reads百分比
+- 两步模式：--write_index 只输出每条valid read的孔号索引(rna_index.npy)和指标；
+  --index 根据索引和新的well name直接拆分fastq，不再重新识别reads
 """
 
 from collections import defaultdict
+import gzip
+import struct
+import numpy as np
 import pandas as pd
-import pysam
 import argparse
-from sccore import utils, parse_chemistry
+from sccore import utils, parse_chemistry, fastq
 from pathlib import Path
 import sys
 
+CHUNK_SIZE = 100_000
+P3 = "AccuraSCOPE_RNA_3p"
+P5 = "AccuraSCOPE_RNA_5p"
+RNA_CHEMISTRYS = (P3, P5)
+# one row per valid read. ordinal: 1-based read number in the input fastqs; well: line number in the barcode file;
+# chemistry: index in RNA_CHEMISTRYS; umi: empty for 5' and dna reads
+INDEX_DTYPE = np.dtype([("ordinal", "<i8"), ("well", "<i4"), ("chemistry", "u1"), ("umi", "S12")])
+
 
 def get_well_barcode(bc_file: str) -> dict[int, str]:
     barcodes = utils.one_col_to_list(bc_file)
     return {i: x for i, x in enumerate(barcodes, start=1)}
 
 
-def get_barcode_name(
-    bc_file: str,
-    well_name_file: str,
-) -> dict[str, str]:
-    well_barcode = get_well_barcode(bc_file)
-    well_name = utils.two_col_to_dict(well_name_file)
-    barcode_name = {}
-    for well, barcode in well_barcode.items():
-        if well in well_name:
-            barcode_name[barcode] = well_name[well]
-        else:
-            barcode_name[barcode] = f"noise_{well}"
-    return barcode_name
+def get_barcode_well(bc_file: str) -> dict[str, int]:
+    return {barcode: well for well, barcode in get_well_barcode(bc_file).items()}
+
+
+def get_well_name(well: int, well_name: dict) -> str:
+    """Wells missing from well_name are named noise_{well}"""
+    return well_name[well] if well in well_name else f"noise_{well}"
+
+
+class NpyWriter:
+    """
+    Append 1-D structured arrays to a .npy file without holding them in memory.
+    The header has a fixed length and is rewritten with the final shape on close.
+
+    >>> import tempfile, os
+    >>> path = tempfile.mktemp(suffix=".npy")
+    >>> with NpyWriter(path, INDEX_DTYPE) as writer:
+    ...     writer.write(np.array([(1, 2, 0, b"AAA")], dtype=INDEX_DTYPE))
+    ...     writer.write(np.array([(5, 3, 1, b"")], dtype=INDEX_DTYPE))
+    >>> np.load(path)["ordinal"].tolist()
+    [1, 5]
+    >>> os.remove(path)
+    """
+
+    HEADER_LEN = 256
+
+    def __init__(self, path, dtype: np.dtype):
+        self.dtype = dtype
+        self.n = 0
+        self.handle = open(path, "wb")
+        self.write_header()
+
+    def write_header(self):
+        descr = np.lib.format.dtype_to_descr(self.dtype)
+        header = f"{{'descr': {descr!r}, 'fortran_order': False, 'shape': ({self.n},), }}"
+        header = header.ljust(self.HEADER_LEN - 11) + "\n"
+        self.handle.seek(0)
+        self.handle.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin-1"))
+
+    def write(self, arr: np.ndarray):
+        self.handle.seek(0, 2)
+        self.handle.write(np.ascontiguousarray(arr, dtype=self.dtype).tobytes())
+        self.n += len(arr)
+
+    def close(self):
+        self.write_header()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compress_blocks(name_records: dict[str, list[str]]) -> dict[str, bytes]:
+    """Each value is a complete gzip member, which can be appended to the output file"""
+    return {name: gzip.compress("".join(records).encode(), compresslevel=1) for name, records in name_records.items()}
+
+
+def iter_tasks(fq1_list, fq2_list, index_file=None):
+    """
+    Yield (start, chunk1, chunk2, index), start is the 1-based ordinal of the first read of the chunk.
+    index is None, or the rows of index_file within the chunk.
+    """
+    index = None
+    if index_file:
+        index = np.load(index_file, mmap_mode="r")
+        ordinals = index["ordinal"]
+    start = 1
+    for chunk1, chunk2 in fastq.iter_paired_chunks(fq1_list, fq2_list, CHUNK_SIZE):
+        rows = None
+        if index is not None:
+            lo, hi = np.searchsorted(ordinals, [start, start + len(chunk1)])
+            rows = np.array(index[lo:hi])
+        yield start, chunk1, chunk2, rows
+        start += len(chunk1)
+    if index is not None and len(index) and ordinals[-1] >= start:
+        raise ValueError(f"{index_file} has reads after the end of the fastq files. Use the same fastq files.")
+
+
+def log_progress(total_reads: int, n_read: int):
+    for n in range((total_reads - n_read) // 1_000_000 + 1, total_reads // 1_000_000 + 1):
+        sys.stderr.write(f"Processed {n * 1_000_000} reads...\n")
 
 
 class SplitRNA:
     def __init__(self, args):
         self.fq1 = args.fq1.split(",")
         self.fq2 = args.fq2.split(",")
-        self.p3_bcumi_runner = parse_chemistry.BcUmi(f"{args.chemistry}_3p")
+        self.threads = args.threads
+        self.write_index = args.write_index
+        self.index_file = args.index
+        self.p3_bcumi_runner = parse_chemistry.BcUmi(f"{args.chemistry}_3p", quality_correct=args.quality_correct)
         self.p5_bcumi_runner = parse_chemistry.BcUmi(f"{args.chemistry}_5p", strict=True)
         _pattern_dict, p3_bc_file = parse_chemistry.get_pattern_dict_and_bc(f"{args.chemistry}_3p")
         _pattern_dict, p5_bc_file = parse_chemistry.get_pattern_dict_and_bc(f"{args.chemistry}_5p")
-        self.p3_barcode_name = get_barcode_name(p3_bc_file[0], args.well_name)
-        self.p5_barcode_name = get_barcode_name(p5_bc_file[0], args.well_name)
+        self.p3_barcode_well = get_barcode_well(p3_bc_file[0])
+        self.p5_barcode_well = get_barcode_well(p5_bc_file[0])
+        self.well_name = utils.two_col_to_dict(args.well_name)
         self.auto_runner = parse_chemistry.AutoAccuraRNA(self.fq1)
         self.outdir = Path("./rna")
+        self.library_type = "rna"
+        if args.quality_correct and not self.index_file:
+            self.fit_quality_prior()
+
+    def fit_quality_prior(self):
+        """Fit the 3' barcode prior from the first PRIOR_READS reads before splitting, so it is the same in every
+        worker. 5' barcodes are strict and not corrected."""
+        chunk = next(fastq.iter_fastq_chunks(self.fq1[0], parse_chemistry.PRIOR_READS), None)
+        seqs = chunk.seqs if chunk else []
+        chemistrys = self.auto_runner.seq_chemistry_chunk(seqs)
+        self.p3_bcumi_runner.fit_quality_prior([seq for seq, x in zip(seqs, chemistrys) if x == P3])
+
+    def index_chunk(self, start: int, chunk1: fastq.FastqChunk) -> np.ndarray:
+        """Returns INDEX_DTYPE rows of the valid reads in the chunk"""
+        seqs = chunk1.seqs
+        chemistrys = self.auto_runner.seq_chemistry_chunk(seqs)
+        parts = [np.zeros(0, dtype=INDEX_DTYPE)]
+        for code, runner, barcode_well in (
+            (0, self.p3_bcumi_runner, self.p3_barcode_well),
+            (1, self.p5_bcumi_runner, self.p5_barcode_well),
+        ):
+            idx = np.array([i for i, x in enumerate(chemistrys) if x == RNA_CHEMISTRYS[code]], dtype=np.int64)
+            if not len(idx):
+                continue
+            valid, _corrected, bc_codes, umi = runner.get_bc_umi_batch(
+                [seqs[i] for i in idx], [chunk1.quals[i] for i in idx]
+            )
+            part = np.zeros(valid.sum(), dtype=INDEX_DTYPE)
+            part["ordinal"] = start + idx[valid]
+            part["well"] = [barcode_well[runner.decode_bc(x)] for x in bc_codes[valid]]
+            part["chemistry"] = code
+            part["umi"] = umi[valid]
+            parts.append(part)
+        index = np.concatenate(parts)
+        return index[np.argsort(index["ordinal"], kind="stable")]
+
+    def process_chunk(self, start: int, chunk1: fastq.FastqChunk, chunk2: fastq.FastqChunk, index=None) -> dict:
+        """
+        Args:
+            index: rows of the chunk from an index file, None to classify reads in chunk1
+        Returns:
+            {"n_read", "p3_reads", "p5_reads", "signal_reads", "name_read_count": {name: {"p3", "p5"}},
+            "blocks": {name: gzip bytes}, "index"}, names are in the order of their first read.
+            blocks is empty and index is returned if write_index.
+        """
+        if index is None:
+            index = self.index_chunk(start, chunk1)
+
+        res = {"n_read": len(chunk1), "p3_reads": 0, "p5_reads": 0, "signal_reads": 0}
+        name_read_count = defaultdict(lambda: defaultdict(int))
+        name_records = {}
+        for ordinal, well, code, umi in index.tolist():
+            chemistry = RNA_CHEMISTRYS[code]
+            name = get_well_name(well, self.well_name)
+            if chemistry == P3:
+                res["p3_reads"] += 1
+                name_read_count[name]["p3"] += 1
+                umi = umi.decode()
+            else:
+                res["p5_reads"] += 1
+                name_read_count[name]["p5"] += 1
+                umi = "A" * 12  # placeholder UMI for 5' reads
+
+            if not name.startswith("noise_"):
+                res["signal_reads"] += 1
+                if self.write_index:
+                    continue
+                i = ordinal - start
+                read_name = f"{chemistry}_{ordinal}:{umi}"
+                name_records.setdefault(name, []).append(utils.fastq_str(read_name, chunk2.seqs[i], chunk2.quals[i]))
+        res["name_read_count"] = {name: dict(count) for name, count in name_read_count.items()}
+        res["blocks"] = compress_blocks(name_records)
+        res["index"] = index if self.write_index else None
+        return res
 
     @utils.add_log
     def run(self):
-        out_handles = {}
+        # blocks are already gzip members
+        writer = utils.WriterPool(compress=None)
+        out_files = {}
         total_reads = 0
         p3_reads = 0
         p5_reads = 0
@@ -61,47 +224,34 @@ class SplitRNA:
         if not fastq_dir.exists():
             fastq_dir.mkdir(parents=True, exist_ok=True)
 
-        for fq1, fq2 in zip(self.fq1, self.fq2):
-            with pysam.FastxFile(fq1) as handle1, pysam.FastxFile(fq2) as handle2:
-                for read1, read2 in zip(handle1, handle2):
-                    total_reads += 1
-                    if total_reads % 1_000_000 == 0:
-                        sys.stderr.write(f"Processed {total_reads} reads...\n")
-                    chemistry = self.auto_runner.seq_chemistry(read1.sequence)
-                    if not chemistry:
-                        continue
-                    if chemistry == "AccuraSCOPE_RNA_3p":
-                        valid, _corrected, corrected_seq, umi = self.p3_bcumi_runner.get_bc_umi(read1.sequence)
-                    else:
-                        valid, _corrected, corrected_seq, _umi = self.p5_bcumi_runner.get_bc_umi(read1.sequence)
-                        umi = "A" * 12  # placeholder UMI for 5' reads
-                    if not valid:
-                        continue
-                    barcode = corrected_seq
-                    if chemistry == "AccuraSCOPE_RNA_3p":
-                        p3_reads += 1
-                        name = self.p3_barcode_name[barcode]
-                        name_read_count[name]["p3"] += 1
-                    else:
-                        p5_reads += 1
-                        name = self.p5_barcode_name[barcode]
-                        name_read_count[name]["p5"] += 1
-
-                    if not name.startswith("noise_"):
-                        signal_reads += 1
-                        if name not in out_handles:
-                            out_file = fastq_dir / f"{name}.fq.gz"
-                            namesheet_df_lines.append(
-                                {
-                                    "sample": name,
-                                    "fastq_1": str(out_file.absolute()),
-                                    "fastq_2": "",
-                                    "strandedness": "auto",
-                                }
-                            )
-                            out_handles[name] = utils.generic_open(out_file, "wt", compresslevel=1)
-                        read_name = f"{chemistry}_{total_reads}:{umi}"
-                        out_handles[name].write(utils.fastq_str(read_name, read2.sequence, read2.quality))
+        index_writer = (
+            NpyWriter(self.outdir / f"{self.library_type}_index.npy", INDEX_DTYPE) if self.write_index else None
+        )
+        tasks = iter_tasks(self.fq1, self.fq2, self.index_file)
+        for res in utils.map_chunks(self, tasks, self.threads):
+            if index_writer:
+                index_writer.write(res["index"])
+            total_reads += res["n_read"]
+            log_progress(total_reads, res["n_read"])
+            p3_reads += res["p3_reads"]
+            p5_reads += res["p5_reads"]
+            signal_reads += res["signal_reads"]
+            for name, count in res["name_read_count"].items():
+                for k, v in count.items():
+                    name_read_count[name][k] += v
+            for name, block in res["blocks"].items():
+                if name not in out_files:
+                    out_file = fastq_dir / f"{name}.fq.gz"
+                    namesheet_df_lines.append(
+                        {
+                            "sample": name,
+                            "fastq_1": str(out_file.absolute()),
+                            "fastq_2": "",
+                            "strandedness": "auto",
+                        }
+                    )
+                    out_files[name] = out_file
+                writer.write(out_files[name], block)
 
         # output metrics
         metrics_file = self.outdir / "rna_metrics.txt"
@@ -126,13 +276,15 @@ class SplitRNA:
         df.to_csv(name_count_file, index_label="name", sep="\t")
 
         # namesheet
-        namesheet_file = self.outdir / "rna_samplesheet.csv"
-        namesheet_df = pd.DataFrame(namesheet_df_lines)
-        namesheet_df.to_csv(namesheet_file, index=False)
+        if not self.write_index:
+            namesheet_file = self.outdir / "rna_samplesheet.csv"
+            namesheet_df = pd.DataFrame(namesheet_df_lines)
+            namesheet_df.to_csv(namesheet_file, index=False)
 
-        # close file handles
-        for handle in out_handles.values():
-            handle.close()
+        # flush and close file handles
+        writer.close()
+        if index_writer:
+            index_writer.close()
 
 
 class SplitDNA:
@@ -141,59 +293,105 @@ class SplitDNA:
         self.fq2 = args.fq2.split(",")
         self.bcumi_runner = parse_chemistry.BcUmi("AccuraSCOPE_DNA", strict=True)
         _pattern_dict, bc_file = parse_chemistry.get_pattern_dict_and_bc("AccuraSCOPE_DNA")
-        self.barcode_name = get_barcode_name(bc_file[0], args.well_name)
+        self.barcode_well = get_barcode_well(bc_file[0])
+        self.well_name = utils.two_col_to_dict(args.well_name)
         self.outdir = Path("./dna")
+        self.library_type = "dna"
+        self.threads = args.threads
+        self.write_index = args.write_index
+        self.index_file = args.index
+
+    def index_chunk(self, start: int, chunk1: fastq.FastqChunk) -> np.ndarray:
+        """Returns INDEX_DTYPE rows of the valid reads in the chunk"""
+        valid, _corrected, bc_codes, _umi = self.bcumi_runner.get_bc_umi_batch(chunk1.seqs)
+        index = np.zeros(valid.sum(), dtype=INDEX_DTYPE)
+        index["ordinal"] = start + valid.nonzero()[0]
+        index["well"] = [self.barcode_well[self.bcumi_runner.decode_bc(x)] for x in bc_codes[valid]]
+        return index
+
+    def process_chunk(self, start: int, chunk1: fastq.FastqChunk, chunk2: fastq.FastqChunk, index=None) -> dict:
+        """
+        Args:
+            index: rows of the chunk from an index file, None to classify reads in chunk1
+        Returns:
+            {"n_read", "valid_reads", "signal_reads", "name_read_count": {name: count},
+            "blocks": {name: (R1 gzip bytes, R2 gzip bytes)}, "index"}, names are in the order of their first read.
+            blocks is empty and index is returned if write_index.
+        """
+        BC_LEN = 8
+        if index is None:
+            index = self.index_chunk(start, chunk1)
+        res = {"n_read": len(chunk1), "valid_reads": 0, "signal_reads": 0}
+        name_read_count = defaultdict(int)
+        name_records_r1, name_records_r2 = {}, {}
+        for ordinal, well in zip(index["ordinal"].tolist(), index["well"].tolist()):
+            res["valid_reads"] += 1
+            name = get_well_name(well, self.well_name)
+            name_read_count[name] += 1
+
+            if not name.startswith("noise_"):
+                res["signal_reads"] += 1
+                if self.write_index:
+                    continue
+                i = ordinal - start
+                read_name = chunk1.names[i]
+                name_records_r1.setdefault(name, []).append(
+                    utils.fastq_str(read_name, chunk1.seqs[i][BC_LEN:], chunk1.quals[i][BC_LEN:])
+                )
+                name_records_r2.setdefault(name, []).append(
+                    utils.fastq_str(chunk2.names[i], chunk2.seqs[i], chunk2.quals[i])
+                )
+        res["name_read_count"] = dict(name_read_count)
+        blocks_r1, blocks_r2 = compress_blocks(name_records_r1), compress_blocks(name_records_r2)
+        res["blocks"] = {name: (blocks_r1[name], blocks_r2[name]) for name in blocks_r1}
+        res["index"] = index if self.write_index else None
+        return res
 
     @utils.add_log
     def run(self):
-        out_handles_r1 = {}
-        out_handles_r2 = {}
+        # blocks are already gzip members
+        writer = utils.WriterPool(compress=None)
+        out_files = {}
         total_reads = 0
         valid_reads = 0
         signal_reads = 0
         name_read_count = defaultdict(int)
         namesheet_df_lines = []
-        BC_LEN = 8
 
         # mkdir
         fastq_dir = self.outdir / "fastqs"
         if not fastq_dir.exists():
             fastq_dir.mkdir(parents=True, exist_ok=True)
-        for fq1, fq2 in zip(self.fq1, self.fq2):
-            with pysam.FastxFile(fq1) as handle1, pysam.FastxFile(fq2) as handle2:
-                for read1, read2 in zip(handle1, handle2):
-                    total_reads += 1
-                    if total_reads % 1_000_000 == 0:
-                        sys.stderr.write(f"Processed {total_reads} reads...\n")
-                    valid, _corrected, corrected_seq, _umi = self.bcumi_runner.get_bc_umi(read1.sequence)
-                    if not valid:
-                        continue
-                    valid_reads += 1
-                    barcode = corrected_seq
-                    name = self.barcode_name[barcode]
-                    name_read_count[name] += 1
-
-                    if not name.startswith("noise_"):
-                        signal_reads += 1
-                        if name not in out_handles_r1:
-                            r1_file = fastq_dir / f"{name}_R1.fq.gz"
-                            r2_file = fastq_dir / f"{name}_R2.fq.gz"
-                            namesheet_df_lines.append(
-                                {
-                                    "patient": "patient1",
-                                    "sample": name,
-                                    "lane": 1,
-                                    "fastq_1": str(r1_file.absolute()),
-                                    "fastq_2": str(r2_file.absolute()),
-                                }
-                            )
-                            out_handles_r1[name] = utils.generic_open(r1_file, "wt", compresslevel=1)
-                            out_handles_r2[name] = utils.generic_open(r2_file, "wt", compresslevel=1)
-
-                        out_handles_r1[name].write(
-                            utils.fastq_str(read1.name, read1.sequence[BC_LEN:], read1.quality[BC_LEN:])
-                        )
-                        out_handles_r2[name].write(utils.fastq_str(read2.name, read2.sequence, read2.quality))
+        index_writer = (
+            NpyWriter(self.outdir / f"{self.library_type}_index.npy", INDEX_DTYPE) if self.write_index else None
+        )
+        tasks = iter_tasks(self.fq1, self.fq2, self.index_file)
+        for res in utils.map_chunks(self, tasks, self.threads):
+            if index_writer:
+                index_writer.write(res["index"])
+            total_reads += res["n_read"]
+            log_progress(total_reads, res["n_read"])
+            valid_reads += res["valid_reads"]
+            signal_reads += res["signal_reads"]
+            for name, count in res["name_read_count"].items():
+                name_read_count[name] += count
+            for name, (block_r1, block_r2) in res["blocks"].items():
+                if name not in out_files:
+                    r1_file = fastq_dir / f"{name}_R1.fq.gz"
+                    r2_file = fastq_dir / f"{name}_R2.fq.gz"
+                    namesheet_df_lines.append(
+                        {
+                            "patient": "patient1",
+                            "sample": name,
+                            "lane": 1,
+                            "fastq_1": str(r1_file.absolute()),
+                            "fastq_2": str(r2_file.absolute()),
+                        }
+                    )
+                    out_files[name] = (r1_file, r2_file)
+                r1_file, r2_file = out_files[name]
+                writer.write(r1_file, block_r1)
+                writer.write(r2_file, block_r2)
 
         # output metrics
         metrics_file = self.outdir / "dna_metrics.txt"
@@ -215,15 +413,15 @@ class SplitDNA:
         df.to_csv(name_count_file, index_label="name", sep="\t")
 
         # namesheet
-        namesheet_file = self.outdir / "dna_samplesheet.csv"
-        namesheet_df = pd.DataFrame(namesheet_df_lines)
-        namesheet_df.to_csv(namesheet_file, index=False)
+        if not self.write_index:
+            namesheet_file = self.outdir / "dna_samplesheet.csv"
+            namesheet_df = pd.DataFrame(namesheet_df_lines)
+            namesheet_df.to_csv(namesheet_file, index=False)
 
-        # close file handles
-        for handle in out_handles_r1.values():
-            handle.close()
-        for handle in out_handles_r2.values():
-            handle.close()
+        # flush and close file handles
+        writer.close()
+        if index_writer:
+            index_writer.close()
 
 
 def main():
@@ -258,7 +456,32 @@ def main():
         default="AccuraSCOPE_RNA",
         choices=["AccuraSCOPE_RNA", "ARC_RNA"],
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of worker processes. Output is the same as threads=1",
+    )
+    parser.add_argument(
+        "--write_index",
+        action="store_true",
+        help="Only write metrics and a read index ({library_type}_index.npy) of valid reads, no fastq. "
+        "Use it with --index to split wells later",
+    )
+    parser.add_argument(
+        "--index",
+        help="Read index written by --write_index from the same fastq files. "
+        "Split wells with the index and --well_name without classifying reads again",
+    )
+    parser.add_argument(
+        "--quality_correct",
+        action="store_true",
+        help="rna only. Correct 3' barcodes with base qualities and a barcode prior from the first reads. "
+        "Ambiguous corrections become invalid",
+    )
     args = parser.parse_args()
+    if args.write_index and args.index:
+        parser.error("--write_index and --index can not be used together")
     if args.library_type == "rna":
         SplitRNA(args).run()
     elif args.library_type == "dna":
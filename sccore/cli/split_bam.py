@@ -2,6 +2,10 @@ import pysam
 import gzip
 import argparse
 import os
+import tempfile
+from collections import defaultdict
+
+from sccore import utils
 
 
 def load_barcodes(barcode_file):
@@ -15,10 +19,81 @@ def load_barcodes(barcode_file):
     return barcodes
 
 
+class BamRecordEncoder:
+    """
+    Encode reads into uncompressed BAM record bytes through a temporary uncompressed BAM file, so that BAM output can
+    be appended in BGZF blocks like other files of utils.WriterPool.
+    """
+
+    def __init__(self, header):
+        self.header = header
+        fd, self.tmp_path = tempfile.mkstemp(suffix=".bam")
+        os.close(fd)
+        # uncompressed BAM header, the start of every output file
+        self.header_bytes = self._encode([])
+
+    def _encode(self, reads) -> bytes:
+        with pysam.AlignmentFile(self.tmp_path, "wbu", header=self.header) as f:
+            for read in reads:
+                f.write(read)
+        with gzip.open(self.tmp_path, "rb") as f:
+            return f.read()
+
+    def encode(self, reads) -> bytes:
+        return self._encode(reads)[len(self.header_bytes) :]
+
+    def close(self):
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class BamWriter:
+    """
+    按 barcode 缓存 reads，缓存的 reads 超过 max_reads 时，把最大的缓存编码后写入 utils.WriterPool，
+    以 BGZF block 追加到对应的 BAM 文件，close 时写入 BGZF EOF。打开的文件数有上限，不产生临时分片文件。
+    """
+
+    def __init__(self, header, max_reads=500_000):
+        self.encoder = BamRecordEncoder(header)
+        self.pool = utils.WriterPool(compress="bgzf")
+        self.max_reads = max_reads
+        self.buffers = defaultdict(list)
+        self.n_read = 0
+        self.started = set()
+
+    def write(self, output_path, read):
+        self.buffers[output_path].append(read)
+        self.n_read += 1
+        if self.n_read >= self.max_reads:
+            for path in sorted(self.buffers, key=lambda x: len(self.buffers[x]), reverse=True):
+                self.flush(path)
+                if self.n_read < self.max_reads // 2:
+                    break
+
+    def flush(self, output_path):
+        reads = self.buffers.pop(output_path)
+        self.n_read -= len(reads)
+        if output_path not in self.started:
+            self.started.add(output_path)
+            self.pool.write(output_path, self.encoder.header_bytes)
+        self.pool.write(output_path, self.encoder.encode(reads))
+
+    def close(self):
+        try:
+            for path in list(self.buffers):
+                self.flush(path)
+            self.pool.close()
+        finally:
+            self.encoder.close()
+
+
 def split_bam_by_barcode(input_bam, barcode_file, output_dir, output_format):
     """
     按照 CB 标签拆分 BAM 文件，并支持 BAM 或 GZIP 压缩的 FASTQ 输出
     """
+    if output_format not in ("bam", "fastq"):
+        raise ValueError(f"output_format must be bam or fastq, got {output_format}")
+
     # 加载 barcodes
     valid_barcodes = load_barcodes(barcode_file)
     print(f"Loaded {len(valid_barcodes)} barcodes from {barcode_file}")
@@ -29,33 +104,28 @@ def split_bam_by_barcode(input_bam, barcode_file, output_dir, output_format):
     # 打开输入 BAM 文件
     bamfile = pysam.AlignmentFile(input_bam, "rb")
 
-    # 字典用于存储每个 barcode 对应的 BAM/FASTQ 输出文件
-    barcode_files = {}
+    # 缓存每个 barcode 的输出，只保持有限个文件打开
+    if output_format == "bam":
+        writer = BamWriter(bamfile.header)
+    elif output_format == "fastq":
+        writer = utils.WriterPool()
 
     try:
         # 遍历每条 BAM 记录
         for read in bamfile:
             # 获取 CB 标签
-            cb_tag = dict(read.get_tags()).get("CB")
+            cb_tag = read.get_tag("CB") if read.has_tag("CB") else None
             if cb_tag and cb_tag in valid_barcodes:
-                if cb_tag not in barcode_files:
-                    if output_format == "bam":
-                        output_path = os.path.join(output_dir, f"{cb_tag}.bam")
-                        barcode_files[cb_tag] = pysam.AlignmentFile(output_path, "wb", header=bamfile.header)
-                    elif output_format == "fastq":
-                        output_path = os.path.join(output_dir, f"{cb_tag}.fastq.gz")
-                        barcode_files[cb_tag] = gzip.open(output_path, "wt")  # 以文本模式写入 gzip 压缩文件
-
                 # 写入数据
                 if output_format == "bam":
-                    barcode_files[cb_tag].write(read)
+                    writer.write(os.path.join(output_dir, f"{cb_tag}.bam"), read)
                 elif output_format == "fastq":
-                    fastq_str = f"@{read.query_name}\n{read.query_sequence}\n+\n{''.join(chr(q + 33) for q in read.query_qualities)}\n"
-                    barcode_files[cb_tag].write(fastq_str)
+                    qual = pysam.qualities_to_qualitystring(read.query_qualities)
+                    fastq_str = utils.fastq_str(read.query_name, read.query_sequence, qual)
+                    writer.write(os.path.join(output_dir, f"{cb_tag}.fastq.gz"), fastq_str)
 
     finally:
-        for cb_file in barcode_files.values():
-            cb_file.close()
+        writer.close()
         bamfile.close()
 
 
@@ -2,41 +2,93 @@ import argparse
 import gzip
 from collections import defaultdict
 
-import pysam
-from sccore import parse_chemistry, utils
+from sccore import fastq, parse_chemistry, utils
+from sccore.barcode import HammingIndex
 
-CHEMISTRYS = ["GEXSCOPE-V2", "bulk_rna-bulk_vdj_match"]
 BULK_LINKER = "GTGGTATCAACGCAGAGT"
+BULK_CHEMISTRY = "bulk_rna-bulk_vdj_match"
+# default target chemistries. Reads starting with BULK_LINKER are BULK_CHEMISTRY;
+# other chemistries in CHEMISTRY_DICT are matched by barcodes, in the order given.
+CHEMISTRYS = ["GEXSCOPE-V2", BULK_CHEMISTRY]
+CHUNK_SIZE = 100_000
+
+
+def get_rules(chemistrys: list[str]) -> list[parse_chemistry.ChemistryRule]:
+    """
+    Compiled matchers of the target chemistrys. Only whitelists of these chemistrys are loaded.
+    The bulk linker is checked first. Chemistrys without barcode whitelists can not be matched and are rejected.
+    """
+    auto_runner = parse_chemistry.Auto([], parse_chemistry.CHEMISTRY_DICT)
+    rules = []
+    if BULK_CHEMISTRY in chemistrys:
+        linker_index = HammingIndex([BULK_LINKER], n_mismatch=2)
+        rules.append(parse_chemistry.ChemistryRule(BULK_CHEMISTRY, [(slice(0, len(BULK_LINKER)), linker_index, False)]))
+    for chemistry in dict.fromkeys(chemistrys):
+        if chemistry == BULK_CHEMISTRY:
+            continue
+        if chemistry not in parse_chemistry.CHEMISTRY_DICT:
+            raise ValueError(f"Unknown chemistry: {chemistry}")
+        if "bc" not in parse_chemistry.CHEMISTRY_DICT[chemistry]:
+            raise ValueError(f"Chemistry {chemistry} has no barcode whitelist and can not be split")
+        rules.append(auto_runner.bc_rule(chemistry))
+    return rules
+
+
+class ChemistrySplitter:
+    def __init__(self, chemistrys: list[str]):
+        self.chemistrys = chemistrys
+        self.classifier = parse_chemistry.ChemistryClassifier(get_rules(chemistrys))
+
+    def process_chunk(self, chunk1: fastq.FastqChunk, chunk2: fastq.FastqChunk) -> dict:
+        """
+        Returns:
+            {"n_read", "count": {chemistry: n}, "blocks": {chemistry: (R1 gzip bytes, R2 gzip bytes)}}
+        """
+        chemistrys = self.classifier.classify(chunk1.seqs).tolist()
+        records1, records2 = defaultdict(list), defaultdict(list)
+        for i, chemistry in enumerate(chemistrys):
+            if chemistry:
+                records1[chemistry].append(chunk1.fastq_str(i))
+                records2[chemistry].append(chunk2.fastq_str(i))
+        blocks = {}
+        for chemistry in records1:
+            blocks[chemistry] = tuple(
+                gzip.compress("".join(x[chemistry]).encode(), compresslevel=1) for x in (records1, records2)
+            )
+        return {
+            "n_read": len(chunk1),
+            "count": {chemistry: len(x) for chemistry, x in records1.items()},
+            "blocks": blocks,
+        }
 
 
 @utils.add_log
 def run(args):
     fq1_list = args.fq1.split(",")
     fq2_list = args.fq2.split(",")
-    auto_runner = parse_chemistry.AutoRNA(fq1_list)
-    L18_set = parse_chemistry.create_mismatch_seqs(BULK_LINKER, max_mismatch=2)
-    out_fq1 = {chemistry: gzip.open(f"{chemistry}_R1.fq.gz", mode="wt", compresslevel=1) for chemistry in CHEMISTRYS}
-    out_fq2 = {chemistry: gzip.open(f"{chemistry}_R2.fq.gz", mode="wt", compresslevel=1) for chemistry in CHEMISTRYS}
+    # the same chemistry twice would open its output files twice
+    chemistrys = list(dict.fromkeys(args.chemistry.split(",")))
+    splitter = ChemistrySplitter(chemistrys)
+    out_fq1 = {chemistry: open(f"{chemistry}_R1.fq.gz", "wb") for chemistry in chemistrys}
+    out_fq2 = {chemistry: open(f"{chemistry}_R2.fq.gz", "wb") for chemistry in chemistrys}
+    # an empty gzip member, so that files without reads are valid gzip files
+    for handle in list(out_fq1.values()) + list(out_fq2.values()):
+        handle.write(gzip.compress(b""))
 
     total = 0
     count_dict = defaultdict(int)
 
-    for fq1_file, fq2_file in zip(fq1_list, fq2_list):
-        with pysam.FastqFile(fq1_file) as f1, pysam.FastqFile(fq2_file) as f2:
-            for read1, read2 in zip(f1, f2):
-                total += 1
-                chemistry = None
-                if read1.sequence[:18] in L18_set:
-                    chemistry = "bulk_rna-bulk_vdj_match"
-                elif auto_runner.is_chemistry(read1.sequence, "GEXSCOPE-V2"):
-                    chemistry = "GEXSCOPE-V2"
-                if chemistry:
-                    count_dict[chemistry] += 1
-                    out_fq1[chemistry].write(str(read1) + "\n")
-                    out_fq2[chemistry].write(str(read2) + "\n")
+    tasks = fastq.iter_paired_chunks(fq1_list, fq2_list, CHUNK_SIZE)
+    for res in utils.map_chunks(splitter, tasks, args.threads):
+        total += res["n_read"]
+        for chemistry, n in res["count"].items():
+            count_dict[chemistry] += n
+        for chemistry, (block1, block2) in res["blocks"].items():
+            out_fq1[chemistry].write(block1)
+            out_fq2[chemistry].write(block2)
 
     print(f"total reads: {total}")
-    for chemistry in CHEMISTRYS:
+    for chemistry in chemistrys:
         print(f"{chemistry} reads: {count_dict[chemistry]}")
         out_fq1[chemistry].close()
         out_fq2[chemistry].close()
@@ -46,6 +98,12 @@ def main():
     parser = argparse.ArgumentParser(description="Split fastq file by chemistry")
     parser.add_argument("--fq1", required=True)
     parser.add_argument("--fq2", required=True)
+    parser.add_argument(
+        "--chemistry",
+        default=",".join(CHEMISTRYS),
+        help=f"Comma separated target chemistrys. {BULK_CHEMISTRY} or any chemistry in parse_chemistry.CHEMISTRY_DICT",
+    )
+    parser.add_argument("--threads", type=int, default=1, help="Number of worker processes")
     args = parser.parse_args()
     run(args)
 
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 
 import argparse
+import array
 import gzip
 import random
-from collections import defaultdict
 
+import numpy as np
 import pysam
 import pandas as pd
+from sccore import umi
 
 
 def openfile(file_name, mode="rt", **kwargs):
@@ -25,7 +27,14 @@ def read_one_col(fn):
 
 
 def get_records(bam_file, barcodes):
-    a = []
+    """
+    Returns:
+        cells, genes: names
+        cell_idx, gene_idx, umis: cell index, gene index and UMI code of each read
+    """
+    cell_ids, gene_ids = {}, {}
+    cell_idx, gene_idx = array.array("q"), array.array("q")
+    umis, umi_batch = [], []
     n_read = 0
     dup_align_read_names = set()
     with pysam.AlignmentFile(bam_file) as bam:
@@ -48,28 +57,47 @@ def get_records(bam_file, barcodes):
                     else:
                         dup_align_read_names.add(record.query_name)
                 # use int instead of str to avoid memory hog
-                a.append((cb, ub, gx))
-    return a
-
-
-def sub_matrix(reads):
+                cell_idx.append(cell_ids.setdefault(cb, len(cell_ids)))
+                gene_idx.append(gene_ids.setdefault(gx, len(gene_ids)))
+                umi_batch.append(ub)
+                if len(umi_batch) == 1000000:
+                    umis.append(umi.encode_umis(umi_batch))
+                    umi_batch = []
+    umis.append(umi.encode_umis(umi_batch))
+    return (
+        list(cell_ids),
+        list(gene_ids),
+        np.frombuffer(cell_idx, dtype=np.int64),
+        np.frombuffer(gene_idx, dtype=np.int64),
+        np.concatenate(umis),
+    )
+
+
+def sub_matrix(cells, genes, cell_idx, gene_idx, umis, order, method="unique"):
+    """
+    Args:
+        order: read index in the sampling order
+        method: UMI method, see `sccore.umi`
+    """
     subsamples = [1.0, 0.5, 0.1]
-    n_reads = len(reads)
-    expr_data = defaultdict(lambda: defaultdict(int))
+    n_reads = len(order)
+    groups = cell_idx * len(genes) + gene_idx
+    # genes in the order of first appearance
+    _, first = np.unique(gene_idx[order], return_index=True)
+    expr_data = {genes[i]: {} for i in np.argsort(first).tolist()}
 
     for frac in subsamples:
         # Step 1: 直接取前 frac 部分 reads
         cutoff = int(n_reads * frac)
-        sampled_reads = reads[:cutoff]
+        sampled_reads = order[:cutoff]
 
         # Step 2: UMI 去重
-        umi_sets = defaultdict(set)  # key: (barcode, gene), value: set of UMIs
-        for barcode, umi, gene in sampled_reads:
-            umi_sets[(barcode, gene)].add(umi)
+        group_ids, _n_reads, n_umis = umi.count_umis(groups[sampled_reads], umis[sampled_reads], method)
 
         # Step 3: 统计表达量
-        for (barcode, gene), umi_set in umi_sets.items():
-            expr_data[gene][f"{barcode}_sub{frac}"] = len(umi_set)
+        for group, n_umi in zip(group_ids.tolist(), n_umis.tolist()):
+            barcode, gene = cells[group // len(genes)], genes[group % len(genes)]
+            expr_data[gene][f"{barcode}_sub{frac}"] = n_umi
 
     # 转换成 DataFrame
     expr_matrix = pd.DataFrame.from_dict(expr_data, orient="index").fillna(0).astype(int)
@@ -79,11 +107,13 @@ def sub_matrix(reads):
 
 def main(args):
     barcodes = set(read_one_col(args.cell_barcode))
-    a = get_records(args.bam, barcodes)
+    cells, genes, cell_idx, gene_idx, umis = get_records(args.bam, barcodes)
+    # the same order as shuffling the reads
+    order = list(range(len(umis)))
     random.seed(0)
-    random.shuffle(a)
+    random.shuffle(order)
 
-    expr_matrix = sub_matrix(a)
+    expr_matrix = sub_matrix(cells, genes, cell_idx, gene_idx, umis, np.array(order, dtype=np.int64), args.umi_method)
     expr_matrix.to_csv(f"{args.sample}_sub_matrix.tsv", sep="\t")
 
 
@@ -92,5 +122,6 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--bam", help="bam file", required=True)
     parser.add_argument("-c", "--cell_barcode", help="barcode file", required=True)
     parser.add_argument("-s", "--sample", help="sample name", required=True)
+    parser.add_argument("--umi_method", default="unique", choices=umi.METHODS, help="UMI deduplication method")
     args = parser.parse_args()
     main(args)
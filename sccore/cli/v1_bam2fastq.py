@@ -3,21 +3,19 @@ Convert celescope V2.* BAM to fastq file
 """
 
 import pysam
-import gzip
 import os
 
+from sccore.fastq import FastqWriter
+
 LINKER1 = "ATCCACGTGCTTGAGA"
 LINKER2 = "TCAGCATGCGGCTACG"
 
 
-def fastq_str(name, seq, qual):
-    """return fastq read string"""
-    return f"@{name}\n{seq}\n+\n{qual}\n"
-
-
-def seg2fastq(segment: pysam.AlignedSegment, cb_len: int) -> tuple[str, str]:
+def seg2records(segment: pysam.AlignedSegment, cb_len: int) -> tuple[tuple[str, str, str], tuple[str, str, str]]:
     """
     C9L16C9L16C9L1U12
+    Returns:
+        (name, seq, qual) of R1 and R2
     """
     query_name = segment.query_name
     attr = query_name.split("_")
@@ -26,12 +24,10 @@ def seg2fastq(segment: pysam.AlignedSegment, cb_len: int) -> tuple[str, str]:
     cbs = [cb[i : i + cb_len] for i in range(0, len(cb), cb_len)]
     r1_seq = "".join([cbs[0], LINKER1, cbs[1], LINKER2, cbs[2], "C", umi, "T" * 18])
     r1_qual = "F" * len(r1_seq)
-    r1 = fastq_str(query_name, r1_seq, r1_qual)
 
     r2_seq = segment.get_forward_sequence()
-    r2_qual = "".join(map(lambda x: chr(x + 33), segment.get_forward_qualities()))
-    r2 = fastq_str(query_name, r2_seq, r2_qual)
-    return r1, r2
+    r2_qual = pysam.qualities_to_qualitystring(segment.get_forward_qualities())
+    return (query_name, r1_seq, r1_qual), (query_name, r2_seq, r2_qual)
 
 
 def get_cb_len(bam_file):
@@ -55,6 +51,7 @@ def main():
     parser.add_argument("-b", "--bam", required=True)
     parser.add_argument("-s", "--sample")
     parser.add_argument("-o", "--outdir", default="./")
+    parser.add_argument("-t", "--threads", type=int, default=2, help="compression threads of each fastq file")
     args = parser.parse_args()
 
     sample = args.sample if args.sample else os.path.basename(args.bam).split("_")[0]
@@ -64,12 +61,12 @@ def main():
     n = 0
     mod = 1000000
     with pysam.AlignmentFile(args.bam, "rb") as f:
-        with gzip.open(f1_fn, "wt") as f1, gzip.open(f2_fn, "wt") as f2:
+        with FastqWriter(f1_fn, threads=args.threads) as f1, FastqWriter(f2_fn, threads=args.threads) as f2:
             print("writing fastq...")
             for segment in f:
-                r1, r2 = seg2fastq(segment, cb_len)
-                f1.write(r1)
-                f2.write(r2)
+                r1, r2 = seg2records(segment, cb_len)
+                f1.write(*r1)
+                f2.write(*r2)
                 n += 1
                 if n % mod == 0:
                     print(f"{n//mod}M reads processed")
@@ -0,0 +1,440 @@
+"""
+FASTQ reading and writing utilities.
+"""
+
+import gzip
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pysam
+
+from sccore import utils
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_EXTRA = b"\x06\x00BC\x02\x00"
+GZIP_MAGIC = b"\x1f\x8b"
+SCAN_SIZE = 1 << 20
+BLOCK_SIZE = 1 << 22
+
+
+def is_gzip(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(path) -> bool:
+    """BGZF is a series of gzip members, each with a 'BC' extra field"""
+    with open(path, "rb") as f:
+        header = f.read(18)
+    return header[:4] == BGZF_MAGIC and header[10:16] == BGZF_EXTRA
+
+
+def find_bgzf_block(f, offset: int) -> int:
+    """Returns the compressed offset of the first BGZF block at or after offset, -1 if not found"""
+    f.seek(offset)
+    buf = f.read(SCAN_SIZE)
+    start = 0
+    while True:
+        pos = buf.find(BGZF_MAGIC, start)
+        if pos == -1 or pos + 16 > len(buf):
+            return -1
+        if buf[pos + 10 : pos + 16] == BGZF_EXTRA:
+            return offset + pos
+        start = pos + 1
+
+
+def resync(lines: list[str]) -> int:
+    """Index of the first line that starts a complete FASTQ record, -1 if not found.
+    A quality line may also start with '@', so the '+' line and equal seq/qual length are also checked.
+
+    >>> resync(["IIII", "+", "IIII", "@r1", "ACGT", "+", "IIII"])
+    3
+    >>> resync(["@III", "@r1", "ACGT", "+", "IIII"])
+    1
+    """
+    for i in range(len(lines) - 3):
+        if lines[i].startswith("@") and lines[i + 2].startswith("+") and len(lines[i + 1]) == len(lines[i + 3]):
+            return i
+    return -1
+
+
+def read_records(lines, n_read: int) -> list[tuple[str, str, str]]:
+    """Parse n_read (name, seq, qual) records from an iterator of lines that starts at a record
+
+    >>> read_records(["@r1 1:N", "ACGT", "+", "IIII", "@r2", "TT"], 10)
+    [('r1', 'ACGT', 'IIII')]
+    """
+    records = []
+    lines = iter(lines)
+    while len(records) < n_read:
+        record = list(itertools.islice(lines, 4))
+        if len(record) < 4:
+            break
+        name, seq, _plus, qual = (x.rstrip("\r\n") for x in record)
+        records.append((name[1:].split(None, 1)[0], seq, qual))
+    return records
+
+
+def read_region(stream, n_read: int, skip_partial: bool = True) -> list[tuple[str, str, str]]:
+    """Read n_read records from a binary stream positioned at any byte offset"""
+    if skip_partial:
+        stream.readline()
+    head = [stream.readline().decode("latin-1").rstrip("\r\n") for _ in range(8)]
+    start = resync(head)
+    if start == -1:
+        return []
+    lines = itertools.chain(head[start:], (x.decode("latin-1") for x in stream))
+    return read_records(lines, n_read)
+
+
+def sample_region_offsets(size: int, n_region: int) -> list[int]:
+    """Evenly spaced byte offsets, the first one is 0.
+
+    >>> sample_region_offsets(100, 4)
+    [0, 25, 50, 75]
+    """
+    return [size * i // n_region for i in range(n_region)]
+
+
+def sample_reads(path, n_read: int = 10000, n_region: int = 10) -> list[tuple[str, str, str]]:
+    """
+    Sample reads from n_region evenly spaced byte offsets of a FASTQ file instead of only the head.
+    Plain files are seeked directly; BGZF files are seeked to the next BGZF block after each offset.
+    Ordinary single-member gzip files can not be seeked, so only the first n_read reads are returned.
+    Records of different regions are interleaved, so that any prefix of the result is spread over the file.
+
+    Returns:
+        list of (name, seq, qual)
+    """
+    if is_gzip(path) and not is_bgzf(path):
+        sys.stderr.write(f"{path} is not BGZF compressed, can not sample randomly. Use the first {n_read} reads.\n")
+        return list(itertools.islice(read_fastq(path), n_read))
+    bgzf = is_gzip(path)
+    per_region = -(-n_read // n_region)
+    regions = []
+    with open(path, "rb") as f:
+        for offset in sample_region_offsets(os.path.getsize(path), n_region):
+            if bgzf:
+                block = find_bgzf_block(f, offset)
+                if block == -1:
+                    continue
+                f.seek(block)
+                stream = gzip.GzipFile(fileobj=f)
+            else:
+                f.seek(offset)
+                stream = f
+            try:
+                regions.append(read_region(stream, per_region, skip_partial=offset > 0))
+            except (OSError, EOFError, zlib.error):
+                continue
+    res = []
+    for i in range(per_region):
+        for records in regions:
+            if i < len(records):
+                res.append(records[i])
+    return res[:n_read]
+
+
+def read_fastq(path, max_read: int | None = None, sampling: str = "head"):
+    """
+    Yield (name, seq, qual) of a FASTQ file.
+    Args:
+        sampling: "head" reads the first max_read reads; "random" uses `sample_reads`
+    """
+    if sampling == "random":
+        yield from sample_reads(path, max_read or 10000)
+        return
+    if sampling != "head":
+        raise ValueError(f"Unknown sampling: {sampling}")
+    with pysam.FastxFile(path) as fq:
+        for n, read in enumerate(fq, start=1):
+            yield read.name, read.sequence, read.quality
+            if n == max_read:
+                break
+
+
+class PipeReader:
+    """Binary reader of a subprocess stdout, e.g. pigz -dc"""
+
+    def __init__(self, cmd: list[str]):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    def read(self, size=-1) -> bytes:
+        return self.proc.stdout.read(size)
+
+    def readline(self) -> bytes:
+        return self.proc.stdout.readline()
+
+    def close(self):
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        # -13: SIGPIPE if the reader stops early
+        if returncode not in (0, -13):
+            raise OSError(f"{' '.join(self.cmd)} exited with {returncode}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_fastq(path, threads: int = 2):
+    """
+    Open a plain or gzip FASTQ in binary mode.
+    gzip is decompressed with python-isal threads if installed, otherwise pigz if available, otherwise gzip.
+    """
+    if not is_gzip(path):
+        return open(path, "rb")
+    if threads > 1 and igzip_threaded is not None:
+        return igzip_threaded.open(path, "rb", threads=threads)
+    if threads > 1 and shutil.which("pigz"):
+        return PipeReader(["pigz", "-dc", "-p", str(threads), str(path)])
+    return gzip.open(path, "rb")
+
+
+class FastqChunk:
+    """A batch of FASTQ records as lists of str. comments are the header after the name, "" if none"""
+
+    __slots__ = ("names", "seqs", "quals", "comments")
+
+    def __init__(self, names: list[str], seqs: list[str], quals: list[str], comments: list[str] | None = None):
+        self.names = names
+        self.seqs = seqs
+        self.quals = quals
+        self.comments = comments if comments is not None else [""] * len(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        """Yield (name, seq, qual)"""
+        return zip(self.names, self.seqs, self.quals)
+
+    def records(self) -> list[tuple[str, str, str]]:
+        return list(self)
+
+    def fastq_str(self, i: int) -> str:
+        """Record i with the full header, same as str() of a pysam FastqProxy plus a newline"""
+        comment = self.comments[i]
+        header = f"{self.names[i]} {comment}" if comment else self.names[i]
+        return f"@{header}\n{self.seqs[i]}\n+\n{self.quals[i]}\n"
+
+    def to_arrays(self) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+        """Returns {"names"|"seqs"|"quals": (uint8 buffer, int64 offsets)}, see `to_ragged`"""
+        return {k: to_ragged(getattr(self, k)) for k in ("names", "seqs", "quals")}
+
+
+def to_ragged(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Concatenate strings into one uint8 buffer. String i is buffer[offsets[i]:offsets[i+1]].
+
+    >>> buf, offsets = to_ragged(["ACG", "T"])
+    >>> buf.tobytes(), offsets.tolist()
+    (b'ACGT', [0, 3, 4])
+    >>> from_ragged(buf, offsets)
+    ['ACG', 'T']
+    """
+    buf = np.frombuffer("".join(strings).encode("latin-1"), dtype=np.uint8)
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in strings], out=offsets[1:])
+    return buf, offsets
+
+
+def from_ragged(buf: np.ndarray, offsets: np.ndarray) -> list[str]:
+    text = buf.tobytes().decode("latin-1")
+    return [text[i:j] for i, j in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def lines_to_chunk(lines: list[str], path="") -> FastqChunk:
+    headers, pluses = lines[0::4], lines[2::4]
+    if not all(x.startswith("@") for x in headers) or not all(x.startswith("+") for x in pluses):
+        raise ValueError(f"{path} is not a valid FASTQ file")
+    fields = [x[1:].split(None, 1) or [""] for x in headers]
+    names = [x[0] for x in fields]
+    comments = [x[1] if len(x) == 2 else "" for x in fields]
+    return FastqChunk(names, lines[1::4], lines[3::4], comments)
+
+
+def iter_fastq_chunks(path, chunk_size: int = 100_000, threads: int = 2):
+    """
+    Stream a FASTQ file in FastqChunk of chunk_size records. Large blocks are decoded and split at once,
+    which is much faster than creating one Python object per record.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("w", suffix=".fq", delete=False) as f:
+    ...     _ = f.write("@r1 1:N\\nACGT\\n+\\nIIII\\n@r2\\nTT\\n+\\nII\\n@r3\\nG\\n+\\nI\\n")
+    >>> chunks = list(iter_fastq_chunks(f.name, chunk_size=2))
+    >>> [chunk.records() for chunk in chunks]
+    [[('r1', 'ACGT', 'IIII'), ('r2', 'TT', 'II')], [('r3', 'G', 'I')]]
+    >>> chunks[0].fastq_str(0)
+    '@r1 1:N\\nACGT\\n+\\nIIII\\n'
+
+    Blank lines at the end of the file are ignored; empty reads are kept.
+    >>> with open(f.name, "w") as fh:
+    ...     _ = fh.write("@r1\\nACGT\\n+\\nIIII\\n@r2\\n\\n+\\n\\n\\n")
+    >>> [chunk.records() for chunk in iter_fastq_chunks(f.name, chunk_size=1)]
+    [[('r1', 'ACGT', 'IIII')], [('r2', '', '')]]
+    >>> os.remove(f.name)
+    """
+    n_line = chunk_size * 4
+    pending = []
+    rest = ""
+    with open_fastq(path, threads) as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            text = rest + block.decode("latin-1")
+            if "\r" in text:
+                text = text.replace("\r", "")
+            lines = text.split("\n")
+            rest = lines.pop()
+            pending.extend(lines)
+            # hold back 3 lines, which may be blank lines at the end of the file
+            while len(pending) >= n_line + 3:
+                yield lines_to_chunk(pending[:n_line], path)
+                pending = pending[n_line:]
+    if rest:
+        pending.append(rest)
+    # blank lines at the end, except the seq and quality lines of an empty last read
+    n_content = len(pending)
+    while n_content and not pending[n_content - 1]:
+        n_content -= 1
+    n_record_line = -(-n_content // 4) * 4
+    if n_record_line > len(pending):
+        raise ValueError(f"{path} is truncated: {n_content % 4} extra lines at the end")
+    pending = pending[:n_record_line]
+    while len(pending) > n_line:
+        yield lines_to_chunk(pending[:n_line], path)
+        pending = pending[n_line:]
+    if pending:
+        yield lines_to_chunk(pending, path)
+
+
+def strip_mate(name: str) -> str:
+    """
+    >>> strip_mate("r1/1"), strip_mate("r1/2"), strip_mate("r1")
+    ('r1', 'r1', 'r1')
+    """
+    if name.endswith(("/1", "/2")):
+        return name[:-2]
+    return name
+
+
+def check_names(names1: list[str], names2: list[str], fq1="", fq2=""):
+    if names1 == names2:
+        return
+    for name1, name2 in zip(names1, names2):
+        if strip_mate(name1) != strip_mate(name2):
+            raise ValueError(f"R1 and R2 read names are not in sync: {name1} in {fq1}, {name2} in {fq2}")
+
+
+def iter_paired_chunks(fq1_list, fq2_list, chunk_size: int = 100_000, threads: int = 2, check: bool = True):
+    """
+    Stream paired-end FASTQ files in (R1 FastqChunk, R2 FastqChunk) of the same size.
+    Args:
+        fq1_list, fq2_list: list of R1 and R2 files
+        threads: gzip decompression threads of each file
+        check: check that R1 and R2 read names are in sync
+    """
+    if len(fq1_list) != len(fq2_list):
+        raise ValueError("fq1 and fq2 must have the same number of files")
+    for fq1, fq2 in zip(fq1_list, fq2_list):
+        iter1 = iter_fastq_chunks(fq1, chunk_size, threads)
+        iter2 = iter_fastq_chunks(fq2, chunk_size, threads)
+        for chunk1, chunk2 in itertools.zip_longest(iter1, iter2):
+            if chunk1 is None or chunk2 is None or len(chunk1) != len(chunk2):
+                raise ValueError(f"{fq1} and {fq2} have different number of reads")
+            if check:
+                check_names(chunk1.names, chunk2.names, fq1, fq2)
+            yield chunk1, chunk2
+
+
+class FastqWriter:
+    """
+    Write FASTQ records to a plain, gzip or BGZF file.
+    Records are formatted into a buffer and written in blocks of block_size bytes, each compressed block is a
+    gzip member or a series of BGZF blocks.
+
+    Args:
+        compress: "auto" (gzip if the path ends with .gz), "gzip", "bgzf" or None
+        threads: number of background compression threads. zlib releases the GIL, so compression overlaps with
+            formatting and parsing. 0 compresses in the calling thread.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp(suffix=".fq.gz")
+    >>> with FastqWriter(path, block_size=10, threads=2) as writer:
+    ...     writer.write("r1", "ACGT", "IIII")
+    ...     writer.write_records([("r2", "TT", "II"), ("r3", "G", "I")])
+    >>> [chunk.records() for chunk in iter_fastq_chunks(path)]
+    [[('r1', 'ACGT', 'IIII'), ('r2', 'TT', 'II'), ('r3', 'G', 'I')]]
+    >>> os.remove(path)
+    """
+
+    def __init__(self, path, compress="auto", compresslevel=1, block_size=1 << 22, threads=0):
+        if compress == "auto":
+            compress = "gzip" if str(path).endswith(".gz") else None
+        self.path = path
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.threads = threads
+        self.handle = open(path, "wb")
+        self.parts = []
+        self.size = 0
+        self.executor = ThreadPoolExecutor(threads) if threads > 0 and compress else None
+        self.pending = deque()
+
+    def write(self, name, seq, qual):
+        record = f"@{name}\n{seq}\n+\n{qual}\n"
+        self.parts.append(record)
+        self.size += len(record)
+        if self.size >= self.block_size:
+            self.flush()
+
+    def write_records(self, records):
+        """records: iterable of (name, seq, qual)"""
+        for name, seq, qual in records:
+            self.write(name, seq, qual)
+
+    def flush(self):
+        if not self.parts:
+            return
+        data = "".join(self.parts).encode("latin-1")
+        self.parts = []
+        self.size = 0
+        if self.executor is None:
+            self.handle.write(utils.compress_bytes(data, self.compress, self.compresslevel))
+            return
+        self.pending.append(self.executor.submit(utils.compress_bytes, data, self.compress, self.compresslevel))
+        while len(self.pending) > self.threads * 2:
+            self.handle.write(self.pending.popleft().result())
+
+    def close(self):
+        self.flush()
+        while self.pending:
+            self.handle.write(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.compress == "bgzf":
+            self.handle.write(utils.BGZF_EOF)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,21 +1,232 @@
+import contextlib
 import gzip
 import os
-from collections import defaultdict
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import scipy.io
 import scipy.sparse
 import pandas as pd
-from sccore import utils
+from sccore import fastq, utils
 
 
 BARCODE_FILE_NAME = "barcodes.tsv.gz"
 FEATURE_FILE_NAME = "features.tsv.gz"
 MATRIX_FILE_NAME = "matrix.mtx.gz"
+# bump when the layout of the cache file changes
+CACHE_VERSION = 1
 
 
 ROW = "geneID"
 COLUMN = "Barcode"
 
+# entries per chunk when reading and writing matrix.mtx
+MTX_CHUNK_SIZE = 1 << 20
+# scipy >= 1.12 reads Matrix Market with a multi-threaded C++ parser, older versions parse in pure Python
+FAST_MMREAD = hasattr(scipy.io, "_fast_matrix_market")
+
+
+def format_int_columns(columns: list) -> bytes:
+    """
+    Format int arrays of the same length as text lines of space separated columns.
+    Digits are computed with vectorized arithmetic instead of one str per number.
+
+    >>> format_int_columns([np.array([1, 20, 300]), np.array([-3, 0, 45])])
+    b'1 -3\\n20 0\\n300 45\\n'
+    """
+    n = len(columns[0])
+    blocks, masks = [], []
+    for k, col in enumerate(columns):
+        col = np.asarray(col, dtype=np.int64)
+        negative = col < 0
+        val = np.abs(col)
+        width = len(str(int(val.max()))) if n else 1
+        digits = np.empty((n, width), dtype=np.uint8)
+        n_digit = np.ones(n, dtype=np.int64)
+        for j in range(width - 1, -1, -1):
+            digits[:, j] = val % 10 + 48
+            val //= 10
+            if j:
+                n_digit += val > 0
+        if negative.any():
+            blocks.append(np.full((n, 1), ord("-"), dtype=np.uint8))
+            masks.append(negative[:, np.newaxis])
+        blocks.append(digits)
+        masks.append(np.arange(width) >= (width - n_digit)[:, np.newaxis])
+        blocks.append(np.full((n, 1), ord("\n" if k == len(columns) - 1 else " "), dtype=np.uint8))
+        masks.append(np.ones((n, 1), dtype=bool))
+    return np.hstack(blocks)[np.hstack(masks)].tobytes()
+
+
+def _coordinates(matrix):
+    """(row, col, data) of stored entries in storage order, the order scipy.io.mmwrite writes them"""
+    if scipy.sparse.isspmatrix_csc(matrix) or scipy.sparse.isspmatrix_csr(matrix):
+        major = np.repeat(np.arange(len(matrix.indptr) - 1), np.diff(matrix.indptr))
+        if scipy.sparse.isspmatrix_csc(matrix):
+            return matrix.indices, major, matrix.data
+        return major, matrix.indices, matrix.data
+    matrix = matrix.tocoo()
+    return matrix.row, matrix.col, matrix.data
+
+
+def write_mtx(path, matrix, compress="auto", compresslevel=6, threads=4):
+    """
+    Write a sparse matrix as a Matrix Market coordinate file. Integer matrices are formatted in chunks by
+    `format_int_columns`, with the same bytes as scipy.io.mmwrite of the same matrix (entries in its storage
+    order), and chunks are compressed in threads as
+    concatenated gzip members (or BGZF blocks), which gzip, zlib and Seurat Read10X read as one stream.
+    Other dtypes, empty matrices and square matrices (which may be written as symmetric) are written by
+    scipy.io.mmwrite.
+
+    Args:
+        compress: "auto" (gzip if the path ends with .gz), "gzip", "bgzf" or None
+
+    >>> import io, tempfile
+    >>> m = scipy.sparse.csc_matrix(np.array([[0, 3], [0, 2], [1, 0]]))
+    >>> path = tempfile.mktemp(suffix=".mtx.gz")
+    >>> write_mtx(path, m)
+    >>> buf = io.BytesIO()
+    >>> scipy.io.mmwrite(buf, m)
+    >>> gzip.open(path).read() == buf.getvalue()
+    True
+    >>> os.remove(path)
+    """
+    if compress == "auto":
+        compress = "gzip" if str(path).endswith(".gz") else None
+    if matrix.dtype.kind != "i" or matrix.shape[0] == matrix.shape[1] or matrix.nnz == 0:
+        with gzip.open(path, "wb") if compress else open(path, "wb") as f:
+            scipy.io.mmwrite(f, matrix)
+        return
+
+    row, col, data = _coordinates(matrix)
+    n_row, n_col = matrix.shape
+    header = f"%%MatrixMarket matrix coordinate integer general\n%\n{n_row} {n_col} {len(data)}\n".encode()
+
+    def format_chunk(start):
+        stop = start + MTX_CHUNK_SIZE
+        lines = format_int_columns([row[start:stop] + 1, col[start:stop] + 1, data[start:stop]])
+        return utils.compress_bytes(lines, compress, compresslevel)
+
+    with open(path, "wb") as f, ThreadPoolExecutor(max(1, threads)) as executor:
+        f.write(utils.compress_bytes(header, compress, compresslevel))
+        pending = deque()
+        for start in range(0, len(data), MTX_CHUNK_SIZE):
+            pending.append(executor.submit(format_chunk, start))
+            while len(pending) > threads * 2:
+                f.write(pending.popleft().result())
+        while pending:
+            f.write(pending.popleft().result())
+        if compress == "bgzf":
+            f.write(utils.BGZF_EOF)
+
+
+def read_mtx(path, threads=2):
+    """
+    Read a Matrix Market coordinate file into a scipy.sparse.coo_matrix, the same as scipy.io.mmread.
+    gzip is decompressed in other threads if python-isal or pigz is available (see `fastq.open_fastq`).
+    With FAST_MMREAD the stream is parsed by scipy. Otherwise "coordinate integer/real general" lines are parsed in
+    chunks by the pandas C parser, and other files are read by scipy.io.mmread.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp(suffix=".mtx")
+    >>> with open(path, "w") as f:
+    ...     _ = f.write("%%MatrixMarket matrix coordinate integer general\\n%comment\\n3 2 2\\n1 2 3\\n3 1 1\\n")
+    >>> read_mtx(path).toarray().tolist()
+    [[0, 3], [0, 0], [1, 0]]
+    >>> os.remove(path)
+    """
+    if FAST_MMREAD:
+        with fastq.open_fastq(path, threads) as f:
+            return scipy.io.mmread(f)
+    with fastq.open_fastq(path, threads) as f:
+        header = f.readline().decode().lower().split()
+        if header[:3] != ["%%matrixmarket", "matrix", "coordinate"] or header[3:] not in (
+            ["integer", "general"],
+            ["real", "general"],
+        ):
+            return scipy.sparse.coo_matrix(scipy.io.mmread(path))
+        line = f.readline()
+        while line.startswith(b"%") or not line.strip():
+            line = f.readline()
+        n_row, n_col, nnz = (int(x) for x in line.split())
+        index_dtype = np.int32 if max(n_row, n_col, nnz) < 2**31 else np.int64
+        dtype = np.int64 if header[3] == "integer" else np.float64
+        row = np.empty(nnz, dtype=index_dtype)
+        col = np.empty(nnz, dtype=index_dtype)
+        data = np.empty(nnz, dtype=dtype)
+        n = 0
+        reader = pd.read_csv(
+            f,
+            sep=" ",
+            header=None,
+            names=["row", "col", "data"],
+            dtype={"row": np.int64, "col": np.int64, "data": dtype},
+            comment="%",
+            chunksize=MTX_CHUNK_SIZE,
+        )
+        for chunk in reader:
+            if n + len(chunk) > nnz:
+                raise ValueError(f"{path} has more than {nnz} entries")
+            row[n : n + len(chunk)] = chunk["row"].to_numpy() - 1
+            col[n : n + len(chunk)] = chunk["col"].to_numpy() - 1
+            data[n : n + len(chunk)] = chunk["data"].to_numpy()
+            n += len(chunk)
+        if n != nnz:
+            raise ValueError(f"{path} has {n} entries, expected {nnz}")
+    return scipy.sparse.coo_matrix((data, (row, col)), shape=(n_row, n_col))
+
+
+class LabelIndex:
+    """
+    Hash index of a list of labels (barcodes, gene ids or names) to their positions. Labels may be duplicated.
+
+    >>> index = LabelIndex(["A", "B", "A", "C"])
+    >>> index.get_first(["C", "A"]).tolist()
+    [3, 0]
+    >>> index.get_all(["A", "C"]).tolist()
+    [0, 2, 3]
+    >>> index.get_first(["D"])
+    Traceback (most recent call last):
+    ...
+    ValueError: 1 labels not found: ['D']
+    """
+
+    __slots__ = ("index", "first_index", "first_pos")
+
+    def __init__(self, labels: list):
+        self.index = pd.Index(labels)
+        if self.index.is_unique:
+            self.first_index = self.index
+            self.first_pos = None
+        else:
+            is_first = ~self.index.duplicated(keep="first")
+            self.first_index = self.index[is_first]
+            self.first_pos = np.flatnonzero(is_first)
+
+    @staticmethod
+    def _check_missing(labels, missing: np.ndarray):
+        if len(missing):
+            missing_labels = [labels[i] for i in missing[:10].tolist()]
+            raise ValueError(f"{len(missing)} labels not found: {missing_labels}")
+
+    def get_first(self, labels: list) -> np.ndarray:
+        """Position of the first occurrence of each label, in the order of labels"""
+        labels = list(labels)
+        pos = self.first_index.get_indexer(labels)
+        self._check_missing(labels, np.flatnonzero(pos == -1))
+        return pos if self.first_pos is None else self.first_pos[pos]
+
+    def get_all(self, labels: list) -> np.ndarray:
+        """Sorted positions of all occurrences of labels"""
+        labels = list(labels)
+        if self.first_pos is None:
+            return np.unique(self.get_first(labels))
+        pos, missing = self.index.get_indexer_non_unique(labels)
+        self._check_missing(labels, missing)
+        return np.unique(pos)
+
 
 class Features:
     def __init__(self, gene_id: list, gene_name=None, gene_type=None):
@@ -31,6 +242,34 @@ class Features:
         else:
             self.gene_name = list(gene_name)
         self.gene_type = gene_type
+        # LabelIndex of gene_id and gene_name, built on first lookup
+        self.__indexes = {}
+
+    def __get_index(self, attr) -> LabelIndex:
+        if attr not in self.__indexes:
+            self.__indexes[attr] = LabelIndex(getattr(self, attr))
+        return self.__indexes[attr]
+
+    def get_gene_id_rows(self, gene_ids: list) -> np.ndarray:
+        """Row of each gene id. Raise ValueError if any gene id is not found."""
+        return self.__get_index("gene_id").get_first(gene_ids)
+
+    def get_gene_name_rows(self, gene_names: list, all_rows=False) -> np.ndarray:
+        """
+        Row of each gene name. Gene names can be duplicated; the first row of each name is returned,
+        or sorted rows of all of them if all_rows.
+
+        >>> features = Features(["g1", "g2", "g3"], ["A", "B", "A"])
+        >>> features.get_gene_name_rows(["B", "A"]).tolist(), features.get_gene_name_rows(["A"], all_rows=True).tolist()
+        ([1, 0], [0, 2])
+        """
+        index = self.__get_index("gene_name")
+        return index.get_all(gene_names) if all_rows else index.get_first(gene_names)
+
+    def slice(self, rows: list):
+        """Features of rows"""
+        gene_type = [self.gene_type[i] for i in rows] if self.gene_type else None
+        return Features([self.gene_id[i] for i in rows], [self.gene_name[i] for i in rows], gene_type)
 
     @classmethod
     def from_tsv(cls, tsv_file):
@@ -72,6 +311,28 @@ class Features:
         df.to_csv(tsv_file, sep="\t", index=False, header=False)
 
 
+def get_file_stats(paths: list) -> np.ndarray:
+    """(mtime_ns, size) of each file"""
+    stats = [os.stat(x) for x in paths]
+    return np.array([(x.st_mtime_ns, x.st_size) for x in stats], dtype=np.int64)
+
+
+def to_csc(matrix) -> scipy.sparse.csc_matrix:
+    """
+    csc_matrix in canonical format. The input matrix is not modified.
+
+    >>> mtx = scipy.sparse.coo_matrix(([1, 2, 3], ([1, 0, 1], [0, 1, 0])), shape=(2, 2))
+    >>> csc = to_csc(mtx)
+    >>> csc.format, csc.toarray().tolist(), csc.nnz
+    ('csc', [[0, 2], [4, 0]], 2)
+    """
+    csc = matrix.tocsc()
+    if not csc.has_canonical_format:
+        csc = csc.copy() if csc is matrix else csc
+        csc.sum_duplicates()
+    return csc
+
+
 def get_matrix_file_path(matrix_dir, file_name):
     """
     compatible with non-gzip file
@@ -89,11 +350,15 @@ class CountMatrix:
         Args:
             features: Features object
             barcodes: list of barcodes
-            matrix: scipy.sparse.coo_matrix
+            matrix: scipy sparse matrix of genes x barcodes. It is stored as csc_matrix with sorted indices and
+                without duplicates; the csr_matrix is created on first use of get_csr().
         """
         self.__features = features
         self.__barcodes = barcodes
-        self.__matrix = matrix
+        self.__matrix = to_csc(matrix)
+        self.__csr = None
+        # LabelIndex of barcodes, built on first lookup
+        self.__barcode_index = None
         self.shape = matrix.shape
 
     @staticmethod
@@ -108,26 +373,118 @@ class CountMatrix:
 
     @classmethod
     @utils.add_log
-    def from_matrix_dir(cls, matrix_dir):
+    def from_matrix_dir(cls, matrix_dir, threads=2, cache=False, cache_dir=None):
+        """
+        Args:
+            cache: use a binary npz cache of the matrix if it was written from text files with the same mtime and
+                size. Otherwise parse the text files and write the cache; failures to write it are ignored.
+                Nothing is written to matrix_dir.
+            cache_dir: dir of cache files. Default: matrix under `utils.get_cache_dir()`
+
+        >>> tmp_dir = tempfile.mkdtemp()
+        >>> features = Features(["g1", "g2"], ["G1", "G2"], ["Gene Expression"] * 2)
+        >>> mtx = scipy.sparse.coo_matrix(np.array([[0, 3, 1], [2, 0, 0]]))
+        >>> CountMatrix(features, ["bc1", "bc2", "bc3"], mtx).to_matrix_dir(f"{tmp_dir}/m")
+        >>> m1 = CountMatrix.from_matrix_dir(f"{tmp_dir}/m", cache=True, cache_dir=f"{tmp_dir}/cache")
+        >>> len(os.listdir(f"{tmp_dir}/cache")), sorted(os.listdir(f"{tmp_dir}/m"))
+        (1, ['barcodes.tsv.gz', 'features.tsv.gz', 'matrix.mtx.gz'])
+        >>> m2 = CountMatrix.from_matrix_dir(f"{tmp_dir}/m", cache=True, cache_dir=f"{tmp_dir}/cache")
+        >>> m2.get_matrix().toarray().tolist(), m2.get_barcodes(), m2.get_features().gene_type
+        ([[0, 3, 1], [2, 0, 0]], ['bc1', 'bc2', 'bc3'], ['Gene Expression', 'Gene Expression'])
+        """
         if not os.path.exists(matrix_dir):
             raise FileNotFoundError(f"{matrix_dir} does not exist")
         features_tsv = get_matrix_file_path(matrix_dir, FEATURE_FILE_NAME)
-        features = Features.from_tsv(tsv_file=features_tsv)
         barcode_file = get_matrix_file_path(matrix_dir, BARCODE_FILE_NAME)
-        barcodes = utils.read_one_col(barcode_file)
         matrix_path = get_matrix_file_path(matrix_dir, MATRIX_FILE_NAME)
-        matrix = scipy.io.mmread(matrix_path)
+        stats = None
+        if cache and features_tsv and barcode_file and matrix_path:
+            if cache_dir is None:
+                cache_dir = os.path.join(utils.get_cache_dir(), "matrix")
+            cache_file = os.path.join(cache_dir, f"{utils.get_file_key(matrix_dir)['name']}.npz")
+            stats = get_file_stats([features_tsv, barcode_file, matrix_path])
+            count_matrix = cls.load_cache(cache_file, stats)
+            if count_matrix is not None:
+                return count_matrix
 
+        features = Features.from_tsv(tsv_file=features_tsv)
+        barcodes = utils.read_one_col(barcode_file)
+        matrix = read_mtx(matrix_path, threads)
+        count_matrix = cls(features, barcodes, matrix)
+        if stats is not None:
+            count_matrix.save_cache(cache_file, stats)
+        return count_matrix
+
+    def save_cache(self, cache_file, stats):
+        """
+        Save as an uncompressed npz of the CSC matrix, barcodes and features.
+        Write to a temp file first so that concurrent readers never see a partial file.
+        """
+        features = self.__features
+        columns = [self.__barcodes, features.gene_id, features.gene_name, features.gene_type or []]
+        # e.g. nan of missing gene names can not be saved as str
+        if not all(isinstance(x, str) for column in columns for x in column):
+            return
+        mtx = self.__matrix
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_file), suffix=".tmp", delete=False) as f:
+                np.savez(
+                    f,
+                    data=mtx.data,
+                    indices=mtx.indices,
+                    indptr=mtx.indptr,
+                    shape=np.array(mtx.shape),
+                    barcodes=np.array(self.__barcodes, dtype=str),
+                    gene_id=np.array(features.gene_id, dtype=str),
+                    gene_name=np.array(features.gene_name, dtype=str),
+                    gene_type=np.array(features.gene_type or [], dtype=str),
+                    has_gene_type=bool(features.gene_type),
+                    stats=stats,
+                    cache_version=CACHE_VERSION,
+                )
+            os.replace(f.name, cache_file)
+        except OSError:
+            with contextlib.suppress(OSError, NameError):
+                os.remove(f.name)
+
+    @classmethod
+    def load_cache(cls, cache_file, stats):
+        """Returns CountMatrix, or None if the cache does not exist or was written from other files"""
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with np.load(cache_file) as data:
+                if int(data["cache_version"]) != CACHE_VERSION or not np.array_equal(data["stats"], stats):
+                    return None
+                matrix = scipy.sparse.csc_matrix(
+                    (data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"].tolist())
+                )
+                gene_type = data["gene_type"].tolist() if bool(data["has_gene_type"]) else None
+                features = Features(data["gene_id"].tolist(), data["gene_name"].tolist(), gene_type)
+                barcodes = data["barcodes"].tolist()
+        except (OSError, ValueError, KeyError):
+            return None
         return cls(features, barcodes, matrix)
 
     @utils.add_log
-    def to_matrix_dir(self, matrix_dir):
+    def to_matrix_dir(self, matrix_dir, threads=4):
+        """
+        matrix.mtx.gz lists entries in column order (by barcode, then gene), the storage order of the CSC matrix.
+        It is not byte-identical to files written from the coo_matrix order before CountMatrix was stored as CSC;
+        readers such as scipy.io.mmread and Seurat Read10X do not depend on the order.
+
+        >>> tmp_dir = tempfile.mkdtemp()
+        >>> features = Features(["g1", "g2"], ["G1", "G2"])
+        >>> mtx = scipy.sparse.coo_matrix(np.array([[0, 3, 1], [2, 0, 4]]))
+        >>> CountMatrix(features, ["bc1", "bc2", "bc3"], mtx).to_matrix_dir(f"{tmp_dir}/m")
+        >>> gzip.open(f"{tmp_dir}/m/matrix.mtx.gz", "rt").read().splitlines()[3:]
+        ['2 1 2', '1 2 3', '1 3 1', '2 3 4']
+        """
         os.mkdir(matrix_dir)
         self.__features.to_tsv(f"{matrix_dir}/{FEATURE_FILE_NAME}")
         pd.Series(self.__barcodes).to_csv(f"{matrix_dir}/{BARCODE_FILE_NAME}", index=False, sep="\t", header=False)
-        matrix_path = f"{matrix_dir}/{MATRIX_FILE_NAME}"
-        with gzip.open(matrix_path, "wb") as f:
-            scipy.io.mmwrite(f, self.__matrix)
+        write_mtx(f"{matrix_dir}/{MATRIX_FILE_NAME}", self.__matrix, threads=threads)
 
     @classmethod
     def from_dataframe(cls, df, features: Features, barcodes=None, value="UMI"):
@@ -164,7 +521,7 @@ class CountMatrix:
 
     def __str__(self):
         n_row, n_col = self.shape[0], self.shape[1]
-        return f"CountMatrix object\n {n_row} x {n_col} coo_matrix"
+        return f"CountMatrix object\n {n_row} x {n_col} csc_matrix"
 
     def __repr__(self):
         return self.__str__()
@@ -183,7 +540,7 @@ class CountMatrix:
             gene_type = self.get_features().gene_type + other.get_features().gene_type
         features = Features(gene_id, gene_name, gene_type)
 
-        matrix = scipy.sparse.vstack([self.get_matrix(), other.get_matrix()])
+        matrix = scipy.sparse.vstack([self.get_matrix(), other.get_matrix()], format="csc")
 
         return CountMatrix(features, self.__barcodes, matrix)
 
@@ -195,9 +552,8 @@ class CountMatrix:
         Returns:
             CountMatrix object
         """
-        mtx_csc = self.__matrix.tocsc()
         slice_barcodes_indices.sort()
-        sliced_mtx = mtx_csc[:, slice_barcodes_indices]
+        sliced_mtx = self.__matrix[:, slice_barcodes_indices]
         barcodes = [self.__barcodes[i] for i in slice_barcodes_indices]
         return CountMatrix(self.__features, barcodes, sliced_mtx)
 
@@ -209,34 +565,133 @@ class CountMatrix:
         Returns:
             CountMatrix object
         """
-        barcodes_indices = [self.__barcodes.index(barcode) for barcode in bcs]
+        barcodes_indices = self.get_barcode_indices(bcs).tolist()
         barcodes_indices.sort()
         return self.slice_matrix(barcodes_indices)
 
+    def get_barcode_indices(self, bcs) -> np.ndarray:
+        """Column of each barcode. Raise ValueError if any barcode is not found."""
+        if self.__barcode_index is None:
+            self.__barcode_index = LabelIndex(self.__barcodes)
+        return self.__barcode_index.get_first(bcs)
+
+    @utils.add_log
+    def slice_matrix_genes(self, genes, by="gene_id"):
+        """
+        Args:
+            genes: gene ids, or gene names if by is "gene_name". All rows of duplicated gene names are kept.
+        Returns:
+            CountMatrix object of the genes, in the original row order
+
+        >>> features = Features(["g1", "g2", "g3"], ["A", "B", "A"])
+        >>> mtx = CountMatrix(features, ["bc1", "bc2"], scipy.sparse.csc_matrix([[1, 0], [2, 3], [0, 4]]))
+        >>> sliced = mtx.slice_matrix_genes(["A"], by="gene_name")
+        >>> sliced.get_features().gene_id, sliced.get_matrix().toarray().tolist()
+        (['g1', 'g3'], [[1, 0], [0, 4]])
+        """
+        if by == "gene_id":
+            rows = np.unique(self.__features.get_gene_id_rows(genes))
+        elif by == "gene_name":
+            rows = self.__features.get_gene_name_rows(genes, all_rows=True)
+        else:
+            raise ValueError(f"by must be gene_id or gene_name, got {by}")
+        rows = rows.tolist()
+        sliced_mtx = self.get_csr()[rows, :]
+        return CountMatrix(self.__features.slice(rows), self.__barcodes, sliced_mtx)
+
     @utils.add_log
     def get_genes_fraction(self, gene_list):
         """
         Returns:
             numpy 2d fraction of gene_names in gene_list
         """
-        gene_indices = [self.__features.gene_name.index(gene) for gene in gene_list]
-        mtx = self.__matrix.tocsc()
-        total = mtx.sum(axis=0)
-        gene = mtx[gene_indices, :].sum(axis=0)
+        gene_indices = self.__features.get_gene_name_rows(gene_list).tolist()
+        total = self.__matrix.sum(axis=0)
+        gene = self.get_csr()[gene_indices, :].sum(axis=0)
         f = gene / total
 
         return f
 
+    def _sum_columns(self, values: np.ndarray) -> np.ndarray:
+        """Sum of values (aligned to the stored entries) in each column"""
+        indptr = self.__matrix.indptr
+        # a trailing 0 so that empty columns at the end have a valid start
+        sums = np.add.reduceat(np.append(values, values.dtype.type(0)), indptr[:-1])
+        sums[indptr[1:] == indptr[:-1]] = 0
+        return sums
+
+    def get_genes_per_barcode(self) -> np.ndarray:
+        """
+        Number of genes with UMI > 0 of each barcode
+
+        >>> m = scipy.sparse.csc_matrix([[1, 0, 0], [2, 0, 5], [0, 0, 1]])
+        >>> mtx = CountMatrix(Features(["g1", "g2", "g3"]), ["bc1", "bc2", "bc3"], m)
+        >>> mtx.get_genes_per_barcode().tolist(), mtx.get_umis_per_barcode().tolist(), mtx.get_cells_per_gene().tolist()
+        ([2, 0, 2], [3, 0, 6], [1, 2, 1])
+        """
+        return self._sum_columns((self.__matrix.data != 0).astype(np.int64))
+
+    def get_umis_per_barcode(self) -> np.ndarray:
+        """Total UMI of each barcode"""
+        return self._sum_columns(self.__matrix.data)
+
+    def get_cells_per_gene(self) -> np.ndarray:
+        """Number of barcodes with UMI > 0 of each gene"""
+        mtx = self.__matrix
+        return np.bincount(mtx.indices[mtx.data != 0], minlength=mtx.shape[0])
+
+    def get_mito_fraction(self, mito_prefix="mt-") -> np.ndarray:
+        """
+        Fraction of UMI from genes whose names start with mito_prefix (case insensitive) of each barcode.
+        0 for barcodes without UMI.
+
+        >>> m = scipy.sparse.csc_matrix([[1, 0], [3, 0]])
+        >>> mtx = CountMatrix(Features(["g1", "g2"], ["MT-CO1", "ACTB"]), ["bc1", "bc2"], m)
+        >>> mtx.get_mito_fraction().tolist()
+        [0.25, 0.0]
+
+        Missing gene names (NaN) are not mitochondrial.
+
+        >>> mtx = CountMatrix(Features(["g1", "g2"], ["MT-CO1", np.nan]), ["bc1", "bc2"], m)
+        >>> mtx.get_mito_fraction().tolist()
+        [0.25, 0.0]
+        """
+        mtx = self.__matrix
+        names = pd.Series(self.__features.gene_name, dtype=object)
+        is_mito = names.str.lower().str.startswith(mito_prefix.lower(), na=False).to_numpy(dtype=bool)
+        if not len(is_mito):
+            return np.zeros(mtx.shape[1])
+        mito = self._sum_columns(np.where(is_mito[mtx.indices], mtx.data, 0))
+        total = self.get_umis_per_barcode()
+        return np.divide(mito, total, out=np.zeros(len(total)), where=total != 0)
+
     def get_bc_geneNum(self):
         """
         Returns {bc: geneNum}, total_genes
+            bc: column index of barcodes with at least one gene
+            total_genes: number of genes detected in any barcode
         """
-        gene_index, bc_index = self.__matrix.nonzero()
-        total_genes = len(set(gene_index))
-        bc_gene = defaultdict(set)
-        for gene, bc in zip(gene_index, bc_index):
-            bc_gene[bc].add(gene)
-        return {bc: len(bc_gene[bc]) for bc in bc_gene}, total_genes
+        genes_per_bc = self.get_genes_per_barcode()
+        bc_index = np.flatnonzero(genes_per_bc)
+        total_genes = int(np.count_nonzero(self.get_cells_per_gene()))
+        return dict(zip(bc_index.tolist(), genes_per_bc[bc_index].tolist())), total_genes
+
+    def to_anndata(self):
+        """
+        AnnData of cells x genes, the same as `scanpy.read_10x_mtx(matrix_dir, var_names="gene_symbols")`
+        """
+        import anndata
+
+        features = self.__features
+        var = pd.DataFrame({"gene_ids": features.gene_id}, index=pd.Index(features.gene_name))
+        if features.gene_type:
+            var["feature_types"] = features.gene_type
+        obs = pd.DataFrame(index=pd.Index(self.__barcodes))
+        # the transpose of csc is csr
+        X = self.__matrix.T.astype(np.float32)
+        adata = anndata.AnnData(X, obs=obs, var=var)
+        adata.var_names_make_unique()
+        return adata
 
     def get_barcodes(self):
         return self.__barcodes
@@ -245,4 +700,11 @@ class CountMatrix:
         return self.__features
 
     def get_matrix(self):
+        """csc_matrix of genes x barcodes"""
         return self.__matrix
+
+    def get_csr(self):
+        """csr_matrix of genes x barcodes, for row (gene) slicing. Created once and cached."""
+        if self.__csr is None:
+            self.__csr = self.__matrix.tocsr()
+        return self.__csr
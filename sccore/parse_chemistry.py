@@ -1,11 +1,18 @@
+import contextlib
+import functools
 import itertools
+import math
+import operator
 import os
+import random
 import re
 import sys
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
-import pysam
-from sccore import utils
+import numpy as np
+from sccore import barcode, fastq, utils
+from sccore.barcode import BarcodeIndex, HammingIndex, QualityCorrector
 from sccore.chemistry.chemistry_dict import chemistry_dict, chemistry_dir
 
 
@@ -33,6 +40,55 @@ def parse_pattern(pattern: str, allowed: str = "CLUNT") -> dict[str, list[slice]
     return pattern_slices
 
 
+class ReadLayout:
+    """
+    Compiled read pattern. Segment slices, offsets and lengths are computed once, and `extract` returns all barcode
+    segments and the UMI of a read (str or bytes) with a single itemgetter call.
+
+    >>> layout = ReadLayout("C8L16C8L16C8L1U12T18")
+    >>> layout.length, layout.n_bc, layout.bc_starts, layout.bc_lens, layout.umi_slice
+    (87, 3, (0, 24, 48), (8, 8, 8), slice(57, 69, None))
+    >>> ReadLayout("C2C2U2").extract("AACCGT")
+    ('AA', 'CC', 'GT')
+    >>> ReadLayout("C3").extract(b"AACCGT")
+    (b'AAC', b'')
+    """
+
+    __slots__ = (
+        "pattern",
+        "pattern_dict",
+        "bc_slices",
+        "umi_slices",
+        "linker_slices",
+        "umi_slice",
+        "bc_starts",
+        "bc_lens",
+        "bc_stop",
+        "length",
+        "n_bc",
+        "extract",
+    )
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pattern_dict = parse_pattern(pattern)
+        self.bc_slices = tuple(self.pattern_dict.get("C", ()))
+        self.umi_slices = tuple(self.pattern_dict.get("U", ()))
+        self.linker_slices = tuple(self.pattern_dict.get("L", ()))
+        # the UMI is empty if the pattern has none
+        self.umi_slice = self.umi_slices[0] if self.umi_slices else slice(0, 0)
+        self.bc_starts = tuple(x.start for x in self.bc_slices)
+        self.bc_lens = tuple(x.stop - x.start for x in self.bc_slices)
+        self.bc_stop = max((x.stop for x in self.bc_slices), default=0)
+        self.length = max((x.stop for slices in self.pattern_dict.values() for x in slices), default=0)
+        self.n_bc = len(self.bc_slices)
+        # (*bc_segments, umi). Always a tuple, since there are at least 2 items
+        self.extract = operator.itemgetter(*self.bc_slices, self.umi_slice)
+
+    def __repr__(self):
+        return f"ReadLayout({self.pattern!r})"
+
+
 def create_mismatch_seqs(seq: str, max_mismatch=1, allowed_bases="ACGTN") -> set[str]:
     """Create all sequences within a specified number of mismatches from the input sequence.
 
@@ -93,8 +149,90 @@ def create_mismatch_origin_dicts_from_whitelists(whitelists: list, n_mismatch: i
     return raw_list, mismatch_list
 
 
+def get_index_cache_file(file_key: dict, n_mismatch: int, beside_whitelist=False) -> str:
+    """Cache file in the user cache dir, or next to the whitelist if beside_whitelist."""
+    suffix = f"mismatch{n_mismatch}.v{barcode.CACHE_VERSION}.npz"
+    if beside_whitelist:
+        return f"{file_key['path']}.{suffix}"
+    return os.path.join(utils.get_cache_dir(), f"{file_key['name']}.{suffix}")
+
+
+@functools.lru_cache(maxsize=None)
+def load_whitelist_index(
+    whitelist: str, n_mismatch: int = 1, beside_whitelist=False
+) -> tuple[set, BarcodeIndex | HammingIndex]:
+    """
+    Load BarcodeIndex from the cache file if it was built from the same whitelist path, mtime and size,
+    otherwise create and cache it. The cache is in `utils.get_cache_dir()`, or next to the whitelist if
+    beside_whitelist. Failures to write the cache are ignored.
+    HammingIndex (n_mismatch >= 2) is cheap to build and is not cached on disk.
+    Results are also shared in the same process.
+
+    Returns:
+        raw barcode set, BarcodeIndex or HammingIndex
+    """
+    if n_mismatch >= 2 or not os.path.isfile(whitelist):
+        barcodes = utils.one_col_to_list(whitelist)
+        return set(barcodes), barcode.create_index(barcodes, n_mismatch)
+
+    file_key = utils.get_file_key(whitelist)
+    meta = {"whitelist": file_key["path"], "mtime_ns": file_key["mtime_ns"], "size": file_key["size"]}
+    cache_file = get_index_cache_file(file_key, n_mismatch, beside_whitelist)
+    if os.path.exists(cache_file):
+        try:
+            index, cache_meta = BarcodeIndex.load(cache_file)
+            if cache_meta == meta and index.n_mismatch == n_mismatch:
+                return set(index.barcodes), index
+        except (OSError, ValueError, KeyError):
+            pass
+
+    barcodes = utils.one_col_to_list(whitelist)
+    index = BarcodeIndex(barcodes, n_mismatch)
+    with contextlib.suppress(OSError):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        index.save(cache_file, **meta)
+    return set(barcodes), index
+
+
+def create_mismatch_indexes_from_whitelists(whitelists: list, n_mismatch: int = 1) -> tuple[list, list]:
+    """Returns raw set list and index list.
+    Same lookup semantics as `create_mismatch_origin_dicts_from_whitelists`, with much less memory.
+    n_mismatch >= 2 uses HammingIndex, which returns the nearest barcode instead of expanding all mismatch seqs.
+
+    >>> whitelists = [os.path.join(chemistry_dir, "GEXSCOPE-V2/bc1.txt")]
+    >>> raw_list, index_list = create_mismatch_indexes_from_whitelists(whitelists)
+    >>> _raw_dicts, mismatch_dicts = create_mismatch_origin_dicts_from_whitelists(whitelists)
+    >>> all(index_list[0][seq] == origin for seq, origin in mismatch_dicts[0].items() if seq not in raw_list[0])
+    True
+    """
+    raw_list, index_list = [], []
+    for f in whitelists:
+        raw, index = load_whitelist_index(f, n_mismatch)
+        raw_list.append(raw)
+        index_list.append(index)
+
+    return raw_list, index_list
+
+
+class LazyMismatchDict(dict):
+    """Create mismatch indexes of a chemistry on first access. Key: chemistry, value: (raw_list, index_list)"""
+
+    def __init__(self, chemistry_dict: dict, n_mismatch: int = 1):
+        super().__init__()
+        self.chemistry_dict = chemistry_dict
+        self.n_mismatch = n_mismatch
+
+    def __missing__(self, chemistry):
+        if "bc" not in self.chemistry_dict.get(chemistry, {}):
+            raise KeyError(chemistry)
+        value = create_mismatch_indexes_from_whitelists(self.chemistry_dict[chemistry]["bc"], self.n_mismatch)
+        self[chemistry] = value
+        return value
+
+
 def check_seq_mismatch(seq_list, raw_list, mismatch_list) -> tuple[bool, bool, str]:
     """
+    mismatch_list can be a list of dict or BarcodeIndex.
     Returns
         valid: True if seq in mismatch_list or mismatch_list is empty
         corrected: True if seq in mismatch_list but not in raw_list
@@ -153,7 +291,8 @@ def get_chemistry_dict():
             cur["bc"] = [os.path.join(chemistry_dir, chemistry, x) for x in bc]
         if linker:
             cur["linker"] = [os.path.join(chemistry_dir, chemistry, x) for x in linker]
-        cur["pattern_dict"] = parse_pattern(cur["pattern"])
+        cur["layout"] = ReadLayout(cur["pattern"])
+        cur["pattern_dict"] = cur["layout"].pattern_dict
     return chemistry_dict
 
 
@@ -161,43 +300,184 @@ CHEMISTRY_DICT = get_chemistry_dict()
 
 
 def get_raw_umi_bc_and_quality(
-    seq: str, quality: str, pattern_dict: dict, reverse_complement=False
+    seq: str, quality: str, layout: ReadLayout, reverse_complement=False
 ) -> tuple[list, list, str, str]:
     """
     Returns:
-        bc_list, umi, bc_quality_list, umi_qual
+        bc_list, bc_quality_list, umi, umi_qual
+
+    >>> get_raw_umi_bc_and_quality("AACCGT", "123456", ReadLayout("C2C2U2"), reverse_complement=True)
+    (['GG', 'TT'], ['43', '21'], 'AC', '65')
     """
-    bc_list = [seq[x] for x in pattern_dict["C"]]
-    bc_quality_list = [quality[x] for x in pattern_dict["C"]]
-    umi = seq[pattern_dict["U"][0]]
-    umi_qual = quality[pattern_dict["U"][0]]
+    *bc_list, umi = layout.extract(seq)
+    *bc_quality_list, umi_qual = layout.extract(quality)
     if reverse_complement:
         bc_list = [utils.reverse_complement(x) for x in bc_list[::-1]]
-        bc_quality_list = bc_quality_list[::-1]
+        bc_quality_list = [x[::-1] for x in bc_quality_list[::-1]]
         umi = utils.reverse_complement(umi)
         umi_qual = umi_qual[::-1]
     return bc_list, bc_quality_list, umi, umi_qual
 
 
+class ChemistryRule:
+    """
+    Compiled read layout check of one chemistry.
+    A read matches if, at any offset in offsets, every check and every anchor passes.
+    """
+
+    __slots__ = ("chemistry", "checks", "anchors", "offsets")
+
+    def __init__(self, chemistry: str, checks=(), anchors=(), offsets=range(1)):
+        """
+        Args:
+            checks: list of (slice, index, reverse_complement).
+                The segment must be in the index (BarcodeIndex or HammingIndex).
+            anchors: list of (slice, seq, equal). The segment must be equal (or not equal if equal is False) to seq.
+            offsets: offsets of the read start.
+        """
+        self.chemistry = chemistry
+        self.checks = list(checks)
+        self.anchors = [(sl, barcode.encode_seq(seq), equal) for sl, seq, equal in anchors]
+        self.offsets = offsets
+
+    @property
+    def read_len(self) -> int:
+        stops = [x[0].stop for x in self.checks] + [x[0].stop for x in self.anchors] + [0]
+        return max(stops) + max(self.offsets)
+
+    def match(self, mat: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            mat: uint8 matrix from `barcode.seqs_to_matrix`
+        Returns:
+            bool array
+        """
+        hit = np.zeros(len(mat), dtype=bool)
+        for offset in self.offsets:
+            ok = ~hit
+            for sl, index, rc in self.checks:
+                segment = mat[ok, sl.start + offset : sl.stop + offset]
+                if rc:
+                    segment = utils.reverse_complement_matrix(segment)
+                idx, _ = index.lookup_codes(barcode.encode_matrix(segment))
+                ok[ok] = idx != -1
+            for sl, code, equal in self.anchors:
+                codes = barcode.encode_matrix(mat[ok, sl.start + offset : sl.stop + offset])
+                ok[ok] = (codes == code) if equal else (codes != code)
+            hit |= ok
+        return hit
+
+
+class ChemistryClassifier:
+    """
+    Decide the chemistry of a batch of reads with a list of ChemistryRule.
+    Rules are checked in order, and each rule only checks the reads not matched by previous rules.
+    """
+
+    def __init__(self, rules: list[ChemistryRule]):
+        self.rules = rules
+        self.chemistrys = np.array([rule.chemistry for rule in rules] + [None], dtype=object)
+        self.read_len = max([rule.read_len for rule in rules] + [1])
+
+    def classify_matrix(self, mat: np.ndarray) -> np.ndarray:
+        """Returns int array of rule index, -1 if no rule matches"""
+        res = np.full(len(mat), -1, dtype=np.intp)
+        todo = np.arange(len(mat))
+        for i, rule in enumerate(self.rules):
+            if len(todo) == 0:
+                break
+            hit = rule.match(mat[todo])
+            res[todo[hit]] = i
+            todo = todo[~hit]
+        return res
+
+    def classify(self, seqs) -> np.ndarray:
+        """
+        Args:
+            seqs: list of str or numpy S-dtype array
+        Returns:
+            object array of chemistry or None
+        """
+        return self.chemistrys[self.classify_matrix(barcode.seqs_to_matrix(seqs, self.read_len))]
+
+
+def wilson_lower_bound(k: int, n: int, z: float = 3.29) -> float:
+    """Lower bound of the Wilson score interval of proportion k/n. z=3.29 is 99.9% two-sided.
+
+    >>> round(wilson_lower_bound(100, 100), 3)
+    0.902
+    >>> wilson_lower_bound(0, 0)
+    0.0
+    """
+    if n == 0:
+        return 0.0
+    p = k / n
+    z2 = z * z
+    centre = p + z2 / (2 * n)
+    margin = z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n))
+    return (centre - margin) / (1 + z2 / n)
+
+
+class ChemistryResult:
+    """Auto detection result of one fastq file"""
+
+    def __init__(self, fq1: str, counts: dict[str, int], n_read: int, early_stopped: bool = False):
+        """
+        Args:
+            counts: read count of each detected chemistry
+            n_read: number of reads checked
+        """
+        self.fq1 = fq1
+        self.counts = dict(sorted(counts.items(), key=lambda x: x[1], reverse=True))
+        self.n_read = n_read
+        self.early_stopped = early_stopped
+        self.chemistry, top_count = next(iter(self.counts.items()), (None, 0))
+        self.percent = top_count / n_read if n_read else 0.0
+        # lower bound of the fraction of all reads that are from the top chemistry
+        self.confidence = wilson_lower_bound(top_count, n_read)
+
+    def __repr__(self):
+        return (
+            f"ChemistryResult(fq1={self.fq1!r}, chemistry={self.chemistry!r}, percent={self.percent:.4f}, "
+            f"confidence={self.confidence:.4f}, n_read={self.n_read}, early_stopped={self.early_stopped}, "
+            f"counts={self.counts})"
+        )
+
+
 class Auto:
     """
     Auto detect singleron chemistrys from R1-read
     """
 
-    def __init__(self, fq1_list, chemistry_dict, max_read=10000):
+    # reads are checked in chunks, and detection may stop after min_read reads if one chemistry dominates
+    CHUNK_SIZE = 500
+    MIN_READ = 1000
+    # lower bound of top chemistry fraction in all reads / in reads with a detected chemistry
+    STOP_PERCENT = 0.5
+    STOP_PURITY = 0.95
+    # True if get_rules is equivalent to seq_chemistry, so that seq_chemistry_batch can be used.
+    # Subclasses that override seq_chemistry must implement get_rules, or set it to False.
+    supports_batch = True
+
+    def __init__(self, fq1_list, chemistry_dict, max_read=10000, threads=4, early_stop=True, sampling="head"):
         """
+        Args:
+            threads: number of fastq files sampled concurrently
+            early_stop: stop reading a fastq once one chemistry dominates
+            sampling: "head" reads the first max_read reads; "random" samples reads from several offsets of the file
         Returns:
             chemistry, chemistry_dict[chemistry]
         """
         self.fq1_list = fq1_list
         self.max_read = max_read
+        self.threads = threads
+        self.early_stop = early_stop
+        self.sampling = sampling
         self.chemistry_dict = chemistry_dict
-        self.bc_mismatch_dict = {}
-        for chemistry in self.chemistry_dict:
-            if "bc" in self.chemistry_dict[chemistry]:
-                self.bc_mismatch_dict[chemistry] = create_mismatch_origin_dicts_from_whitelists(
-                    self.chemistry_dict[chemistry]["bc"], 1
-                )
+        # only chemistries that are actually checked load their whitelists
+        self.bc_mismatch_dict = LazyMismatchDict(self.chemistry_dict, 1)
+        self.bc_matchers = {}
+        self.classifier = None
 
     def run(self):
         """
@@ -209,10 +489,10 @@ class Auto:
 
     def get_chemistry(self) -> str:
         """check chemistry in the fq1_list"""
-        fq_chemistry = {}
-        for fastq1 in self.fq1_list:
-            chemistry = self.get_fq_chemistry(fastq1)
-            fq_chemistry[fastq1] = chemistry
+        self.compile()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.threads, len(self.fq1_list)))) as executor:
+            chemistrys = list(executor.map(self.get_fq_chemistry, self.fq1_list))
+        fq_chemistry = dict(zip(self.fq1_list, chemistrys))
         if len(set(fq_chemistry.values())) != 1:
             sys.exit(
                 f"Error: multiple chemistrys are not allowed for one sample: {self.fq1_list}! \n" + str(fq_chemistry)
@@ -222,12 +502,13 @@ class Auto:
 
     def is_chemistry(self, seq, chemistry):
         """check if seq matches the barcode of chemistry"""
-        raw_list, mismatch_list = self.bc_mismatch_dict[chemistry]
-        bc_list = [seq[x] for x in self.chemistry_dict[chemistry]["pattern_dict"]["C"]]
+        if chemistry not in self.bc_matchers:
+            _raw_list, mismatch_list = self.bc_mismatch_dict[chemistry]
+            self.bc_matchers[chemistry] = barcode.WhitelistMatcher(mismatch_list)
+        bc_list = self.chemistry_dict[chemistry]["layout"].extract(seq)[:-1]
         if chemistry.split("-")[0] == "flv":
             bc_list = [utils.reverse_complement(bc) for bc in bc_list[::-1]]
-        valid, _corrected, _res = check_seq_mismatch(bc_list, raw_list, mismatch_list)
-        return valid
+        return self.bc_matchers[chemistry].is_valid(bc_list)
 
     def seq_chemistry(self, seq):
         """check if seq matches any chemistry in chemistry_dict"""
@@ -236,25 +517,102 @@ class Auto:
                 return chemistry
         return None
 
-    def get_fq_chemistry(self, fq1):
-        chemistry_readcount = defaultdict(int)
+    def bc_rule(self, chemistry, name=None, anchors=(), offsets=range(1)) -> ChemistryRule:
+        """ChemistryRule equivalent to is_chemistry"""
+        _raw_list, index_list = self.bc_mismatch_dict[chemistry]
+        slices = list(self.chemistry_dict[chemistry]["layout"].bc_slices)
+        rc = chemistry.split("-")[0] == "flv"
+        if rc:
+            slices = slices[::-1]
+        checks = [(sl, index, rc) for sl, index in zip(slices, index_list)]
+        return ChemistryRule(name or chemistry, checks, anchors, offsets)
+
+    def get_rules(self) -> list[ChemistryRule]:
+        """Rules used by seq_chemistry_batch, in the same order as seq_chemistry"""
+        return [self.bc_rule(chemistry) for chemistry in self.chemistry_dict if "bc" in self.chemistry_dict[chemistry]]
+
+    def seq_chemistry_batch(self, seqs) -> np.ndarray:
+        """
+        Batch version of seq_chemistry. The classifier is compiled on first call.
+        Args:
+            seqs: list of str or numpy S-dtype array
+        Returns:
+            object array of chemistry or None
+        """
+        if self.classifier is None:
+            self.classifier = ChemistryClassifier(self.get_rules())
+        return self.classifier.classify(seqs)
 
-        fq = pysam.FastxFile(fq1)
+    def detect(self) -> dict[str, ChemistryResult]:
+        """
+        Sample all fastq files concurrently.
+        Returns:
+            {fq1: ChemistryResult}
+        """
+        self.compile()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.threads, len(self.fq1_list)))) as executor:
+            results = list(executor.map(self.detect_fq_chemistry, self.fq1_list))
+        return dict(zip(self.fq1_list, results))
+
+    def compile(self):
+        """Compile the classifier before it is shared between threads"""
+        if self.supports_batch and self.classifier is None:
+            self.classifier = ChemistryClassifier(self.get_rules())
+
+    def seq_chemistry_chunk(self, seqs: list[str]) -> list:
+        if self.supports_batch:
+            return self.seq_chemistry_batch(seqs).tolist()
+        return [self.seq_chemistry(seq) for seq in seqs]
+
+    def detect_fq_chemistry(self, fq1) -> ChemistryResult:
+        """
+        Read up to max_read reads in chunks. If early_stop, stop after MIN_READ reads once the Wilson lower bounds of
+        the top chemistry fraction among all reads and among detected reads pass STOP_PERCENT and STOP_PURITY.
+        """
+        chemistry_readcount = defaultdict(int)
         n = 0
-        for read in fq:
-            seq = read.sequence
-            n += 1
-            chemistry = self.seq_chemistry(seq)
-            if chemistry:
-                chemistry_readcount[chemistry] += 1
-            if n == self.max_read:
-                break
-        sorted_counts = sorted(chemistry_readcount.items(), key=lambda x: x[1], reverse=True)
-        print(sorted_counts)
+        early_stopped = False
+        with contextlib.closing(fastq.read_fastq(fq1, self.max_read, self.sampling)) as reads:
+            chunk = []
+            for _name, seq, _qual in reads:
+                chunk.append(seq)
+                n += 1
+                if len(chunk) < self.CHUNK_SIZE and n < self.max_read:
+                    continue
+                for chemistry in self.seq_chemistry_chunk(chunk):
+                    if chemistry:
+                        chemistry_readcount[chemistry] += 1
+                chunk = []
+                if n >= self.max_read:
+                    break
+                if self.early_stop and n >= self.MIN_READ and self.dominates(chemistry_readcount, n):
+                    early_stopped = True
+                    break
+            for chemistry in self.seq_chemistry_chunk(chunk):
+                if chemistry:
+                    chemistry_readcount[chemistry] += 1
+        return ChemistryResult(fq1, chemistry_readcount, n, early_stopped)
+
+    def dominates(self, chemistry_readcount: dict, n: int) -> bool:
+        """
+        >>> runner = Auto([], {})
+        >>> runner.dominates({"GEXSCOPE-V2": 950, "GEXSCOPE-V1": 2}, 1000)
+        True
+        >>> runner.dominates({"GEXSCOPE-V2": 500, "GEXSCOPE-V1": 400}, 1000)
+        False
+        """
+        if not chemistry_readcount:
+            return False
+        top = max(chemistry_readcount.values())
+        detected = sum(chemistry_readcount.values())
+        return wilson_lower_bound(top, n) >= self.STOP_PERCENT and wilson_lower_bound(top, detected) >= self.STOP_PURITY
+
+    def get_fq_chemistry(self, fq1):
+        result = self.detect_fq_chemistry(fq1)
+        sys.stderr.write(f"{result}\n")
 
-        chemistry, read_counts = sorted_counts[0]
-        percent = float(read_counts) / n
-        if percent < 0.1:
+        chemistry, percent = result.chemistry, result.percent
+        if chemistry is None or percent < 0.1:
             print("Valid chemistry read counts percent < 0.1")
             raise Exception("Auto chemistry detection failed! ")
         elif percent < 0.5:
@@ -265,65 +623,152 @@ class Auto:
 
 
 FLV_RNA_V2_LINKER1 = "ATCCAGCTGCTTGAGATC"
+MAX_OFFSET_LEN = 3 + 1  # allow for extra 1 bases
+# reads used to fit the barcode prior of QualityCorrector
+PRIOR_READS = 100_000
 
 
-class AutoRNA(Auto):
-    def __init__(self, fq1_list, max_read=10000):
-        super().__init__(fq1_list, CHEMISTRY_DICT, max_read)
-        self.v3_linker_mismatch = create_mismatch_origin_dicts_from_whitelists(
-            self.chemistry_dict["GEXSCOPE-V3"]["linker"], 1
+@functools.lru_cache(maxsize=None)
+def get_linker_indexes() -> tuple[list, list, BarcodeIndex]:
+    """
+    Linker indexes used to find the offset of GEXSCOPE-V3 and flv_rna-V2 reads, built once per process.
+    Returns:
+        v3 linker raw set list, v3 linker index list, flv_rna-V2 linker1 index
+    """
+    v3_raw_list, v3_index_list = create_mismatch_indexes_from_whitelists(CHEMISTRY_DICT["GEXSCOPE-V3"]["linker"], 1)
+    return v3_raw_list, v3_index_list, BarcodeIndex([FLV_RNA_V2_LINKER1], 1)
+
+
+def v3_offset(seq):
+    """
+    return -1 if not v3
+
+    >>> seq = "AT" + "TCGACTGTC" + "ACGATG" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG" + "TTTTTTTTTT"
+    >>> v3_offset(seq)
+    2
+    >>> seq = "TCGACTGTC" + "ACGATG" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG" + "TTTTTTTTTT"
+    >>> v3_offset(seq)
+    0
+    >>> seq = "TCGACTGTC" + "ATATAT" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG" + "TTTTTTTTTT"
+    >>> v3_offset(seq)
+    -1
+    """
+    raw_list, index_list, _ = get_linker_indexes()
+    bc_len = 9
+    linker_len = 6
+    for offset in range(MAX_OFFSET_LEN + 1):
+        first_linker_start = offset + bc_len
+        second_linker_start = first_linker_start + linker_len + bc_len
+        first_linker_seq = seq[first_linker_start : first_linker_start + linker_len]
+        second_linker_seq = seq[second_linker_start : second_linker_start + linker_len]
+        valid, _, _ = check_seq_mismatch([first_linker_seq, second_linker_seq], raw_list, index_list)
+        if valid:
+            return offset
+    return -1
+
+
+def flv_rna_v2_offset(seq) -> int:
+    """
+    return -1 if not
+
+    >>> flv_rna_v2_offset(FLV_RNA_V2_LINKER1)
+    0
+    >>> flv_rna_v2_offset("A" + FLV_RNA_V2_LINKER1)
+    1
+    >>> flv_rna_v2_offset("GGGGG" + FLV_RNA_V2_LINKER1)
+    -1
+    """
+    linker1_index = get_linker_indexes()[2]
+    for offset in range(MAX_OFFSET_LEN + 1):
+        linker = seq[offset : offset + len(FLV_RNA_V2_LINKER1)]
+        if linker in linker1_index:
+            return offset
+    return -1
+
+
+def v3_offset_batch(mat: np.ndarray) -> np.ndarray:
+    """
+    Batch version of v3_offset.
+    Args:
+        mat: uint8 matrix from `barcode.seqs_to_matrix`
+    Returns:
+        int array of offset, -1 if not v3
+
+    >>> seq = "TCGACTGTC" + "ACGATG" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG"
+    >>> v3_offset_batch(barcode.seqs_to_matrix(["AT" + seq, seq, "A" * 60], 60)).tolist()
+    [2, 0, -1]
+    """
+    bc_len = 9
+    linker_len = 6
+    linker1_index, linker2_index = get_linker_indexes()[1]
+    res = np.full(len(mat), -1, dtype=np.intp)
+    for offset in range(MAX_OFFSET_LEN, -1, -1):
+        first_linker_start = offset + bc_len
+        second_linker_start = first_linker_start + linker_len + bc_len
+        idx1, _ = linker1_index.lookup_codes(
+            barcode.encode_matrix(mat[:, first_linker_start : first_linker_start + linker_len])
+        )
+        idx2, _ = linker2_index.lookup_codes(
+            barcode.encode_matrix(mat[:, second_linker_start : second_linker_start + linker_len])
         )
-        self.flv_rna_v2_linker1_mismatch_dict = create_mismatch_origin_dict([FLV_RNA_V2_LINKER1], 1)
+        # iterate from the largest offset so that the smallest valid offset wins
+        res[(idx1 != -1) & (idx2 != -1)] = offset
+    return res
 
-    def v3_offset(self, seq):
-        """
-        return -1 if not v3
 
-        >>> seq = "AT" + "TCGACTGTC" + "ACGATG" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG" + "TTTTTTTTTT"
-        >>> runner = AutoRNA([], "fake_sample")
-        >>> runner.v3_offset(seq)
-        2
-        >>> seq = "TCGACTGTC" + "ACGATG" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG" + "TTTTTTTTTT"
-        >>> runner.v3_offset(seq)
-        0
-        >>> seq = "TCGACTGTC" + "ATATAT" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG" + "TTTTTTTTTT"
-        >>> runner.v3_offset(seq)
-        -1
+def flv_rna_v2_offset_batch(mat: np.ndarray) -> np.ndarray:
+    """
+    Batch version of flv_rna_v2_offset.
+
+    >>> seqs = [FLV_RNA_V2_LINKER1, "A" + FLV_RNA_V2_LINKER1, "GGGGG" + FLV_RNA_V2_LINKER1]
+    >>> flv_rna_v2_offset_batch(barcode.seqs_to_matrix(seqs, 30)).tolist()
+    [0, 1, -1]
+    """
+    linker1_index = get_linker_indexes()[2]
+    linker_len = len(FLV_RNA_V2_LINKER1)
+    res = np.full(len(mat), -1, dtype=np.intp)
+    for offset in range(MAX_OFFSET_LEN, -1, -1):
+        codes = barcode.encode_matrix(mat[:, offset : offset + linker_len])
+        idx, _ = linker1_index.lookup_codes(codes)
+        res[idx != -1] = offset
+    return res
+
+
+class AutoRNA(Auto):
+    def __init__(self, fq1_list, max_read=10000, **kwargs):
+        super().__init__(fq1_list, CHEMISTRY_DICT, max_read, **kwargs)
+
+    def get_rules(self) -> list[ChemistryRule]:
+        """
+        >>> runner = AutoRNA([])
+        >>> seqs = [
+        ...     "AT" + "TCGACTGTC" + "ACGATG" + "TTCTAGGAT" + "CATAGT" + "TGCACGAGA" + "C" + "CATATCAATGGG" + "TTTTTTTTTT",
+        ...     "NCAGATTC" + "TCGGTGACAGCCATAT" + "GTACGCAA" + "CGTAGTCAGAAGCTGA" + "CTGAGCCA" + "TCCGAAGCC" + "CTGTCT",
+        ...     "ATCGATCGATCG" + "ATCGATCG" + "C" + "TTTTTTTTTT",
+        ...     "A" * 80,
+        ... ]
+        >>> runner.seq_chemistry_batch(seqs).tolist() == [runner.seq_chemistry(seq) for seq in seqs]
+        True
         """
         bc_len = 9
         linker_len = 6
-        max_offset_len = 3 + 1  # allow for extra 1 bases
-        for offset in range(max_offset_len + 1):
-            first_linker_start = offset + bc_len
-            second_linker_start = first_linker_start + linker_len + bc_len
-            first_linker_seq = seq[first_linker_start : first_linker_start + linker_len]
-            second_linker_seq = seq[second_linker_start : second_linker_start + linker_len]
-            valid, _, _ = check_seq_mismatch([first_linker_seq, second_linker_seq], *self.v3_linker_mismatch)
-            if valid:
-                return offset
-        return -1
-
-    def flv_rna_v2_offset(self, seq) -> int:
-        """
-        return -1 if not
-
-        >>> seq = FLV_RNA_V2_LINKER1
-        >>> runner = AutoRNA([], "fake_sample")
-        >>> runner.flv_rna_v2_offset(seq)
-        0
-        >>> seq = "A" + FLV_RNA_V2_LINKER1
-        >>> runner.flv_rna_v2_offset(seq)
-        1
-        >>> seq = "GGGGG" + FLV_RNA_V2_LINKER1
-        >>> runner.flv_rna_v2_offset(seq)
-        -1
-        """
-        max_offset_len = 3 + 1  # allow for extra 1 bases
-        for offset in range(max_offset_len + 1):
-            linker = seq[offset : offset + 18]
-            if linker in self.flv_rna_v2_linker1_mismatch_dict:
-                return offset
-        return -1
+        _raw, (linker1_index, linker2_index), flv_rna_v2_linker1_index = get_linker_indexes()
+        offsets = range(MAX_OFFSET_LEN + 1)
+        v3_checks = [
+            (slice(bc_len, bc_len + linker_len), linker1_index, False),
+            (slice(bc_len * 2 + linker_len, (bc_len + linker_len) * 2), linker2_index, False),
+        ]
+        flv_rna_v2_checks = [(slice(0, len(FLV_RNA_V2_LINKER1)), flv_rna_v2_linker1_index, False)]
+        return [
+            ChemistryRule("GEXSCOPE-V3", v3_checks, offsets=offsets),
+            ChemistryRule("flv_rna-V2", flv_rna_v2_checks, offsets=offsets),
+            self.bc_rule("GEXSCOPE-V2"),
+            self.bc_rule("GEXSCOPE-V1", name="flv_rna", anchors=[(slice(56, 57), "C", False)]),
+            self.bc_rule("GEXSCOPE-V1"),
+            ChemistryRule(
+                "GEXSCOPE-MicroBead", anchors=[(slice(16, 20), "TTTT", False), (slice(22, 26), "TTTT", True)]
+            ),
+        ]
 
     def seq_chemistry(self, seq):
         """
@@ -350,10 +795,10 @@ class AutoRNA(Auto):
         >>> runner.seq_chemistry(seq)
         'GEXSCOPE-MicroBead'
         """
-        if self.v3_offset(seq) != -1:
+        if v3_offset(seq) != -1:
             return "GEXSCOPE-V3"
 
-        if self.flv_rna_v2_offset(seq) != -1:
+        if flv_rna_v2_offset(seq) != -1:
             return "flv_rna-V2"
 
         for chemistry in ["GEXSCOPE-V2", "GEXSCOPE-V1"]:
@@ -369,8 +814,13 @@ class AutoRNA(Auto):
 
 
 class AutoBulkRNA(Auto):
-    def __init__(self, fq1_list, max_read=10000):
-        super().__init__(fq1_list, CHEMISTRY_DICT, max_read)
+    def __init__(self, fq1_list, max_read=10000, **kwargs):
+        super().__init__(fq1_list, CHEMISTRY_DICT, max_read, **kwargs)
+
+    def get_rules(self) -> list[ChemistryRule]:
+        return [ChemistryRule("bulk_rna-bulk_vdj_match", anchors=[(slice(0, 18), "GTGGTATCAACGCAGAGT", True)])] + [
+            self.bc_rule(chemistry) for chemistry in ["bulk_rna-V2", "bulk_rna-V1", "bulk_rna-V3"]
+        ]
 
     def seq_chemistry(self, seq):
         """
@@ -385,8 +835,11 @@ class AutoBulkRNA(Auto):
 
 
 class AutoFlv(Auto):
-    def __init__(self, fq1_list, max_read=10000):
-        super().__init__(fq1_list, CHEMISTRY_DICT, max_read)
+    def __init__(self, fq1_list, max_read=10000, **kwargs):
+        super().__init__(fq1_list, CHEMISTRY_DICT, max_read, **kwargs)
+
+    def get_rules(self) -> list[ChemistryRule]:
+        return [self.bc_rule(chemistry) for chemistry in ["flv", "flv-V2"]]
 
     def seq_chemistry(self, seq):
         """
@@ -398,10 +851,16 @@ class AutoFlv(Auto):
 
 
 class AutoAccuraRNA(Auto):
-    def __init__(self, fq1_list, max_read=10000):
-        super().__init__(fq1_list, CHEMISTRY_DICT, max_read)
+    def __init__(self, fq1_list, max_read=10000, **kwargs):
+        super().__init__(fq1_list, CHEMISTRY_DICT, max_read, **kwargs)
         p3_linker = "ATACGCGGA"
         self.p3_linker_mismatch_dict = create_mismatch_seqs(p3_linker)
+        self.p3_linker_index = BarcodeIndex([p3_linker], 1)
+
+    def get_rules(self) -> list[ChemistryRule]:
+        p3_rule = self.bc_rule("AccuraSCOPE_RNA_3p")
+        p3_rule.checks.insert(0, (slice(0, 9), self.p3_linker_index, False))
+        return [p3_rule, self.bc_rule("AccuraSCOPE_RNA_5p")]
 
     def seq_chemistry(self, seq) -> str | None:
         """
@@ -442,69 +901,444 @@ def get_pattern_dict_and_bc(chemistry, pattern: str = "", whitelist: str = "") -
 
 
 class BcUmi:
-    def __init__(self, chemistry, pattern="", whitelist="", strict=False):
+    def __init__(self, chemistry, pattern="", whitelist="", strict=False, max_mismatch=1, quality_correct=False):
+        """
+        Args:
+            strict: no mismatch allowed in barcode
+            max_mismatch: max mismatch allowed in each barcode segment if not strict.
+            quality_correct: get_bc_umi_batch corrects barcodes with base qualities if they are given,
+                see get_bc_umi_quality. Call fit_quality_prior first.
+
+        >>> seq = "TCGACTGTC" + "ATCCACGTGCTTGAGA" + "TTCGAGGAT" + "TCAGCATGCGGCTACG" + "TGCACGAGA" + "C" + "CATATCAATGGG"
+        >>> seq = "AA" + seq[2:]
+        >>> BcUmi("GEXSCOPE-V2").get_bc_umi(seq)[:3]
+        (False, False, '_TTCGAGGAT_TGCACGAGA')
+        >>> BcUmi("GEXSCOPE-V2", max_mismatch=2).get_bc_umi(seq)[:3]
+        (True, True, 'TCGACTGTC_TTCGAGGAT_TGCACGAGA')
+        """
         self.chemistry = chemistry
         self.pattern_dict, self.bc = get_pattern_dict_and_bc(self.chemistry, pattern, whitelist)
-        self.raw_list, self.mismatch_list = create_mismatch_origin_dicts_from_whitelists(self.bc, 0 if strict else 1)
-        # v3
-        self.offset_runner = AutoRNA([])
-
-    def get_bc_umi(self, seq) -> tuple[bool, bool, str, str]:
+        self.layout = ReadLayout(pattern) if chemistry == "customized" else CHEMISTRY_DICT[chemistry]["layout"]
+        self.n_mismatch = 0 if strict else max_mismatch
+        self.quality_correct = quality_correct
+        self.raw_list, self.mismatch_list = create_mismatch_indexes_from_whitelists(self.bc, self.n_mismatch)
+        # fast-reject bitmaps before the index search; None without whitelists
+        self.matcher = barcode.WhitelistMatcher(self.mismatch_list) if self.mismatch_list else None
+        # created by fit_quality_prior, or on first get_bc_umi_quality call with a uniform prior
+        self.quality_correctors = []
+        # batch: read length needed by pattern, including offset
+        self.read_len = self.layout.length + MAX_OFFSET_LEN
+
+    def get_offset(self, seq) -> int:
         if self.chemistry == "GEXSCOPE-V3":
-            offset = self.offset_runner.v3_offset(seq)
-            seq = seq[offset:]
+            return v3_offset(seq)
         elif self.chemistry == "flv_rna-V2":
-            offset = self.offset_runner.flv_rna_v2_offset(seq)
+            return flv_rna_v2_offset(seq)
+        return 0
+
+    def get_bc_umi(self, seq) -> tuple[bool, bool, str, str]:
+        offset = self.get_offset(seq)
+        if offset:
             seq = seq[offset:]
-        bc_list = [seq[x] for x in self.pattern_dict["C"]]
+        *bc_list, umi = self.layout.extract(seq)
         if self.chemistry == "flv":
             bc_list = [utils.reverse_complement(bc) for bc in bc_list[::-1]]
-        valid, corrected, corrected_seq = check_seq_mismatch(bc_list, self.raw_list, self.mismatch_list)
-        if "U" in self.pattern_dict:
-            umi = seq[self.pattern_dict["U"][0]]
+        if self.matcher:
+            valid, corrected, corrected_seq = self.matcher.match(bc_list)
         else:
-            umi = ""
+            valid, corrected, corrected_seq = check_seq_mismatch(bc_list, self.raw_list, self.mismatch_list)
         return valid, corrected, corrected_seq, umi
 
+    def fit_quality_prior(self, seqs, max_read=PRIOR_READS):
+        """
+        Create the QualityCorrector of each barcode segment, with a prior from exact-match barcode counts of the first
+        max_read sequences. The prior is fixed afterwards.
+        """
+        if not self.mismatch_list:
+            return
+        self.quality_correctors = [QualityCorrector(x.barcodes, self.n_mismatch) for x in self.mismatch_list]
+        counts = [[] for _ in self.quality_correctors]
+        for seq in itertools.islice(seqs, max_read):
+            offset = self.get_offset(seq)
+            if offset:
+                seq = seq[offset:]
+            *bc_list, _umi = self.layout.extract(seq)
+            if self.chemistry == "flv":
+                bc_list = [utils.reverse_complement(bc) for bc in bc_list[::-1]]
+            for corrector, x, bc in zip(self.quality_correctors, counts, bc_list):
+                x.append(corrector.exact_index(bc))
+        for corrector, x in zip(self.quality_correctors, counts):
+            corrector.add_counts(x)
+
+    def get_bc_umi_quality(self, seq, quality) -> tuple[bool, bool, str, str]:
+        """
+        Same as get_bc_umi, but a barcode segment that is not in the whitelist is corrected by QualityCorrector:
+        whitelist candidates are ranked by base quality and a prior from exact-match barcode counts,
+        and ambiguous corrections are invalid.
+        Call `fit_quality_prior` first with the reads (or a prefix of them); the prior is not updated while correcting,
+        so the results do not depend on read order. Without it the prior is uniform.
+
+        >>> runner = BcUmi("GEXSCOPE-V2")
+        >>> seq = "TCGACTGTC" + "ATCCACGTGCTTGAGA" + "TTCGAGGAT" + "TCAGCATGCGGCTACG" + "TGCACGAGA" + "C" + "CATATCAATGGG"
+        >>> runner.fit_quality_prior([seq] * 10)
+        >>> runner.get_bc_umi_quality(seq, "I" * len(seq))
+        (True, False, 'TCGACTGTC_TTCGAGGAT_TGCACGAGA', 'CATATCAATGGG')
+        >>> runner.get_bc_umi_quality("A" + seq[1:], "#" + "I" * (len(seq) - 1))
+        (True, True, 'TCGACTGTC_TTCGAGGAT_TGCACGAGA', 'CATATCAATGGG')
+        """
+        if not self.mismatch_list:
+            return self.get_bc_umi(seq)
+        if not self.quality_correctors:
+            self.quality_correctors = [QualityCorrector(x.barcodes, self.n_mismatch) for x in self.mismatch_list]
+        offset = self.get_offset(seq)
+        if offset:
+            seq, quality = seq[offset:], quality[offset:]
+        bc_list, bc_quality_list, _umi, _umi_qual = get_raw_umi_bc_and_quality(
+            seq, quality, self.layout, reverse_complement=self.chemistry == "flv"
+        )
+        valid, corrected = True, False
+        res = []
+        for corrector, bc, bc_quality in zip(self.quality_correctors, bc_list, bc_quality_list):
+            j, bc_corrected = corrector.correct(bc, bc_quality)
+            if j == -1:
+                valid = False
+                res.append("")
+                continue
+            corrected |= bc_corrected
+            res.append(corrector.index.barcodes[j])
+        return valid, corrected, "_".join(res), seq[self.layout.umi_slice]
 
-def invalid_debug(chemistry, fq1_list, output_file, max_read=10000):
+    def get_bc_umi_batch(self, seqs, quals=None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Batch version of get_bc_umi.
+        Args:
+            seqs: a chunk of R1 sequences, list of str or numpy S-dtype array
+            quals: R1 qualities. If given and quality_correct, barcodes that are not exact whitelist matches are
+                corrected by get_bc_umi_quality.
+        Returns:
+            valid: bool array
+            corrected: bool array
+            bc_codes: uint64 array with shape (n_read, n_bc_segment), encoded corrected barcode segments. 0 if invalid.
+                Use `decode_bc` to get the same corrected_seq as get_bc_umi.
+            umi: S-dtype array
+
+        >>> runner = BcUmi("GEXSCOPE-V2")
+        >>> seq = "TCGACTGTC" + "ATCCACGTGCTTGAGA" + "TTCGAGGAT" + "TCAGCATGCGGCTACG" + "TGCACGAGA" + "C" + "CATATCAATGGG"
+        >>> seqs = [seq, "A" + seq[1:], "A" * 80]
+        >>> valid, corrected, bc_codes, umi = runner.get_bc_umi_batch(seqs)
+        >>> valid.tolist(), corrected.tolist(), umi.tolist()
+        ([True, True, False], [False, True, False], [b'CATATCAATGGG', b'CATATCAATGGG', b'AAAAAAAAAAAA'])
+        >>> [runner.decode_bc(x) for x in bc_codes[:2]] == [runner.get_bc_umi(x)[2] for x in seqs[:2]]
+        True
+
+        Truncated reads give the same results as get_bc_umi
+        >>> seqs = [seq[:30], seq[:5], ""]
+        >>> for runner in [BcUmi("GEXSCOPE-V2"), BcUmi("GEXSCOPE-MicroBead")]:
+        ...     valid, corrected, bc_codes, umi = runner.get_bc_umi_batch(seqs)
+        ...     batch = [(bool(v), runner.decode_bc(x)) for v, x in zip(valid, bc_codes)]
+        ...     print(batch == [runner.get_bc_umi(x)[0:3:2] for x in seqs], batch[1])
+        True (False, '__')
+        True (True, 'TCGAC')
+
+        With quality_correct, a mismatch at a low-quality base decides between two whitelist barcodes,
+        and a high-quality mismatch between them is ambiguous
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        ...     _ = f.write("AAAAAA\\nAAAATT\\n")
+        >>> runner = BcUmi("customized", pattern="C6U4", whitelist=f.name, quality_correct=True)
+        >>> runner.fit_quality_prior(["AAAAAAGGGG", "AAAATTGGGG"] * 10)
+        >>> seqs = ["AAAAATGGGG"] * 3 + ["AAAAAAGGGG"]
+        >>> quals = ["IIII#IIIII", "IIIII#IIII", "IIIIIIIIII", "IIIIIIIIII"]
+        >>> valid, corrected, bc_codes, umi = runner.get_bc_umi_batch(seqs, quals)
+        >>> valid.tolist(), corrected.tolist(), [runner.decode_bc(x) for x in bc_codes]
+        ([True, True, False, True], [True, True, False, False], ['AAAATT', 'AAAAAA', '', 'AAAAAA'])
+        >>> runner.get_bc_umi_batch(seqs)[0].tolist()
+        [True, True, True, True]
+        >>> os.remove(f.name)
+        """
+        mat = barcode.seqs_to_matrix(seqs, self.read_len)
+        n_read = len(mat)
+        valid = np.ones(n_read, dtype=bool)
+        corrected = np.zeros(n_read, dtype=bool)
+        offset = None
+        if self.chemistry == "GEXSCOPE-V3":
+            offset = v3_offset_batch(mat)
+        elif self.chemistry == "flv_rna-V2":
+            offset = flv_rna_v2_offset_batch(mat)
+        if offset is not None:
+            offset_found = offset != -1
+            valid &= offset_found
+            offset = np.maximum(offset, 0)[:, np.newaxis]
+            rows = np.arange(n_read)[:, np.newaxis]
+
+        def get_segment(s: slice) -> np.ndarray:
+            if offset is None:
+                return mat[:, s]
+            return mat[rows, offset + np.arange(s.start, s.stop)]
+
+        segments = [get_segment(x) for x in self.layout.bc_slices]
+        seg_lens = []
+        if not self.mismatch_list:
+            # without whitelists, segments of truncated reads are kept as they are, without the padding
+            row_len = np.count_nonzero(mat, axis=1)
+            start = 0 if offset is None else offset[:, 0]
+            seg_lens = [np.clip(row_len - start - x.start, 0, x.stop - x.start) for x in self.layout.bc_slices]
+        if self.chemistry == "flv":
+            segments = [utils.reverse_complement_matrix(x) for x in segments[::-1]]
+            seg_lens = seg_lens[::-1]
+        bc_codes = np.zeros((n_read, len(segments)), dtype=np.uint64)
+        for i, segment in enumerate(segments):
+            codes = barcode.encode_matrix(segment)
+            if not self.mismatch_list:
+                bc_codes[:, i] = barcode.trim_codes(codes, seg_lens[i], segment.shape[1], self.chemistry == "flv")
+                continue
+            index = self.mismatch_list[i]
+            idx, seg_corrected = index.lookup_codes(codes)
+            seg_valid = idx != -1
+            valid &= seg_valid
+            corrected |= seg_corrected
+            bc_codes[:, i] = np.where(seg_valid, index.codes[np.maximum(idx, 0)], 0)
+
+        if self.layout.umi_slices:
+            umi_slice = self.layout.umi_slice
+            umi = np.ascontiguousarray(get_segment(umi_slice)).view(f"S{umi_slice.stop - umi_slice.start}").ravel()
+        else:
+            umi = np.zeros(n_read, dtype="S1")
+        if offset is not None:
+            corrected &= offset_found
+            bc_codes[~offset_found] = 0
+            umi[~offset_found] = b""
+        if self.quality_correct and quals is not None and self.mismatch_list:
+            # reads without mismatches, or with a segment that has no candidate, are the same in both methods
+            for i in np.flatnonzero(corrected).tolist():
+                seq = seqs[i].decode() if isinstance(seqs[i], bytes) else seqs[i]
+                qual = quals[i].decode() if isinstance(quals[i], bytes) else quals[i]
+                valid[i], corrected[i], corrected_seq, _umi = self.get_bc_umi_quality(seq, qual)
+                bc_codes[i] = [barcode.encode_seq(x) if x else 0 for x in corrected_seq.split("_")]
+        return valid, corrected, bc_codes, umi
+
+    @staticmethod
+    def decode_bc(bc_codes) -> str:
+        """Decode one row of bc_codes from get_bc_umi_batch into corrected_seq"""
+        return "_".join(barcode.decode_seq(int(x)) if x else "" for x in bc_codes)
+
+    def get_linker_checks(self) -> list[tuple[slice, BarcodeIndex]]:
+        """
+        (slice, index) of linker segments, created on first call. Linker whitelists are matched to L segments by
+        length, and whitelists of the same length are merged. 1 mismatch is allowed.
+        """
+        if not hasattr(self, "linker_checks"):
+            linkers = defaultdict(list)
+            for x in CHEMISTRY_DICT.get(self.chemistry, {}).get("linker", []):
+                linker = utils.one_col_to_list(x)
+                if self.chemistry.split("-")[0] == "flv":
+                    linker = [utils.reverse_complement(x) for x in linker]
+                for x in linker:
+                    linkers[len(x)].append(x)
+            indexes = {n: barcode.create_index(sorted(set(x)), 1) for n, x in linkers.items()}
+            self.linker_checks = [
+                (x, indexes[x.stop - x.start]) for x in self.layout.linker_slices if x.stop - x.start in indexes
+            ]
+        return self.linker_checks
+
+    def get_invalid_reason(self, seq) -> str:
+        """
+        Why get_bc_umi returns invalid, "" if valid. Comma separated failures:
+            short: read is shorter than the pattern
+            offset: linker to locate the barcodes is not found (GEXSCOPE-V3 and flv_rna-V2)
+            bc1, bc2...: barcode segment is not in the whitelist, numbered as the whitelists
+            linker: a linker segment is not in the linker whitelist
+        Linker is only reported together with barcode failures, since reads with valid barcodes are valid.
+
+        >>> runner = BcUmi("GEXSCOPE-V2")
+        >>> seq = "TCGACTGTC" + "ATCCACGTGCTTGAGA" + "TTCGAGGAT" + "TCAGCATGCGGCTACG" + "TGCACGAGA" + "C" + "CATATCAATGGG"
+        >>> runner.get_invalid_reason(seq), runner.get_invalid_reason("AA" + seq[2:25] + "A" * 9 + seq[34:])
+        ('', 'bc1,bc2')
+        >>> runner.get_invalid_reason(seq[:40])
+        'short'
+        >>> BcUmi("GEXSCOPE-V3").get_invalid_reason("A" * 80)
+        'offset'
+        """
+        offset = self.get_offset(seq)
+        if offset == -1:
+            return "offset"
+        seq = seq[offset:]
+        if len(seq) < self.layout.bc_stop:
+            return "short"
+        bc_list = self.layout.extract(seq)[:-1]
+        if self.chemistry == "flv":
+            bc_list = [utils.reverse_complement(bc) for bc in bc_list[::-1]]
+        res = []
+        for i, bc in enumerate(bc_list):
+            if self.matcher and not self.matcher.contains(i, bc):
+                res.append(f"bc{i + 1}")
+        if res and any(seq[sl] not in index for sl, index in self.get_linker_checks()):
+            res.append("linker")
+        return ",".join(res)
+
+
+class InvalidStats:
+    """
+    Streaming summary of invalid reads with bounded memory: read counts, counts of each invalid reason and a uniform
+    reservoir sample of n_sample invalid reads. Stats of shards can be merged.
+
+    >>> stats = InvalidStats(n_sample=2)
+    >>> for i in range(10):
+    ...     stats.add(i, f"r{i}", "ACGT", "IIII", "bc1" if i % 2 else "")
+    >>> stats.n_read, stats.n_invalid, dict(stats.reasons), len(stats.samples)
+    (10, 5, {'bc1': 5}, 2)
+    >>> other = InvalidStats(n_sample=2)
+    >>> other.add(10, "r10", "ACGT", "IIII", "offset")
+    >>> stats.merge(other)
+    >>> stats.n_read, stats.n_invalid, sorted(stats.reasons.items()), len(stats.samples)
+    (11, 6, [('bc1', 5), ('offset', 1)], 2)
+    """
+
+    def __init__(self, n_sample=1000, seed=0):
+        self.n_sample = n_sample
+        self.rng = random.Random(seed)
+        self.n_read = 0
+        self.n_invalid = 0
+        self.reasons = defaultdict(int)
+        # (ordinal, name, seq, qual, reason)
+        self.samples = []
+
+    def add(self, ordinal, name, seq, qual, reason):
+        self.n_read += 1
+        if not reason:
+            return
+        self.n_invalid += 1
+        self.reasons[reason] += 1
+        record = (ordinal, name, seq, qual, reason)
+        if len(self.samples) < self.n_sample:
+            self.samples.append(record)
+        else:
+            j = self.rng.randrange(self.n_invalid)
+            if j < self.n_sample:
+                self.samples[j] = record
+
+    def merge(self, other: "InvalidStats"):
+        """The merged sample is still a uniform sample of all invalid reads"""
+        a, b = self.samples[:], other.samples[:]
+        self.rng.shuffle(a)
+        self.rng.shuffle(b)
+        na, nb = self.n_invalid, other.n_invalid
+        samples = []
+        while len(samples) < self.n_sample and (a or b):
+            if b and (not a or self.rng.random() * (na + nb) >= na):
+                samples.append(b.pop())
+                nb -= 1
+            else:
+                samples.append(a.pop())
+                na -= 1
+        self.samples = samples
+        self.n_read += other.n_read
+        self.n_invalid += other.n_invalid
+        for reason, n in other.reasons.items():
+            self.reasons[reason] += n
+
+    def get_samples(self) -> list[tuple]:
+        """Sampled (ordinal, name, seq, qual, reason) in input order"""
+        return sorted(self.samples)
+
+    def get_reason_rows(self) -> list[tuple[str, int, float]]:
+        """(reason, count, percent of invalid reads), most frequent first"""
+        rows = sorted(self.reasons.items(), key=lambda x: (-x[1], x[0]))
+        return [(reason, n, round(n / self.n_invalid * 100, 2)) for reason, n in rows]
+
+    def write(self, fastq_file, stats_file):
+        """Write sampled invalid reads with the reason in the header, and reason counts"""
+        with utils.openfile(fastq_file, "wt") as f:
+            for _ordinal, name, seq, qual, reason in self.get_samples():
+                f.write(utils.fastq_str(f"{name} reason={reason}", seq, qual))
+        with open(stats_file, "w") as f:
+            f.write(f"total_reads\t{self.n_read}\n")
+            f.write(f"invalid_reads\t{self.n_invalid}\n")
+            for reason, n, percent in self.get_reason_rows():
+                f.write(f"{reason}\t{n}\t{percent}%\n")
+
+
+class InvalidDiagnoser:
+    """Worker of diagnose_invalid"""
+
+    def __init__(self, chemistry, n_sample=1000, seed=0):
+        self.runner = BcUmi(chemistry)
+        self.n_sample = n_sample
+        self.seed = seed
+
+    def process_chunk(self, start: int, chunk: fastq.FastqChunk) -> InvalidStats:
+        stats = InvalidStats(self.n_sample, seed=self.seed + start)
+        valid = self.runner.get_bc_umi_batch(chunk.seqs)[0].tolist()
+        for i, (name, seq, qual) in enumerate(chunk):
+            reason = "" if valid[i] else self.runner.get_invalid_reason(seq)
+            stats.add(start + i, name, seq, qual, reason)
+        return stats
+
+
+def diagnose_invalid(chemistry, fq1_list, max_read=None, n_sample=1000, threads=1, seed=0) -> InvalidStats:
+    """
+    Scan R1 fastqs of any chemistry in CHEMISTRY_DICT in one streaming pass and return InvalidStats.
+    Args:
+        max_read: only scan the first max_read reads. None scans all reads.
+        threads: chunks are scanned by this number of worker processes
+    """
+
+    def tasks():
+        start = 1
+        for fq1 in fq1_list:
+            for chunk in fastq.iter_fastq_chunks(fq1):
+                if max_read is not None and start + len(chunk) > max_read:
+                    n = max_read - start + 1
+                    chunk = fastq.FastqChunk(chunk.names[:n], chunk.seqs[:n], chunk.quals[:n])
+                if len(chunk):
+                    yield start, chunk
+                start += len(chunk)
+                if max_read is not None and start > max_read:
+                    return
+
+    stats = InvalidStats(n_sample, seed)
+    for chunk_stats in utils.map_chunks(InvalidDiagnoser(chemistry, n_sample, seed), tasks(), threads):
+        stats.merge(chunk_stats)
+    return stats
+
+
+def invalid_debug(chemistry, fq1_list, output_file, max_read=10000, sampling="head", stats=None, max_seq=1000):
+    """
+    Write an HTML report of invalid reads, with barcodes and linkers highlighted.
+    Args:
+        sampling: "head" or "random", see `fastq.read_fastq`
+        stats: InvalidStats from `diagnose_invalid`. If None, up to max_read reads of the first fastq are checked.
+        max_seq: max number of invalid reads in the report
+    """
     cur = CHEMISTRY_DICT[chemistry]
-    fq1 = fq1_list[0]
-    fq = pysam.FastxFile(fq1)
     bcs, linkers = [], []
     if "bc" in cur:
         for x in cur["bc"]:
             bc = utils.one_col_to_list(x)
             if chemistry.split("-")[0] == "flv":
-                bc = [utils.reverse_complement(x) for x in bc]
+                bc = utils.reverse_complement_batch(bc).astype(str).tolist()
             bcs.append(bc)
     if "linker" in cur:
         for x in cur["linker"]:
             linker = utils.one_col_to_list(x)
             if chemistry.split("-")[0] == "flv":
-                linker = [utils.reverse_complement(x) for x in linker]
+                linker = utils.reverse_complement_batch(linker).astype(str).tolist()
             linkers.extend(linker)
-    runner = BcUmi(chemistry)
+    if stats is None:
+        runner = BcUmi(chemistry)
+        stats = InvalidStats(n_sample=max_seq)
+        for i, (name, seq, qual) in enumerate(fastq.read_fastq(fq1_list[0], max_read, sampling), start=1):
+            valid = runner.get_bc_umi(seq)[0]
+            stats.add(i, name, seq, qual, "" if valid else runner.get_invalid_reason(seq))
+
+    highlighter = SeqHighlighter(list(zip(bcs, ["red", "green", "blue"])) + [(linkers, "yellow")])
     html_sequences = []
-    n_invalid = 0
-    n_read = 0
-    for read in fq:
-        n_read += 1
-        if n_read > max_read:
-            break
-        seq = read.sequence
-        valid, _corrected, _corrected_seq, _umi = runner.get_bc_umi(seq)
-        if valid:
-            continue
-        n_invalid += 1
-        for bc, color in zip(bcs, ["red", "green", "blue"]):
-            seq = add_color_in_html(seq, bc, background_color=color)
-        seq = add_color_in_html(seq, linkers, background_color="yellow")
-        html_sequences.append(f"{n_invalid}--{read.name}")
-        html_sequences.append(seq)
-
-    MAX_SEQ = 1000
-    joined_sequences = "<br>".join(html_sequences[: MAX_SEQ * 2])
+    samples = stats.get_samples()[:max_seq]
+    for n, (_ordinal, name, seq, _qual, reason) in enumerate(samples, start=1):
+        html_sequences.append(f"{n}--{name}--{reason}")
+        html_sequences.append(highlighter.highlight(seq))
+    joined_sequences = "<br>".join(html_sequences)
+    joined_reasons = "<br>".join(f"{reason}: {n} ({percent}%)" for reason, n, percent in stats.get_reason_rows())
 
     html_content = f"""
     <!DOCTYPE html>
@@ -520,7 +1354,11 @@ def invalid_debug(chemistry, fq1_list, output_file, max_read=10000):
                 bc3: <span style="background-color:blue;">blue</span><br>
                 linker: <span style="background-color:yellow;">yellow</span>
             </p>
-        <h3> First {MAX_SEQ} invalid reads </h3>
+        <h3> Invalid reasons in {stats.n_invalid} invalid reads of {stats.n_read} reads </h3>
+            <p>
+                {joined_reasons}
+            </p>
+        <h3> {len(samples)} sampled invalid reads </h3>
         {joined_sequences}
     </body>
     </html>
@@ -528,13 +1366,92 @@ def invalid_debug(chemistry, fq1_list, output_file, max_read=10000):
 
     with open(output_file, "w", encoding="utf-8") as f:
         f.write(html_content)
-    sys.stderr.write(f"invalid reads in first 10000 reads:{n_invalid}\n")
+    sys.stderr.write(f"invalid reads in {stats.n_read} reads:{stats.n_invalid}\n")
 
 
 def add_color_in_html(seq, items, color="black", background_color="white"):
-    for item in items:
-        seq = seq.replace(
-            item,
-            f'<span style="color:{color};background-color:{background_color};">{item}</span>',
-        )
-    return seq
+    """
+    >>> add_color_in_html("AACGT", ["ACG"], background_color="red")
+    'A<span style="color:black;background-color:red;">ACG</span>T'
+    """
+    return SeqHighlighter([(items, background_color)], color=color).highlight(seq)
+
+
+class SeqHighlighter:
+    """
+    Highlight groups of patterns in sequences with HTML spans.
+    An Aho-Corasick automaton of all patterns is built once, and all matches in a sequence are found in one pass.
+    Overlapping matches are resolved by group order, then by start; the sequence itself is never re-scanned.
+
+    >>> highlighter = SeqHighlighter([(["ACG"], "red"), (["CGTT", "TT"], "yellow")])
+    >>> highlighter.find("AACGTTT")
+    [(1, 4, 0), (2, 6, 1), (4, 6, 1), (5, 7, 1)]
+    >>> highlighter.highlight("AACGTTT").replace("color:black;background-color:", "")
+    'A<span style="red;">ACG</span><span style="yellow;">TT</span>T'
+    """
+
+    def __init__(self, groups: list[tuple[list[str], str]], color="black"):
+        """
+        Args:
+            groups: list of (patterns, background_color)
+        """
+        self.spans = [
+            f'<span style="color:{color};background-color:{background_color};">' for _, background_color in groups
+        ]
+        goto = [{}]
+        # (pattern length, group) of patterns ending at each state
+        out = [[]]
+        for group, (patterns, _background_color) in enumerate(groups):
+            for pattern in patterns:
+                state = 0
+                for ch in pattern:
+                    if ch not in goto[state]:
+                        goto.append({})
+                        out.append([])
+                        goto[state][ch] = len(goto) - 1
+                    state = goto[state][ch]
+                if pattern:
+                    out[state].append((len(pattern), group))
+        # complete the transitions with failure links in BFS order
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = dict(goto[0])
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            delta[state] = {**delta[fail[state]], **goto[state]}
+            out[state] = out[state] + out[fail[state]]
+            for ch, child in goto[state].items():
+                fail[child] = delta[fail[state]].get(ch, 0) if state else 0
+                queue.append(child)
+        self.delta = delta
+        self.out = out
+
+    def find(self, seq: str) -> list[tuple[int, int, int]]:
+        """Returns sorted (start, end, group) of all matches"""
+        res = []
+        delta, out = self.delta, self.out
+        state = 0
+        for i, ch in enumerate(seq, start=1):
+            state = delta[state].get(ch, 0)
+            for length, group in out[state]:
+                res.append((i - length, i, group))
+        res.sort()
+        return res
+
+    def highlight(self, seq: str) -> str:
+        matches = sorted(self.find(seq), key=lambda x: (x[2], x[0]))
+        covered = bytearray(len(seq))
+        selected = []
+        for start, end, group in matches:
+            if not any(covered[start:end]):
+                covered[start:end] = b"\x01" * (end - start)
+                selected.append((start, end, group))
+        selected.sort()
+        res = []
+        pos = 0
+        for start, end, group in selected:
+            res += [seq[pos:start], self.spans[group], seq[start:end], "</span>"]
+            pos = end
+        res.append(seq[pos:])
+        return "".join(res)
@@ -5,26 +5,25 @@ from typing import Union
 
 def create_pattern_args(pattern: str) -> str:
     """Create starsolo args relate to pattern"""
-    pattern_dict = parse_chemistry.parse_pattern(pattern)
-    if len(pattern_dict["U"]) != 1:
+    layout = parse_chemistry.ReadLayout(pattern)
+    if len(layout.umi_slices) != 1:
         raise ValueError(
             f"Error: Wrong pattern:{pattern}. \n Solution: fix pattern so that UMI only have 1 position.\n"
         )
-    ul = pattern_dict["U"][0].start
-    ur = pattern_dict["U"][0].stop
+    ul = layout.umi_slice.start
+    ur = layout.umi_slice.stop
     umi_len = ur - ul
 
-    if len(pattern_dict["C"]) == 1:
+    if layout.n_bc == 1:
         solo_type = "CB_UMI_Simple"
-        start, stop = pattern_dict["C"][0].start, pattern_dict["C"][0].stop
-        cb_start = start + 1
-        cb_len = stop - start
+        cb_start = layout.bc_starts[0] + 1
+        cb_len = layout.bc_lens[0]
         umi_start = ul + 1
         cb_str = f"--soloCBstart {cb_start} --soloCBlen {cb_len} --soloCBmatchWLtype 1MM "
         umi_str = f"--soloUMIstart {umi_start} --soloUMIlen {umi_len} "
     else:
         solo_type = "CB_UMI_Complex"
-        cb_pos = " ".join([f"0_{x.start}_0_{x.stop-1}" for x in pattern_dict["C"]])
+        cb_pos = " ".join([f"0_{x.start}_0_{x.stop-1}" for x in layout.bc_slices])
         umi_pos = f"0_{ul}_0_{ur-1}"
         cb_str = f"--soloCBposition {cb_pos} --soloCBmatchWLtype EditDist_2 "
         umi_str = f"--soloUMIposition {umi_pos} --soloUMIlen {umi_len} "
@@ -0,0 +1,256 @@
+"""
+UMI deduplication and error correction.
+
+UMIs are packed into uint64 codes with the encoding of `sccore.barcode`. UMIs with bases other than ACGTN get a
+code derived from their hash, which is only equal for the same UMI and is never within 1 mismatch of any code. Reads are reduced to unique (group, UMI)
+pairs with read counts by sorting, and UMIs within 1 mismatch in the same group can be collapsed. Methods:
+    unique: distinct UMIs
+    cluster: connected components of the 1-Hamming UMI graph
+    directional: UMI-tools directional method. UMI a absorbs b if they differ by 1 base and count(a) >= 2 * count(b) - 1
+"""
+
+import hashlib
+
+import numpy as np
+from sccore import barcode
+
+METHODS = ("unique", "cluster", "directional")
+_BASE_MASK = np.uint64(barcode.INVALID_BASE)
+# A, C, G, T and N
+_BASES = np.array([0, 1, 2, 3, 4], dtype=np.uint64)
+# codes >= INVALID_UMI_FLAG are UMIs with invalid bases. Codes of valid UMIs are below it, since their first base is
+# at most N (4).
+INVALID_UMI_FLAG = 0xF << 60
+
+
+def _invalid_umi_code(umi: bytes) -> int:
+    digest = hashlib.blake2b(umi, digest_size=8).digest()
+    return INVALID_UMI_FLAG | (int.from_bytes(digest, "little") & ((1 << 60) - 1))
+
+
+def _encode_valid(arr: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    if lengths.min() == arr.dtype.itemsize:
+        return barcode.encode_array(arr)
+    codes = np.empty(len(arr), dtype=np.uint64)
+    for length in np.unique(lengths).tolist():
+        mask = lengths == length
+        # empty UMIs are encoded as the leading bit only
+        codes[mask] = barcode.encode_array(arr[mask].astype(f"S{length}")) if length else 1
+    return codes
+
+
+def encode_umis(umis) -> np.ndarray:
+    """
+    Encode UMIs (list of str or numpy S-dtype array) into uint64 codes. UMIs may have different lengths.
+    UMIs with bases other than ACGTN, or longer than barcode.MAX_LEN, get hash codes >= INVALID_UMI_FLAG.
+    uint64 arrays are returned as is.
+
+    >>> codes = encode_umis(["ACGT", "ACG", "ACGT"])
+    >>> [barcode.decode_seq(int(x)) for x in codes]
+    ['ACGT', 'ACG', 'ACGT']
+    >>> codes = encode_umis(["AC.T", "AC*T", "AC.T", "ACNT"])
+    >>> len(set(codes.tolist())), [x >= INVALID_UMI_FLAG for x in codes.tolist()]
+    (3, [True, True, True, False])
+    """
+    if isinstance(umis, np.ndarray) and umis.dtype == np.uint64:
+        return umis
+    arr = np.asarray(umis, dtype=bytes).ravel()
+    if arr.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    lengths = np.char.str_len(arr)
+    mat = np.ascontiguousarray(arr).view(np.uint8).reshape(len(arr), -1)
+    in_umi = np.arange(mat.shape[1]) < lengths[:, np.newaxis]
+    invalid = ((barcode.BASE_LUT[mat] == barcode.INVALID_BASE) & in_umi).any(axis=1) | (lengths > barcode.MAX_LEN)
+    if not invalid.any():
+        return _encode_valid(arr, lengths)
+    codes = np.empty(len(arr), dtype=np.uint64)
+    valid = ~invalid
+    if valid.any():
+        codes[valid] = _encode_valid(arr[valid], lengths[valid])
+    codes[invalid] = np.array([_invalid_umi_code(x) for x in arr[invalid].tolist()], dtype=np.uint64)
+    return codes
+
+
+def _unique_pairs(groups: np.ndarray, codes: np.ndarray, reads: np.ndarray):
+    """
+    Returns:
+        groups, codes and read counts of unique (group, code) pairs sorted by (group, code), and the pair index of
+        each input
+    """
+    order = np.lexsort((codes, groups))
+    g, c = groups[order], codes[order]
+    is_start = np.ones(len(g), dtype=bool)
+    is_start[1:] = (g[1:] != g[:-1]) | (c[1:] != c[:-1])
+    starts = np.flatnonzero(is_start)
+    inverse = np.empty(len(g), dtype=np.int64)
+    inverse[order] = np.cumsum(is_start) - 1
+    counts = np.add.reduceat(reads[order], starts) if len(g) else reads[:0]
+    return g[starts], c[starts], counts, inverse
+
+
+def _hamming1_edges(groups: np.ndarray, codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (src, dst) of unique (group, code) pairs whose UMIs are in the same group and differ by 1 base.
+    Each edge appears in both directions. Codes of invalid UMIs have no edges.
+    For each position, pairs are sorted with the base at the position masked, so neighbours become adjacent.
+
+    >>> codes = encode_umis(["AAAA", "AAAT", "AACT", "AAAT"])
+    >>> [x.tolist() for x in _hamming1_edges(np.array([0, 0, 0, 1]), codes)]
+    [[0, 1, 1, 2], [1, 0, 2, 1]]
+    """
+    src, dst = [], []
+    valid = codes < np.uint64(INVALID_UMI_FLAG)
+    max_len = (int(codes[valid].max()).bit_length() - 1) // barcode.BITS if valid.any() else 0
+    for pos in range(max_len):
+        shift = np.uint64(barcode.BITS * pos)
+        # valid codes with a base at pos
+        idx = np.flatnonzero(((codes >> shift) >= np.uint64(8)) & valid)
+        masked = codes[idx] | (_BASE_MASK << shift)
+        g = groups[idx]
+        order = np.lexsort((masked, g))
+        idx, masked, g = idx[order], masked[order], g[order]
+        adjacent = (masked[1:] == masked[:-1]) & (g[1:] == g[:-1])
+        # at most 5 codes share a masked code, so neighbours are within 4 positions.
+        # same[i]: sorted pairs i to i + d share the masked code
+        same = adjacent
+        for d in range(1, len(_BASES)):
+            if d > 1:
+                same = same[:-1] & adjacent[d - 1 :]
+            hit = np.flatnonzero(same)
+            if not len(hit):
+                break
+            src += [idx[hit], idx[hit + d]]
+            dst += [idx[hit + d], idx[hit]]
+    if not src:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(src), np.concatenate(dst)
+
+
+def _collapse(groups: np.ndarray, codes: np.ndarray, reads: np.ndarray, method: str) -> np.ndarray:
+    """
+    Index of the representative of each unique (group, code) pair, sorted by (group, code).
+    UMIs are visited by read count (descending) then code, and each UMI goes to the first visited UMI that reaches it,
+    which is the same as UMI-tools.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown UMI method: {method}. Choose from {METHODS}")
+    n = len(codes)
+    if method == "unique" or n == 0:
+        return np.arange(n)
+    src, dst = _hamming1_edges(groups, codes)
+    if method == "directional":
+        keep = reads[src] >= 2 * reads[dst] - 1
+        src, dst = src[keep], dst[keep]
+    order = np.lexsort((codes, -reads))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    # propagate the smallest rank along edges until stable
+    label = rank
+    while len(src):
+        new = label.copy()
+        np.minimum.at(new, dst, label[src])
+        if np.array_equal(new, label):
+            break
+        label = new
+    return order[label]
+
+
+def count_umis(groups, umis, method="unique", reads=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count reads and UMIs of each group.
+    Args:
+        groups: int group id of each read, e.g. barcode or (barcode, gene) ids
+        umis: UMI of each read, see `encode_umis`
+        method: one of METHODS
+        reads: read count of each (group, UMI) if inputs are already counted. Default 1.
+    Returns:
+        group ids (sorted), read counts, UMI counts
+
+    >>> groups = [0] * 6 + [1] * 2 + [2] * 4
+    >>> umis = ["AAAA"] * 3 + ["AAAT", "CCCC", "CCCG"] + ["AAAA", "AAAT"] + ["AAAA"] * 2 + ["AAAT"] * 2
+    >>> for method in METHODS:
+    ...     print(method, [x.tolist() for x in count_umis(groups, umis, method)])
+    unique [[0, 1, 2], [6, 2, 4], [4, 2, 2]]
+    cluster [[0, 1, 2], [6, 2, 4], [2, 1, 1]]
+    directional [[0, 1, 2], [6, 2, 4], [2, 1, 2]]
+
+    UMIs with invalid bases are only merged with the same UMI
+    >>> [x.tolist() for x in count_umis([0] * 4, ["AA.A", "AA*A", "AA.A", "AAAA"], "cluster")]
+    [[0], [4], [3]]
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    codes = encode_umis(umis)
+    reads = np.ones(len(groups), dtype=np.int64) if reads is None else np.asarray(reads, dtype=np.int64)
+    g, c, r, _inverse = _unique_pairs(groups, codes, reads)
+    is_root = _collapse(g, c, r, method) == np.arange(len(g))
+    if len(g) == 0:
+        return g, r, r
+    starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    return g[starts], np.add.reduceat(r, starts), np.add.reduceat(is_root.astype(np.int64), starts)
+
+
+def correct_umis(groups, umis, method="directional") -> np.ndarray:
+    """
+    Corrected UMI code of each read. UMIs are replaced by the representative UMI of their cluster in the group.
+
+    >>> codes = correct_umis([0, 0, 0, 1], ["AAAA", "AAAA", "AAAT", "AAAT"])
+    >>> [barcode.decode_seq(int(x)) for x in codes]
+    ['AAAA', 'AAAA', 'AAAA', 'AAAT']
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    codes = encode_umis(umis)
+    g, c, r, inverse = _unique_pairs(groups, codes, np.ones(len(groups), dtype=np.int64))
+    return c[_collapse(g, c, r, method)][inverse]
+
+
+class UmiCounter:
+    """
+    Streaming read and UMI counts of each key (e.g. barcode, or (cell, gene)) with bounded memory.
+    Reads are buffered as key ids and UMI codes, and reduced to unique (key, UMI) pairs every max_buffer reads.
+
+    >>> counter = UmiCounter()
+    >>> counter.add(["c1", "c1", "c1", "c2"], ["AAAA", "AAAA", "AAAT", "CCCC"])
+    >>> counter.count()
+    {'c1': (3, 2), 'c2': (1, 1)}
+    >>> counter.count("directional")
+    {'c1': (3, 1), 'c2': (1, 1)}
+    """
+
+    def __init__(self, max_buffer=1 << 22):
+        self.max_buffer = max_buffer
+        self.key_ids = {}
+        # unique (key id, UMI code) pairs and their read counts
+        self.groups = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros(0, dtype=np.uint64)
+        self.reads = np.zeros(0, dtype=np.int64)
+        self.buffer = []
+        self.n_buffer = 0
+
+    def add(self, keys: list, umis):
+        """Add a batch of reads"""
+        key_ids = self.key_ids
+        groups = np.fromiter((key_ids.setdefault(k, len(key_ids)) for k in keys), dtype=np.int64, count=len(keys))
+        self.buffer.append((groups, encode_umis(umis)))
+        self.n_buffer += len(groups)
+        if self.n_buffer >= self.max_buffer:
+            self.compact()
+
+    def compact(self):
+        if not self.buffer:
+            return
+        groups = np.concatenate([self.groups] + [x[0] for x in self.buffer])
+        codes = np.concatenate([self.codes] + [x[1] for x in self.buffer])
+        reads = np.concatenate([self.reads, np.ones(self.n_buffer, dtype=np.int64)])
+        self.groups, self.codes, self.reads, _inverse = _unique_pairs(groups, codes, reads)
+        self.buffer = []
+        self.n_buffer = 0
+
+    def count(self, method="unique") -> dict:
+        """
+        Returns:
+            {key: (read count, UMI count)}
+        """
+        self.compact()
+        keys = list(self.key_ids)
+        group_ids, n_reads, n_umis = count_umis(self.groups, self.codes, method, reads=self.reads)
+        return {keys[g]: (r, u) for g, r, u in zip(group_ids.tolist(), n_reads.tolist(), n_umis.tolist())}
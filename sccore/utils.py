@@ -1,15 +1,21 @@
 import gzip
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
+import struct
 import sys
 import time
 import csv
-from collections import defaultdict, OrderedDict
+import zlib
+from collections import defaultdict, deque, OrderedDict
 from datetime import timedelta
 from functools import wraps
 from pathlib import Path
 from typing import Union
 
+import numpy as np
 import pandas as pd
 
 
@@ -73,13 +79,55 @@ def nested_defaultdict(dim=3, val_type=int):
         return defaultdict(lambda: nested_defaultdict(dim - 1, val_type=val_type))
 
 
+# complement of each byte; unknown bases become N, padding byte 0 stays 0
+COMPLEMENT_TABLE = bytearray(b"N" * 256)
+COMPLEMENT_TABLE[0] = 0
+for _base, _complement in zip(b"ACGTN", b"TGCAN"):
+    COMPLEMENT_TABLE[_base] = _complement
+COMPLEMENT_TABLE = bytes(COMPLEMENT_TABLE)
+COMPLEMENT_LUT = np.frombuffer(COMPLEMENT_TABLE, dtype=np.uint8)
+
+
 def reverse_complement(dna: str) -> str:
     """Returns the reverse complement of a DNA sequence, allowing 'N' bases.
+    Unknown bases become 'N'.
     >>> reverse_complement("ATCGNTA")
     'TANCGAT'
+    >>> reverse_complement("acgX")
+    'NNNN'
     """
-    complement = {"A": "T", "T": "A", "C": "G", "G": "C", "N": "N"}
-    return "".join(complement.get(base, "N") for base in reversed(dna))
+    return dna.encode("latin-1", "replace").translate(COMPLEMENT_TABLE)[::-1].decode("latin-1")
+
+
+def reverse_complement_matrix(mat: np.ndarray) -> np.ndarray:
+    """Reverse complement each row of an uint8 matrix with shape (n, length).
+
+    >>> reverse_complement_matrix(np.frombuffer(b"ATCGN", dtype=np.uint8).reshape(1, 5)).tobytes()
+    b'NCGAT'
+    """
+    return COMPLEMENT_LUT[mat[:, ::-1]]
+
+
+def reverse_complement_batch(seqs) -> np.ndarray:
+    """Reverse complement a batch of sequences at once.
+    Args:
+        seqs: list of str or numpy S-dtype array. Equal-length sequences take the vectorized path.
+    Returns:
+        numpy S-dtype array
+
+    >>> reverse_complement_batch(["ATCGN", "AAAAC"]).tolist()
+    [b'NCGAT', b'GTTTT']
+    >>> reverse_complement_batch(["ATCG", "A"]).tolist()
+    [b'CGAT', b'T']
+    """
+    arr = np.asarray(seqs, dtype=bytes)
+    if arr.size == 0:
+        return arr
+    length = arr.dtype.itemsize
+    if (np.char.str_len(arr) != length).any():
+        return np.array([x.translate(COMPLEMENT_TABLE)[::-1] for x in arr], dtype=arr.dtype)
+    mat = np.ascontiguousarray(arr).view(np.uint8).reshape(-1, length)
+    return np.ascontiguousarray(reverse_complement_matrix(mat)).view(arr.dtype).ravel()
 
 
 def add_log(func):
@@ -110,6 +158,28 @@ def add_log(func):
     return wrapper
 
 
+def get_cache_dir() -> str:
+    """User cache dir of sccore: $XDG_CACHE_HOME/sccore, default ~/.cache/sccore"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "sccore")
+
+
+def get_file_key(path) -> dict:
+    """
+    Identity of a file for cache validation: real path, mtime and size. Cheaper than hashing the content.
+    "name" is a short file name derived from the real path.
+    """
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    digest = hashlib.md5(real_path.encode()).hexdigest()[:16]
+    return {
+        "path": real_path,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "name": f"{os.path.basename(real_path)}.{digest}",
+    }
+
+
 def one_col_to_list(file) -> list[str]:
     """
     Read file with one column. Strip each line.
@@ -139,3 +209,181 @@ def generic_open(file_name: Union[str, Path], *args, **kwargs):
     else:
         file_obj = open(file_name, *args, **kwargs)
     return file_obj
+
+
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_MAX_BLOCK_SIZE = 0x10000
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def bgzf_compress(data: bytes, compresslevel: int = 1) -> bytes:
+    """
+    Compress data into BGZF blocks, i.e. gzip members with a 'BC' extra field holding the block size.
+    The EOF block is not included.
+
+    >>> data = b"ACGT" * 100000
+    >>> gzip.decompress(bgzf_compress(data) + BGZF_EOF) == data
+    True
+    """
+    out = []
+    for i in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[i : i + BGZF_BLOCK_SIZE]
+        for level in (compresslevel, 0):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            if len(cdata) + 26 <= BGZF_MAX_BLOCK_SIZE:
+                break
+        header = struct.pack("<4BI2BH2sHH", 31, 139, 8, 4, 0, 0, 255, 6, b"BC", 2, len(cdata) + 25)
+        out += [header, cdata, struct.pack("<II", zlib.crc32(block), len(block))]
+    return b"".join(out)
+
+
+def compress_bytes(data: bytes, compress=None, compresslevel: int = 1) -> bytes:
+    """
+    Args:
+        compress: "gzip" returns a gzip member, "bgzf" returns BGZF blocks without EOF, None returns data
+    """
+    if compress == "gzip":
+        return gzip.compress(data, compresslevel=compresslevel)
+    if compress == "bgzf":
+        return bgzf_compress(data, compresslevel)
+    if compress is None:
+        return data
+    raise ValueError(f"Unknown compress: {compress}")
+
+
+class WriterPool:
+    """
+    Write to many files with a bounded number of open handles.
+    Data is buffered per file in memory and flushed in large blocks to the file opened in append mode.
+    At most max_open files are open at any time, the least recently used one is closed first.
+    A file is truncated when it is first flushed.
+
+    Args:
+        compress: "auto" (gzip if the path ends with .gz), "gzip", "bgzf" or None.
+            Each flush is appended as a gzip member or as BGZF blocks, concatenated members are a valid gzip file.
+            Use None to write data that is already compressed.
+        buffer_size: flush a file when its buffer reaches buffer_size bytes
+        max_buffer: flush the largest buffers when the buffers of all files reach max_buffer bytes
+
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> with WriterPool(max_open=2, buffer_size=4) as pool:
+    ...     for i in range(9):
+    ...         pool.write(f"{tmp}/{i % 3}.txt.gz", f"{i}\\n")
+    >>> gzip.open(f"{tmp}/0.txt.gz", "rt").read().split()
+    ['0', '3', '6']
+    >>> import shutil; shutil.rmtree(tmp)
+    """
+
+    def __init__(self, max_open=64, buffer_size=1 << 20, max_buffer=256 << 20, compress="auto", compresslevel=1):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.max_buffer = max_buffer
+        self.compress = compress
+        self.compresslevel = compresslevel
+        # path: handle, in LRU order
+        self.handles = OrderedDict()
+        self.buffers = defaultdict(list)
+        self.buffer_len = defaultdict(int)
+        self.total_len = 0
+        self.opened = set()
+        self.bgzf_paths = set()
+
+    def write(self, path, data: Union[str, bytes]):
+        if isinstance(data, str):
+            data = data.encode()
+        path = str(path)
+        self.buffers[path].append(data)
+        self.buffer_len[path] += len(data)
+        self.total_len += len(data)
+        if self.buffer_len[path] >= self.buffer_size:
+            self.flush(path)
+        elif self.total_len >= self.max_buffer:
+            for largest in sorted(self.buffer_len, key=self.buffer_len.get, reverse=True):
+                self.flush(largest)
+                if self.total_len < self.max_buffer // 2:
+                    break
+
+    def get_compress(self, path: str):
+        if self.compress == "auto":
+            return "gzip" if path.endswith(".gz") else None
+        return self.compress
+
+    def get_handle(self, path: str):
+        if path in self.handles:
+            self.handles.move_to_end(path)
+            return self.handles[path]
+        if len(self.handles) >= self.max_open:
+            _path, handle = self.handles.popitem(last=False)
+            handle.close()
+        handle = open(path, "ab" if path in self.opened else "wb")
+        self.opened.add(path)
+        self.handles[path] = handle
+        return handle
+
+    def flush(self, path):
+        path = str(path)
+        if not self.buffer_len.get(path):
+            return
+        data = b"".join(self.buffers.pop(path))
+        self.total_len -= self.buffer_len.pop(path)
+        compress = self.get_compress(path)
+        if compress == "bgzf":
+            self.bgzf_paths.add(path)
+        self.get_handle(path).write(compress_bytes(data, compress, self.compresslevel))
+
+    def close(self):
+        for path in list(self.buffer_len):
+            self.flush(path)
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+        for path in self.bgzf_paths:
+            with open(path, "ab") as f:
+                f.write(BGZF_EOF)
+        self.bgzf_paths.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_worker = None
+
+
+def _init_worker(worker):
+    global _worker
+    _worker = worker
+
+
+def _process_chunk(task):
+    return _worker.process_chunk(*task)
+
+
+def map_chunks(worker, tasks, threads: int = 1):
+    """
+    Yield worker.process_chunk(*task) for each task, in input order.
+    If threads > 1, tasks are processed by a pool of worker processes, each with a copy of worker, while the caller
+    keeps producing tasks; at most threads * 2 tasks are in flight.
+
+    >>> class Square:
+    ...     def process_chunk(self, x):
+    ...         return x * x
+    >>> list(map_chunks(Square(), [(1,), (2,), (3,)]))
+    [1, 4, 9]
+    """
+    if threads <= 1:
+        for task in tasks:
+            yield worker.process_chunk(*task)
+        return
+    with multiprocessing.Pool(threads, initializer=_init_worker, initargs=(worker,)) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_process_chunk, (task,)))
+            if len(pending) >= threads * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()